@@ -4,6 +4,7 @@ import json
 import asyncio
 import traceback
 import sys
+import time
 
 from .interpereter import Interpereter
 from . import parser
@@ -22,6 +23,8 @@ def main():
 	try:
 		args = parse_arguments()
 		filename = proc_filename(args.filename)
+		if args.parse_benchmark:
+			sys.exit(benchmark_parser(filename))
 		sys.exit(run_file(filename))
 	except parser.ParseFailed as e:
 		print(format_error_place(code, e.position))
@@ -33,6 +36,7 @@ def parse_arguments():
 	action = parser.add_mutually_exclusive_group()
 	action.add_argument('-t', '--trace', action = 'store_true', help = 'Display details of the program as it is running')
 	action.add_argument('-c', '--compile', action = 'store_true', help = 'Dumps the bytecode of the program rather than running it')
+	action.add_argument('-p', '--parse-benchmark', action = 'store_true', help = 'Times parsing the program, along with some long and deeply nested expressions')
 	return parser.parse_args()
 
 
@@ -62,6 +66,33 @@ def run_file(filename):
 	return 0 if worked else 1
 
 
+def benchmark_parser(filename, repeats = 20):
+	inputs = [(filename, open(filename).read())]
+	for size in [10, 30, 100, 1000]:
+		inputs += [
+			('{} brackets'.format(size), '(' * size + '1' + ')' * size),
+			('{} lists'.format(size), '[' * size + ']' * size),
+			('{} calls'.format(size), 'f(' * size + ')' * size),
+			('{} lambdas'.format(size), 'x -> ' * size + 'x'),
+			('{} negations'.format(size), '-' * size + '1'),
+			('{} powers'.format(size), '2^' * size + '2'),
+		]
+	for size in [1000, 10000]:
+		inputs.append(('{} additions'.format(size), '+'.join(['x'] * size)))
+		inputs.append(('{} arguments'.format(size), 'f(' + ','.join(['x'] * size) + ')'))
+	for name, code in inputs:
+		start = time.perf_counter()
+		for _ in range(repeats):
+			try:
+				parser.parse(code)
+				outcome = 'ok'
+			except (parser.ParseFailed, parser.TokenizationFailed) as e:
+				outcome = e.__class__.__name__
+		elapsed = (time.perf_counter() - start) / repeats
+		print('{:30} {:9.3f}ms  {}'.format(name, elapsed * 1000, outcome))
+	return 0
+
+
 def interactive_terminal():
 	terminal = Terminal.new_blackbox_sync(
 		allow_special_commands=True,
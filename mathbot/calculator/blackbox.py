@@ -7,8 +7,13 @@ from . import errors
 from . import runtime
 from . import formatter
 from . import crucible
+from . import quota
+from . import snapshot
+from . import profiler
+from . import nodes
+from . import image
+from . import results
 import sympy
-import async_timeout
 import json
 import traceback
 import re
@@ -25,6 +30,19 @@ On line {line_num} at position {position}
 TAB_WITH = 8
 
 
+# Estimated memory used by a terminal that hasn't defined anything
+TERMINAL_SIZE = 16 * 1024
+
+
+# Resources that a single command may use, unless told otherwise
+DEFAULT_COMMAND_QUOTA = quota.Budget(cpu_time=5)
+
+
+# Seconds that formatting a result, and working out its decimal
+# approximation, may each take
+RENDER_TIME_LIMIT = 2
+
+
 class Terminal:
 
     def __init__(self,
@@ -34,6 +52,9 @@ class Terminal:
                  yield_rate=100,
                  colour_output=False,
                  runtime_protection_level=0,
+                 cache_budget=None,
+                 command_quota=DEFAULT_COMMAND_QUOTA,
+                 result_cache=None,
                  _called_directly=True,
                  trap_unknown_errors=False):
         if _called_directly:
@@ -42,14 +63,26 @@ class Terminal:
         self.show_parsepoint = False
         self.show_result_type = False
         self.builder = bytecode.Builder()
+        if runtime_protection_level > 0:
+            # User code can't reassign the builtins, so they can be folded
+            self.builder.known_values = runtime.known_values()
         self.allow_special_commands = allow_special_commands
         self.colour_output = colour_output
         self.interpereter = interpereter.Interpereter(yield_rate=yield_rate, use_crucible=True)
+        if cache_budget is not None:
+            self.interpereter.calling_cache.memory_budget = cache_budget
         self.line_count = 0
         self.retain_cache = retain_cache
         self.output_limit = output_limit
         self.trap_unknown_errors = False
         self.timeout = True
+        self.command_quota = command_quota
+        self.runtime_protection_level = runtime_protection_level
+        self.result_cache = result_cache
+        # Names defined by the runtime library, if it's protected
+        self.runtime_names = None
+        self.snapshot_base = None
+        self.last_profile = None
 
     @staticmethod
     def new_blackbox_sync(**kwargs):
@@ -60,7 +93,13 @@ class Terminal:
     async def new_blackbox(**kwargs):
         term = Terminal(_called_directly=False, **kwargs)
         try:
-            runtime_segment = runtime.prepare_runtime(term.builder)
+            # The runtime library is compiled and run once, and then
+            # copied into each new terminal
+            runtime_segment, references = await image.prepare(
+                term.builder,
+                term.interpereter,
+                kwargs.get('runtime_protection_level', 0)
+            )
         except parser.ParseFailed as e:
             print('RUNTIME ISSUE: Parse error')
             print(format_error_place(runtime.LIBRARY_CODE, e.position))
@@ -69,23 +108,66 @@ class Terminal:
             print('RUNTIME ISSUE: Tokenization error')
             print(format_error_place(runtime.LIBRARY_CODE, e.position))
             raise e
-        try:
-            await term.interpereter.run_async(
-                segment=runtime_segment,
-                assignment_auth_level=kwargs.get('runtime_protection_level', 0),
-                assignment_protection_level=kwargs.get('runtime_protection_level', 0)
-            )
         except Exception:
-            print('Error during library loading. Re-running with trace.')
+            print('Error during library loading.')
             traceback.print_exc()
-            temp_interp = interpereter.Interpereter(
-                term.linker.constructed(),
-                yield_rate=kwargs.get('yield_rate', 100),
-                trace=True
-            )
-            await temp_interp.run_async()
+            raise
+        term.snapshot_base = snapshot.Base(term.interpereter, runtime_segment, references)
+        if term.runtime_protection_level > 0:
+            term.runtime_names = frozenset(term.builder.globalscope.name_mapping)
         return term
 
+    def result_key(self, tokens, ast):
+        ''' The key to use for the output of some code in the result cache,
+            or None if the output can't be cached.
+        '''
+        if self.result_cache is None or self.runtime_names is None:
+            return None
+        if self.show_tree or self.show_result_type or self.interpereter.trace \
+                or self.interpereter.profiler is not None:
+            return None
+        if not results.is_pure(ast, self.runtime_names):
+            return None
+        # Whitespace and comments are already gone from the tokens
+        source = tuple(i.string for i in tokens.original_tokens)
+        return (self.runtime_protection_level, self.output_limit, self.timeout, source)
+
+    def memory_usage(self):
+        ''' Rough estimate of the number of bytes that this terminal uses,
+            not counting anything that it shares with other terminals.
+        '''
+        size = TERMINAL_SIZE + self.interpereter.calling_cache.size
+        for value in self.interpereter.root_scope.values:
+            if value is not None and self.snapshot_base.references.key(value) is None:
+                size += interpereter.estimate_size(value)
+        return size
+
+    def snapshot(self):
+        ''' Returns a string that can be used to restore the global state later.
+            Raises snapshot.SnapshotError if the state can't be saved.
+        '''
+        frozen = self.interpereter.state_freeze()
+        return snapshot.dump({
+            'names': dict(self.builder.extrascope),
+            'values': frozen.values,
+            'security': frozen.security,
+            'line_count': self.line_count
+        }, self.snapshot_base)
+
+    def restore(self, data):
+        ''' Restores a state that was saved with snapshot.
+            Raises snapshot.SnapshotError if this can't be done, in which
+            case the terminal is left unchanged.
+        '''
+        state = snapshot.load(data, self.snapshot_base)
+        names = state['names']
+        for name, index in self.builder.extrascope.items():
+            if names.get(name) != index:
+                raise snapshot.SnapshotError('Snapshot does not match the global names of the runtime')
+        self.builder.extrascope = dict(names)
+        self.interpereter.state_thaw(interpereter.FrozenState(state['values'], state['security']))
+        self.line_count = state['line_count']
+
 
     def execute(self, code):
         loop = asyncio.get_event_loop()
@@ -93,13 +175,18 @@ class Terminal:
         return loop.run_until_complete(future)
 
     async def execute_async(self, code, **kwargs):
-        return await self.execute_internal(code)
+        return await self.execute_internal(code, **kwargs)
 
-    async def execute_internal(self, line, **kwargs):
+    async def execute_internal(self, line, budget=None, **kwargs):
         ''' Runs some code.
-            Returns a string-bool tuple.
+            Returns a string-bool-dict tuple.
             The string is the output to display to the user.
             The bool is True if nothing went wrong.
+            The resources used are in details['usage'].
+
+            budget limits the resources that the code may use, on
+            top of the terminal's command_quota. This is used by
+            channel and guild quotas.
         '''
         output = []
         details = {}
@@ -108,7 +195,7 @@ class Terminal:
             for i, v in enumerate(args):
                 try:
                     args[i] = formatter.format(v, limit = self.output_limit)
-                except Exception:
+                except Exception as e:
                     print(e)
             output.append(' '.join(map(str, args)))
         self.line_count += 1
@@ -126,8 +213,14 @@ class Terminal:
             for byte, elnk in zip(c.bytecode, c.error_link):
                 print(byte, elnk)
         elif self.allow_special_commands and line == ':cache':
-            for key, value in self.interpereter.calling_cache.values.items():
+            cache = self.interpereter.calling_cache
+            for key, value in cache.items():
                 prt('{:40} : {:20}'.format(str(key), str(value)))
+            for stats in sorted(cache.all_statistics(), key=lambda i: i.name):
+                prt('{:20} : {}'.format(stats.name, stats))
+            prt('{} entries, about {} KB'.format(len(cache), cache.size // 1024))
+            if self.result_cache is not None:
+                prt('Result cache: {} entries, {}'.format(len(self.result_cache), self.result_cache.statistics))
         elif self.allow_special_commands and line == ':memory':
             mem = self.interpereter.get_memory_usage()
             print(mem // 1024, 'KB')
@@ -137,66 +230,106 @@ class Terminal:
             # Can recursively load files, which might be bad.
             fn = line.split()[1]
             code = open(fn).read()
-            await self.execute_internal(code, **kwargs)
+            await self.execute_internal(code, budget=budget, **kwargs)
         elif self.allow_special_commands and line.startswith(':time '):
             # Timing functions so we can see which one is faster.
             code = line[6:]
             start = time()
-            await self.execute_internal(code, **kwargs)
+            _, _, timed = await self.execute_internal(code, budget=budget, **kwargs)
             end = time()
             prt(f"It took {end - start} seconds.")
+            if 'usage' in timed:
+                usage = timed['usage']
+                prt(f"It used {usage.cpu_time} seconds of CPU time and {usage.ticks} ticks.")
+        elif self.allow_special_commands and line.startswith(':profile '):
+            # Show which instructions and functions the code spends its time on
+            code = line[9:]
+            self.interpereter.profiler = profiler.Profiler()
+            try:
+                await self.execute_internal(code, budget=budget, **kwargs)
+            finally:
+                self.last_profile = self.interpereter.profiler
+                self.interpereter.profiler = None
+            for i in self.last_profile.report():
+                prt(i)
+        elif self.allow_special_commands and line.startswith(':profile-export '):
+            # Save the last profile in a format that flame graph tools can read
+            fn = line.split()[1]
+            if self.last_profile is None:
+                prt('Nothing has been profiled')
+            else:
+                with open(fn, 'w') as f:
+                    f.write(self.last_profile.collapsed())
+                prt('Saved profile to', fn)
         elif self.allow_special_commands and line == ":timeout":
             self.timeout = not self.timeout
         else:
             try:
                 worked = False
                 tokens, ast = parser.parse(line, source_name = 'iterm_' + str(self.line_count))
+                cache_key = self.result_key(tokens, ast)
+                if cache_key is not None:
+                    cached = self.result_cache.get(cache_key)
+                    if cached is not None:
+                        return cached, True, {'cached': True}
                 if self.show_tree:
-                    prt(json.dumps(ast, indent = 4))
-                ast = {'#': 'program', 'items': [ast, {'#': 'end'}]}
+                    prt(json.dumps(nodes.to_json(ast), indent = 4))
+                ast = nodes.Program(items=[ast, nodes.End()])
                 self.interpereter.stack = [None]
                 code_segment = self.builder.build(ast)
                 # for index, byte in enumerate(bytes):
                 #   print('{:3d} - {}'.format(index, byte))
                 
+                allowance = quota.UNLIMITED
                 if self.timeout:
-                    async with async_timeout.timeout(5):
-                        result_items = await self.interpereter.run_async(segment=code_segment, get_entire_stack=True)
-                else:
-                    result_items = await self.interpereter.run_async(segment=code_segment, get_entire_stack=True)
+                    allowance = allowance.limit(self.command_quota)
+                if budget is not None:
+                    allowance = allowance.limit(budget)
+                try:
+                    result_items = await self.interpereter.run_async(
+                        segment=code_segment,
+                        get_entire_stack=True,
+                        budget=allowance
+                    )
+                finally:
+                    details['usage'] = self.interpereter.usage
 
                 details['result'] = result_items
                 worked = True
                 for result in result_items:
                     if isinstance(result, tuple(sympy.core.all_classes)):
-                        f_res = await crucible.run(
-                            formatter.format,
-                            (result,),
-                            timeout = 2 if self.timeout else 10 ** 10
+                        # Both parts are worked out by the same job, so the
+                        # value is only sent to the crucible once
+                        time_limit = RENDER_TIME_LIMIT if self.timeout else None
+                        f_res, f_ext, timed_out = await crucible.run(
+                            formatter.render,
+                            (result, self.output_limit, time_limit),
+                            timeout = 2 * RENDER_TIME_LIMIT + 1 if self.timeout else 10 ** 10
                         )
+                        if formatter.EXACT in timed_out:
+                            raise asyncio.TimeoutError
+                        if f_ext is not None:
+                            prt(f_res, '=', f_ext)
+                        elif formatter.APPROXIMATION in timed_out:
+                            prt(f_res, '[approximation timed out]')
+                            # This might not happen next time
+                            cache_key = None
+                        else:
+                            prt(f_res)
                     else:
-                        f_res = formatter.format(result, limit=self.output_limit)
-                    try:
-                        exact = await crucible.run(result.evalf, (), timeout= 2 if self.timeout else 10 ** 10)
-                        details['exact'] = exact
-                        f_ext = formatter.format(exact, limit=self.output_limit)
-                        f_ext = re.sub(r'\d+\.\d+', lambda x: x.group(0).rstrip('0').rstrip('.'), f_ext)
-                        f_ext = formatter.sympy_cleanup(f_ext)
-                        if f_ext in ['inf', '-inf', f_res.replace('\N{SINGLE LOW-9 QUOTATION MARK}', '')]:
-                            raise Exception
-                        prt(f_res, '=', f_ext)
-                    except asyncio.TimeoutError:
-                        prt(f_res, '[exact value timed out]')
-                    except Exception as e:
-                        prt(f_res)
+                        prt(formatter.format(result, limit=self.output_limit))
                     if self.show_result_type:
                         prt(result.__class__)
                         prt(result.__class__.__mro__)
+                if cache_key is not None:
+                    self.result_cache.put(cache_key, '\n'.join(output))
             except errors.CompilationError as e:
                 prt('Compilation error')
                 prt(e.description)
                 if e.position is not None:
                     prt(format_error_place(line, e.position))
+            except quota.QuotaExceededError:
+                prt('Operation timed out')
             except errors.EvaluationError as e:
                 dbg = e._linking
                 if dbg is None:
@@ -217,6 +350,8 @@ class Terminal:
                 prt('Output was too large to display')
             except asyncio.TimeoutError:
                 prt('Operation timed out')
+            except crucible.ResourceExhausted as e:
+                prt('Operation used too much', e.resource)
             except Exception:
                 if not self.trap_unknown_errors:
                     raise
@@ -3,6 +3,9 @@ from . import parser as parser
 from . import errors as errors
 from . import functions
 from . import formatter
+from . import folding
+from . import operators
+from . import nodes
 import itertools
 import json
 import sympy
@@ -82,7 +85,78 @@ class I(enum.IntEnum):
 	CONSTANT_STRING = 67
 	CONSTANT_GLYPH = 68
 
-	# Next to use: 70
+	# Superinstructions, these are only produced by the peephole optimiser
+	CALL_THUNK = 70
+	RETURN_CACHED = 71
+	LOCAL_OPERATOR = 72
+	CONSTANT_OPERATOR = 73
+
+	# Next to use: 74
+
+
+# Number of values stored in the bytecode directly after each instruction.
+# Instructions that are not listed here have no operands.
+OPERAND_COUNT = {
+	I.CONSTANT: 1,
+	I.CONSTANT_STRING: 1,
+	I.CONSTANT_GLYPH: 1,
+	I.JUMP_IF_MACRO: 1,
+	I.ARG_LIST_END: 1,
+	I.ARG_LIST_END_NO_CACHE: 1,
+	I.ARG_LIST_END_WITH_TCO: 1,
+	I.WORD: 1,
+	I.ASSIGNMENT: 1,
+	I.DECLARE_SYMBOL: 2,
+	I.ACCESS_GLOBAL: 2,
+	I.ACCESS_LOCAL: 1,
+	I.ACCESS_SEMI: 2,
+	I.UNLOAD: 1,
+	I.FUNCTION_NORMAL: 1,
+	I.JUMP: 1,
+	I.JUMP_IF_TRUE: 1,
+	I.JUMP_IF_FALSE: 1,
+	I.PUSH_ERROR_STOPGAP: 2,
+	I.CALL_THUNK: 1,
+	I.LOCAL_OPERATOR: 2,
+	I.CONSTANT_OPERATOR: 2,
+}
+
+
+# Instructions whose first operand points to another place in the bytecode.
+POINTER_OPERAND = frozenset([
+	I.JUMP,
+	I.JUMP_IF_TRUE,
+	I.JUMP_IF_FALSE,
+	I.JUMP_IF_MACRO,
+	I.PUSH_ERROR_STOPGAP,
+])
+
+
+# Instructions that the peephole optimiser may fuse onto a preceding
+# ACCESS_LOCAL or CONSTANT. These must not have any operands.
+FUSABLE_OPERATORS = frozenset([
+	I.BIN_ADD,
+	I.BIN_SUB,
+	I.BIN_MUL,
+	I.BIN_DIV,
+	I.BIN_MOD,
+	I.BIN_POW,
+	I.BIN_LESS,
+	I.BIN_MORE,
+	I.BIN_L_EQ,
+	I.BIN_M_EQ,
+	I.BIN_EQUL,
+	I.BIN_N_EQ,
+	I.UNR_NOT,
+	I.UNR_MIN,
+	I.UNR_FAC,
+	I.LIST_EXTRACT_FIRST,
+	I.LIST_EXTRACT_REST,
+	I.LIST_PREPEND,
+	I.STORE_IN_CACHE,
+	I.RETURN,
+	I.RETURN_CACHED,
+])
 
 
 OPERATOR_DICT = {
@@ -109,6 +183,17 @@ OPERATOR_DICT = {
 }
 
 
+# Short circuiting operators, and the jump that skips the right hand side
+LOGIC_OPERATORS = {
+	'&&': (I.JUMP_IF_FALSE, I.BIN_AND),
+	'||': (I.JUMP_IF_TRUE, I.BIN_OR_)
+}
+
+
+def is_operator_chain(node):
+	return node.tag == 'bin_op' and node.operator not in LOGIC_OPERATORS
+
+
 COMPARATOR_DICT = {
 	'<': I.CMP_LESS,
 	'>': I.CMP_MORE,
@@ -198,6 +283,10 @@ class ConstructedBytecode:
 	def __init__(self, segment):
 		self.bytecode = segment.bytecode
 		self.error_link = segment.error_link
+		# Used by the interpereter to decide when to compile
+		# the segment into closure-threaded code.
+		self.call_count = 0
+		self.threaded = None
 
 	def __getitem__(self, index):
 		return self.bytecode[index]
@@ -205,6 +294,16 @@ class ConstructedBytecode:
 	def __len__(self):
 		return len(self.bytecode)
 
+	def __getstate__(self):
+		# The compiled code can't be stored, but can be recreated
+		return {'bytecode': self.bytecode, 'error_link': self.error_link}
+
+	def __setstate__(self, state):
+		self.bytecode = state['bytecode']
+		self.error_link = state['error_link']
+		self.call_count = 0
+		self.threaded = None
+
 	def __repr__(self):
 		return f'Bytecode @{id(self.bytecode)}'
 
@@ -231,7 +330,7 @@ class ConstructedBytecode:
 				result.append(['str', i])
 			elif isinstance(i, (int, sympy.Integer)):
 				result.append(['int', int(i)])
-			elif isinstance(i, (float, sympy.Number)):
+			elif isinstance(i, (float, sympy.Number, operators.NativeRational)):
 				result.append(['flt', i])
 			elif isinstance(i, complex):
 				result.append(['cpx', i.real, i.imag])
@@ -251,17 +350,32 @@ class Builder:
 		share a given scope.
 	'''
 
-	def __init__(self):
+	def __init__(self, optimise=True):
 		self.globalscope = Scope([])
 		self.extrascope = {}
+		# Setting this to False disables constant folding and the peephole
+		# optimiser, which can make the bytecode easier to follow when debugging.
+		self.optimise = optimise
+		# Global names that are guaranteed to hold these values, because they
+		# are protected from reassignment. Used by the constant folder.
+		self.known_values = {}
 
 	def build(self, *asts, unsafe=False):
 		segment = CodeSegment(self)
 		for i in asts:
-			segment.add_ast(i, unsafe=unsafe)
+			try:
+				if self.optimise:
+					i = folding.fold_constants(i, self.known_values)
+				segment.add_ast(i, unsafe=unsafe)
+			except RecursionError:
+				# Things like f(1)(1)(1)... that are nested too deeply to
+				# convert, but were short enough to get through the parser
+				raise errors.CompilationError('Expression is nested too deeply')
 		segment.resolve_jump_addresses()
 		segment.push(I.END)
-		return ConstructedBytecode(segment)
+		if self.optimise:
+			PeepholeOptimiser(segment, 0).run()
+		return segment.constructed()
 
 	def resolve_name(self, name):
 		if name not in self.extrascope:
@@ -275,7 +389,15 @@ class CodeSegment:
 		self.bytecode = []
 		self.error_link = []
 		self.master = master
+		self._constructed = None
 
+	def constructed(self):
+		''' Get the ConstructedBytecode for this segment.
+			All pointers into the segment share the same object.
+		'''
+		if self._constructed is None:
+			self._constructed = ConstructedBytecode(self)
+		return self._constructed
 
 	def add_ast(self, ast, unsafe=False):
 		self.bytecodeify(
@@ -297,7 +419,7 @@ class CodeSegment:
 				self.bytecode[i] = self.master.resolve_name(v.name)
 			if isinstance(v, Pointer):
 				self.bytecode[i] = (
-					ConstructedBytecode(v.destination.segment),
+					v.destination.segment.constructed(),
 					v.destination.index
 				)
 			if isinstance(v, Destination):
@@ -310,91 +432,98 @@ class CodeSegment:
 	def bytecodeify(self, node, keys):
 		keys.readyup()
 		# Branch by the current node type
-		node_type = node['#']
-		handler = getattr(self, 'btcfy_' + node_type, None)
+		handler = self.HANDLERS.get(node.tag)
 		if handler is None:
-			raise errors.CompilationError('Unknown AST node: {}. Cannot convert to bytecode.'.format(node_type))
-		return handler(node, keys)
+			raise errors.CompilationError('Unknown AST node: {}. Cannot convert to bytecode.'.format(node.tag))
+		return handler(self, node, keys)
 
 	def btcfy_number(self, node, _):
 		''' Bytecodifies a number node '''
-		self.push(I.CONSTANT, convert_number(node['string']))
+		self.push(I.CONSTANT, convert_number(node.string))
 
 	def btcfy_glyph(self, node, _):
 		''' Bytecodifies a glyph node '''
-		string = node['string'][1:]
+		string = node.string[1:]
 		# string = bytes(string, 'utf-8').decode('unicode_escape')
 		# print(string, formatter.string_backslash_escaping(string))
 		self.push(I.CONSTANT_GLYPH, formatter.string_backslash_escaping(string))
 
 	def btcfy_string(self, node, _):
 		''' Bytecodifies a string node '''
-		string = node['string'][1:-1]
+		string = node.string[1:-1]
 		# string = bytes(string, 'utf-8').decode('unicode_escape')
 		# print(string)
 		self.push(I.CONSTANT_STRING, formatter.string_backslash_escaping(string))
 
+	# Chains of operators such as 1+2+3+... or 1:2:3:[] are as deep as they
+	# are long, so they are converted without recursing down the chain.
+
 	def btcfy_bin_op(self, node, keys):
-		op = node['operator']
-		left = node['left']
-		right = node['right']
-		er = node['token']['source']
-		if op == '&&': # Logical and
-			end = Destination()
-			self.bytecodeify(left, keys())
-			self.push(
-				I.DUPLICATE,
-				I.JUMP_IF_FALSE,
-				Pointer(end),
-				error = er
-			)
-			self.bytecodeify(right, keys())
-			self.push(
-				I.BIN_AND,
-				end,
-				error = er
-			)
-		elif op == '||': # Logical or
+		if node.operator in LOGIC_OPERATORS:
+			self.btcfy_logic_op(node, keys)
+			return
+		# The right hand side is evaluated first, so going down the left
+		# of the chain the right sides are done on the way down, and going
+		# down the right the left sides are done on the way back up
+		links = []
+		while is_operator_chain(node):
+			if is_operator_chain(node.left):
+				self.bytecodeify(node.right, keys())
+				links.append((node, None))
+				node = node.left
+			else:
+				links.append((node, node.left))
+				node = node.right
+		self.bytecodeify(node, keys())
+		for link, left in reversed(links):
+			if left is not None:
+				self.bytecodeify(left, keys())
+			self.push(OPERATOR_DICT[link.operator], error = link.token.source)
+
+	def btcfy_logic_op(self, node, keys):
+		links = []
+		while node.tag == 'bin_op' and node.operator in LOGIC_OPERATORS:
+			links.append(node)
+			node = node.left
+		self.bytecodeify(node, keys())
+		for link in reversed(links):
+			er = link.token.source
+			jump, combine = LOGIC_OPERATORS[link.operator]
 			end = Destination()
-			self.bytecodeify(left, keys())
 			self.push(
 				I.DUPLICATE,
-				I.JUMP_IF_TRUE,
+				jump,
 				Pointer(end),
 				error = er
 			)
-			self.bytecodeify(right, keys())
+			self.bytecodeify(link.right, keys())
 			self.push(
-				I.BIN_OR_,
+				combine,
 				end,
 				error = er
 			)
-		else:
-			self.bytecodeify(right, keys())
-			self.bytecodeify(left, keys())
-			self.push(OPERATOR_DICT[op], error = node['token']['source'])
 
 	def btcfy_not(self, node, keys):
-		self.bytecodeify(node['expression'], keys())
-		self.push(I.UNR_NOT, error = node['token']['source'])
+		self.bytecodeify(node.expression, keys())
+		self.push(I.UNR_NOT, error = node.token.source)
 
 	def btcfy_uminus(self, node, keys):
-		self.bytecodeify(node['value'], keys())
-		self.push(I.UNR_MIN, error = node['token']['source'])
+		self.bytecodeify(node.value, keys())
+		self.push(I.UNR_MIN, error = node.token.source)
 
 	def btcfy_percent_op(self, node, keys):
-		self.bytecodeify({'#': 'number', 'string': '100'}, keys())
-		self.bytecodeify(node['value'], keys())
-		self.push(I.BIN_DIV, error = node['token']['source'])
+		self.bytecodeify(nodes.Token('number', '100'), keys())
+		self.bytecodeify(node.value, keys())
+		self.push(I.BIN_DIV, error = node.token.source)
 
 	def btcfy_word(self, node, keys):
-		scope, depth, index = keys.scope.find_value(node['string'].lower())
+		scope, depth, index = keys.scope.find_value(node.string.lower())
 		if scope == self.master.globalscope:
 			# NOTE: Only global variables can fail to be found,
 			# so we only need the name for this one.
 			self.push(I.ACCESS_GLOBAL)
 			self.push(index)
-			self.push(node['string'], error = node['source'])
+			self.push(node.string, error = node.source)
 		elif depth == 0:
 			self.push(I.ACCESS_LOCAL)
 			self.push(index)
@@ -404,36 +533,36 @@ class CodeSegment:
 			self.push(index)
 
 	def btcfy__exact_item_hack(self, node, keys):
-		self.push(I.CONSTANT, node['value'])
+		self.push(I.CONSTANT, node.value)
 
 	def btcfy_factorial(self, node, keys):
-		self.bytecodeify(node['value'], keys())
-		self.push(I.UNR_FAC, error = node['token']['source'])
+		self.bytecodeify(node.value, keys())
+		self.push(I.UNR_FAC, error = node.token.source)
 
 	def btcfy_assignment(self, node, keys):
-		name = node['variable']['string'].lower()
+		name = node.variable.string.lower()
 		# NOTE: If not sure what these two lines are for
-		if (node['value']['#'] == 'function_definition'):
-			node['value']['name'] = name
-		self.bytecodeify(node['value'], keys())
+		if (node.value.tag == 'function_definition'):
+			node.value.name = name
+		self.bytecodeify(node.value, keys())
 		if name in PROTECTED_NAMES and not keys.unsafe:
 			m = 'Cannot assign to variable "{}"'.format(name)
-			raise errors.CompilationError(m, node['variable'])
+			raise errors.CompilationError(m, node.variable)
 		scope, depth, index = keys.scope.find_value(name)
 		assert scope == self.master.globalscope
 		# print(scope, depth, index)
-		self.push(I.ASSIGNMENT, index, error=node['variable'].get('source'))
+		self.push(I.ASSIGNMENT, index, error=node.variable.source)
 
 	def btcfy_unload_global(self, node, keys):
-		name = node['variable']['string'].lower()
+		name = node.variable.string.lower()
 		scope, depth, index = keys.scope.find_value(name)
-		self.push(I.UNLOAD, index, error=node['variable'].get('source'))
+		self.push(I.UNLOAD, index, error=node.variable.source)
 
 	def btcfy_declare_symbol(self, node, keys):
-		name = node['name']['string'].lower()
+		name = node.name.string.lower()
 		if name in PROTECTED_NAMES and not keys.unsafe:
 			m = 'Cannot assign to variable "{}"'.format(name)
-			raise errors.CompilationError(m, node['name'])
+			raise errors.CompilationError(m, node.name)
 		scope, depth, index = keys.scope.find_value(name)
 		assert scope == self.master.globalscope
 		self.push(I.DECLARE_SYMBOL)
@@ -441,7 +570,7 @@ class CodeSegment:
 		self.push(name)
 
 	def btcfy_program(self, node, keys):
-		for i in node['items']:
+		for i in node.items:
 			self.bytecodeify(i, keys())
 
 	def btcfy_end(self, node, keys):
@@ -451,24 +580,24 @@ class CodeSegment:
 		# Create the function itself
 		start_pointer = self.define_function(node, keys)
 		# Create the bytecode for the current scope
-		# self.push(I.FUNCTION_MACRO if node['kind'] == '~>' else I.FUNCTION_NORMAL)
+		# self.push(I.FUNCTION_MACRO if node.kind == '~>' else I.FUNCTION_NORMAL)
 		self.push(I.FUNCTION_NORMAL)
 		self.push(start_pointer)
 
 	def btcfy_comparison(self, node, keys):
-		if len(node['rest']) == 1:
+		if len(node.rest) == 1:
 			# Can get away with a simple binary operator like the others
-			self.bytecodeify(node['rest'][0]['value'], keys())
-			self.bytecodeify(node['first'], keys())
-			op = node['rest'][0]['operator']
-			er = node['rest'][0]['token']['source']
+			self.bytecodeify(node.rest[0]['value'], keys())
+			self.bytecodeify(node.first, keys())
+			op = node.rest[0]['operator']
+			er = node.rest[0]['token'].source
 			self.push(OPERATOR_DICT[op], error = er)
 		else:
 			bailed = Destination()
 			end = Destination()
 			self.push(I.CONSTANT, 1)
-			self.bytecodeify(node['first'], keys())
-			for index, ast in enumerate(node['rest']):
+			self.bytecodeify(node.first, keys())
+			for index, ast in enumerate(node.rest):
 				if index > 0:
 					self.push(
 						I.STACK_SWAP, # Get the flag on top
@@ -478,7 +607,7 @@ class CodeSegment:
 						I.STACK_SWAP # Put the value back on top
 					)
 				self.bytecodeify(ast['value'], keys())
-				self.push(COMPARATOR_DICT[ast['operator']], error = ast['token']['source'])
+				self.push(COMPARATOR_DICT[ast['operator']], error = ast['token'].source)
 			self.push(
 				I.JUMP,
 				Pointer(end),
@@ -492,41 +621,38 @@ class CodeSegment:
 		self.push(I.LIST_CREATE_EMPTY)
 
 	def btcfy_head(self, node, keys):
-		self.bytecodeify(node['expression'], keys())
-		self.push(I.LIST_EXTRACT_FIRST, error = node['token']['source'])
+		self.bytecodeify(node.expression, keys())
+		self.push(I.LIST_EXTRACT_FIRST, error = node.token.source)
 
 	def btcfy_tail(self, node, keys):
-		self.bytecodeify(node['expression'], keys())
-		self.push(I.LIST_EXTRACT_REST, error = node['token']['source'])
+		self.bytecodeify(node.expression, keys())
+		self.push(I.LIST_EXTRACT_REST, error = node.token.source)
 
 	def btcfy_list_literal(self, node, keys):
 		self.push(I.LIST_CREATE_EMPTY)
-		for item in node['items'][::-1]:
+		for item in node.items[::-1]:
 			self.bytecodeify(item, keys())
 			self.push(I.LIST_PREPEND)
 
 	def btcfy_function_call(self, node, keys):
-		args = node.get('arguments', {'items': []})['items']
-		function_name = node['function']['string'].lower() if node['function']['#'] == 'word' else None
-		handler = self.btcfy_function_call_normal
-		if function_name:
-			handler = getattr(self, 'btcfy_func_' + function_name, handler)
-		handler(node, keys, args)
+		args = node.arguments.items
+		function_name = node.function.string.lower() if node.function.tag == 'word' else None
+		handler = self.FUNCTION_HANDLERS.get(function_name, CodeSegment.btcfy_function_call_normal)
+		handler(self, node, keys, args)
 
 	def btcfy_function_call_normal(self, node, keys, args):
-		call_marker_errinfo = node['arguments']['edges']['start']['source']
+		call_marker_errinfo = node.arguments.edges['start'].source
 		# IDEA: If the function contains only a small amount of code, we can also
 		# inline it (for normal function calls). Cannot inline everything since
 		# this leads to exponential code growth.
 		argument_functions = [
-			self.define_function({
-				'#': 'function_definition',
-				'parameters': {'items': []},
-				'kind': '->',
-				'expression': i
-			}, keys) for i in args[::-1]
+			self.define_function(nodes.FunctionDefinition(
+				parameters=nodes.Parameters(items=[]),
+				kind='->',
+				expression=i
+			), keys) for i in args[::-1]
 		]
-		self.bytecodeify(node['function'], keys())
+		self.bytecodeify(node.function, keys())
 		landing_macro = Destination()
 		landing_end = Destination()
 		# Need to jump because normal functions and macros are handled differently
@@ -614,34 +740,229 @@ class CodeSegment:
 
 	def define_function(self, node, keys):
 		# Ensure that none of the parameter names are illigal
-		params = [i['string'].lower() for i in node['parameters']['items']]
-		for n, i in zip(params, node['parameters']['items']):
+		params = [i.string.lower() for i in node.parameters.items]
+		for n, i in zip(params, node.parameters.items):
 			if n in PROTECTED_NAMES:
 				m = f'"{n}" is not allowed as a funcation parameter'
 				raise errors.CompilationError(m, i)
-		is_macro = int(node.get('kind') == '~>')
+		is_macro = int(node.kind == '~>')
 		contents = CodeSegment(self.master)
 		start_address = Destination()
 		# Function header information
 		contents.push(
 			start_address,                 # Landing place
-			node.get('name', '?').lower(), # name
+			(node.name or '?').lower(),    # name
 			len(params),                   # number of required parameters
-			node.get('variadic', 0),       # whether the function accepts additional parameters
+			node.variadic or 0,            # whether the function accepts additional parameters
 			is_macro                       # whether the function is a macro or not
 		)
 		# If the function has no parameters, there's no need to add an additional
 		# scope frame, since it would hold no information anyway.
 		subscope = Scope(params, superscope=keys.scope) if params else keys.scope
-		contents.bytecodeify(node['expression'], keys(allow_tco=True, scope=subscope))
+		contents.bytecodeify(node.expression, keys(allow_tco=True, scope=subscope))
 		contents.push(
 			I.STORE_IN_CACHE,
 			I.RETURN
 		)
 		contents.resolve_jump_addresses()
+		if self.master.optimise:
+			# Skip over the header, it isn't code
+			PeepholeOptimiser(contents, 5).run()
 		return Pointer(start_address)
 
 
+CodeSegment.HANDLERS = nodes.visitor_table(CodeSegment, 'btcfy_')
+CodeSegment.FUNCTION_HANDLERS = nodes.visitor_table(CodeSegment, 'btcfy_func_')
+
+
+class PeepholeNode:
+
+	''' A single instruction, as seen by the peephole optimiser. '''
+
+	__slots__ = ['inst', 'operands', 'links', 'referrers']
+
+	def __init__(self, inst, operands, links):
+		self.inst = inst
+		self.operands = operands
+		# Error links for the instruction and each of its operands
+		self.links = links
+		# Pointers (from jumps in the same segment) that land here
+		self.referrers = []
+
+	def pointers(self):
+		if self.inst in POINTER_OPERAND and isinstance(self.operands[0], Pointer):
+			yield self.operands[0]
+
+
+class PeepholeOptimiser:
+
+	''' Rewrites a segment into a faster, equivalent sequence of instructions.
+
+		This has to be run after resolve_jump_addresses. Only the code from
+		start onwards is touched, which means that pointers to the start of
+		a function remain valid. While running, jumps within the segment
+		point to PeepholeNode objects, which are turned back into real
+		addresses at the end.
+
+		Instructions carry their error links with them. When instructions
+		are fused, the last operand of the new instruction takes the link
+		of the instruction that can fail, since that is where the playhead
+		is when the error is raised.
+	'''
+
+	def __init__(self, segment, start):
+		self.segment = segment
+		self.start = start
+		self.changed = False
+		self.nodes = self.decode()
+
+	def decode(self):
+		code = self.segment.bytecode
+		links = self.segment.error_link
+		constructed = self.segment.constructed()
+		nodes = []
+		at_address = {}
+		place = self.start
+		while place < len(code):
+			width = OPERAND_COUNT.get(code[place], 0)
+			node = PeepholeNode(
+				code[place],
+				code[place + 1 : place + 1 + width],
+				links[place : place + 1 + width]
+			)
+			at_address[place] = node
+			nodes.append(node)
+			place += width + 1
+		for node in nodes:
+			if node.inst in POINTER_OPERAND:
+				target_segment, target = node.operands[0]
+				if target_segment is constructed:
+					pointer = Pointer(at_address[target])
+					node.operands[0] = pointer
+					pointer.destination.referrers.append(pointer)
+		return nodes
+
+	def encode(self):
+		constructed = self.segment.constructed()
+		addresses = {}
+		place = self.start
+		for node in self.nodes:
+			addresses[node] = place
+			place += len(node.operands) + 1
+		code = []
+		links = []
+		for node in self.nodes:
+			code.append(node.inst)
+			for i in node.operands:
+				if isinstance(i, Pointer):
+					i = (constructed, addresses[i.destination])
+				code.append(i)
+			links += node.links
+		# Modify the lists in place, since the ConstructedBytecode
+		# for this segment already refers to them.
+		self.segment.bytecode[self.start:] = code
+		self.segment.error_link[self.start:] = links
+
+	def run(self):
+		self.changed = True
+		while self.changed:
+			self.changed = False
+			self.simplify()
+		self.fuse_operands()
+		self.encode()
+
+	def replace(self, index, count, new_nodes):
+		''' Replace count nodes, starting at index, with new_nodes.
+			Anything that jumped to the first of the old nodes will
+			instead jump to whatever ends up in its place.
+		'''
+		old_nodes = self.nodes[index : index + count]
+		for node in old_nodes:
+			for pointer in node.pointers():
+				pointer.destination.referrers.remove(pointer)
+		for node in new_nodes:
+			for pointer in node.pointers():
+				pointer.destination.referrers.append(pointer)
+		self.nodes[index : index + count] = new_nodes
+		self.move_referrers(old_nodes[0], self.nodes[index])
+		self.changed = True
+
+	def move_referrers(self, old, new):
+		if old is not new:
+			for pointer in old.referrers:
+				pointer.destination = new
+			new.referrers += old.referrers
+			old.referrers = []
+
+	def simplify(self):
+		nodes = self.nodes
+		index = 0
+		# The last instruction is always END or RETURN, so it never changes
+		while index < len(nodes) - 1:
+			node = nodes[index]
+			after = nodes[index + 1]
+			inst = node.inst
+			target = node.operands[0].destination if any(node.pointers()) else None
+			if inst == I.NOTHING:
+				# Jump destinations are no longer needed
+				self.replace(index, 1, [])
+			elif target is not None and inst != I.PUSH_ERROR_STOPGAP and target.inst == I.JUMP \
+					and any(target.pointers()) and target.operands[0].destination is not target:
+				# Thread jumps to jumps
+				pointer = node.operands[0]
+				target.referrers.remove(pointer)
+				pointer.destination = target.operands[0].destination
+				pointer.destination.referrers.append(pointer)
+				self.changed = True
+			elif inst == I.JUMP and target is after:
+				self.replace(index, 1, [])
+			elif inst == I.JUMP and target is not None and target.inst in (I.RETURN, I.RETURN_CACHED):
+				self.replace(index, 1, [PeepholeNode(target.inst, [], node.links[:1])])
+			elif after.referrers:
+				# Can't merge with an instruction that something jumps to
+				index += 1
+			elif inst == I.UNR_NOT and after.inst in (I.JUMP_IF_TRUE, I.JUMP_IF_FALSE):
+				opposite = I.JUMP_IF_FALSE if after.inst == I.JUMP_IF_TRUE else I.JUMP_IF_TRUE
+				pointer = after.operands[0]
+				if isinstance(pointer, Pointer):
+					pointer = Pointer(pointer.destination)
+				self.replace(index, 2, [PeepholeNode(opposite, [pointer], [node.links[0], after.links[1]])])
+			elif inst == I.STORE_IN_CACHE and after.inst == I.RETURN:
+				self.replace(index, 2, [PeepholeNode(I.RETURN_CACHED, [], node.links[:1])])
+			elif inst == I.FUNCTION_NORMAL and after.inst == I.ARG_LIST_END_NO_CACHE \
+					and after.operands[0] == 0 and is_thunk(node.operands[0]):
+				self.replace(index, 2, [PeepholeNode(I.CALL_THUNK, node.operands, node.links)])
+			elif (inst, after.inst) in ((I.DUPLICATE, I.DISCARD), (I.STACK_SWAP, I.STACK_SWAP)):
+				self.replace(index, 2, [])
+			else:
+				index += 1
+
+	def fuse_operands(self):
+		nodes = self.nodes
+		index = 0
+		while index < len(nodes) - 1:
+			node = nodes[index]
+			after = nodes[index + 1]
+			if node.inst in (I.ACCESS_LOCAL, I.CONSTANT) \
+					and after.inst in FUSABLE_OPERATORS and not after.referrers:
+				fused = I.LOCAL_OPERATOR if node.inst == I.ACCESS_LOCAL else I.CONSTANT_OPERATOR
+				self.replace(index, 2, [PeepholeNode(
+					fused,
+					[node.operands[0], after.inst],
+					node.links + after.links
+				)])
+			index += 1
+
+
+def is_thunk(pointer):
+	''' Determines whether a pointer leads to a function that has no parameters
+		and is not a macro. Calling one of these doesn't need to create a
+		function object at all.
+	'''
+	segment, address = pointer
+	return segment[address + 2] == 0 and not segment[address + 3] and not segment[address + 4]
+
+
 def ast_to_bytecode(ast, unsafe=False, add_terminal_byte=True) -> ConstructedBytecode:
 	builder = Builder()
 	segment = builder.build(ast)
@@ -652,15 +973,18 @@ def ast_to_bytecode(ast, unsafe=False, add_terminal_byte=True) -> ConstructedByt
 
 
 def convert_number(x):
+	''' Integers and short decimals become native numbers,
+		everything else is a sympy number.
+	'''
 	x = x.lower()
 	if x.endswith('i'):
-		return sympy.I * convert_number(x[:-1])
+		return sympy.I * operators.to_sympy(convert_number(x[:-1]))
 	if '.' in x and 'e' not in x:
 		i, p = x.split('.')
 		k = len(p)
 		if k < 30: # Maybe increase this limit
-			return sympy.Rational(int(i or '0') * 10 ** k + int(p or '0'), 10 ** k)
-	return sympy.Number(x.lstrip('0') or '0')
+			return operators.to_native(sympy.Rational(int(i or '0') * 10 ** k + int(p or '0'), 10 ** k))
+	return operators.to_native(sympy.Number(x.lstrip('0') or '0'))
 
 
 def build(ast, offset = 0):
@@ -2,16 +2,32 @@
 	A small library that uses multiprocessing
 	to run small functions that might explode
 	in a bad way.
+
+	Workers can be limited in the amount of memory (address space) they
+	use, and the CPU time that each job may take. A job that runs out of
+	memory or time raises ResourceExhausted. Running out of CPU time gets
+	the worker killed by the OS, which works even if it is stuck in a
+	long operation that can't be interrupted.
 '''
 
 
 import asyncio
+import collections
+import contextlib
 import multiprocessing
 import async_timeout
 import time
 import traceback
 import random
 import logging
+import os
+import signal
+
+try:
+	import resource
+except ImportError:
+	# Not available on Windows, where workers can't be limited
+	resource = None
 
 
 log = logging.getLogger(__name__)
@@ -27,28 +43,113 @@ if multiprocessing.get_start_method(allow_none=True) is None:
 	log.info('Crucible set multiprocessing start method')
 
 
-def worker(pipe):
+# Kinds of replies that workers send back
+RESULT = 'result'
+FAILED = 'failed'
+EXHAUSTED = 'exhausted'
+
+MEMORY = 'memory'
+CPU_TIME = 'CPU time'
+
+
+def worker(pipe, memory_limit=None):
 	log.info('Crucible worker has started!')
+	# Workers killed for using too much CPU time would otherwise dump core
+	_set_limit('RLIMIT_CORE', 0)
+	_set_limit('RLIMIT_AS', memory_limit)
 	while True:
-		if pipe.poll(None):
-			func, args = pipe.recv()
-			pipe.send(func(*args))
-			del func, args
-		time.sleep(0.1)
+		# Blocks until there is a job to do
+		func, args, cpu_limit = pipe.recv()
+		_limit_cpu_time(cpu_limit)
+		try:
+			reply = (RESULT, func(*args))
+		except MemoryError:
+			reply = (EXHAUSTED, MEMORY)
+		except Exception as e:
+			reply = (FAILED, '{}: {}'.format(type(e).__name__, e)[:500])
+		del func, args
+		try:
+			pipe.send(reply)
+		except MemoryError:
+			# The result was too large to send
+			pipe.send((EXHAUSTED, MEMORY))
+		del reply
+
+
+def _set_limit(name, value):
+	if resource is not None and value is not None:
+		_, hard = resource.getrlimit(getattr(resource, name))
+		if hard != resource.RLIM_INFINITY:
+			value = min(value, hard)
+		resource.setrlimit(getattr(resource, name), (value, hard))
+
+
+def _limit_cpu_time(seconds):
+	''' Limit the CPU time that the process can use, starting now. The OS
+		kills the process (with SIGXCPU) if it goes over the limit.
+	'''
+	if resource is None:
+		return
+	if seconds is None:
+		limit = resource.RLIM_INFINITY
+	else:
+		usage = resource.getrusage(resource.RUSAGE_SELF)
+		# Limits are in whole seconds, so this is rounded up
+		limit = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+	_set_limit('RLIMIT_CPU', limit)
+
+
+class DeadlineExceeded(Exception):
+	''' Raised inside a job that takes longer than its deadline '''
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+	''' Raise DeadlineExceeded if the code inside takes longer than
+		this many seconds of real time. This lets a job give up on one
+		part of its work and still send back the rest.
+
+		Only works in the main thread, such as in a worker, and only
+		interrupts Python code. Does nothing if seconds is None.
+	'''
+	if seconds is None or not hasattr(signal, 'setitimer'):
+		yield
+		return
+	def expired(signum, frame):
+		raise DeadlineExceeded
+	previous = signal.signal(signal.SIGALRM, expired)
+	signal.setitimer(signal.ITIMER_REAL, seconds)
+	try:
+		yield
+	finally:
+		signal.setitimer(signal.ITIMER_REAL, 0)
+		signal.signal(signal.SIGALRM, previous)
 
 
 def echo(argument):
 	return argument
 
 
+try:
+	PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+	PAGE_SIZE = 4096
+
+
+# Time (in seconds) that a new worker has to respond to its first message.
+# This is long because the worker has to import everything first.
+STARTUP_TIMEOUT = 20
+
+
 class Process:
 
-	__slots__ = ['_pipe', '_process']
+	__slots__ = ['_pipe', '_process', 'jobs']
 
-	def __init__(self):
+	def __init__(self, memory_limit=None):
 		self._pipe, child_pipe = multiprocessing.Pipe()
-		self._process = multiprocessing.Process(target=worker, args=(child_pipe,), daemon=True)
+		self._process = multiprocessing.Process(target=worker, args=(child_pipe, memory_limit), daemon=True)
 		self._process.start()
+		self.jobs = 0
 
 	def send(self, value):
 		self._pipe.send(value)
@@ -59,64 +160,322 @@ class Process:
 	def poll(self):
 		return self._pipe.poll()
 
+	def fileno(self):
+		return self._pipe.fileno()
+
 	def terminate(self):
 		self._process.terminate()
 
+	def is_alive(self):
+		return self._process.is_alive()
+
+	@property
+	def exitcode(self):
+		return self._process.exitcode
+
+	def memory_usage(self):
+		''' Resident set size of the process, in bytes.
+			None if this can't be found out (it only works on Linux).
+		'''
+		try:
+			with open('/proc/{}/statm'.format(self._process.pid)) as f:
+				return int(f.read().split()[1]) * PAGE_SIZE
+		except (OSError, ValueError, IndexError):
+			return None
+
 
 class StartupFailure(Exception):
 	pass
 
 
-class Pool:
+class JobFailed(Exception):
+	''' The function given to a worker raised an exception '''
+
+
+class ResourceExhausted(Exception):
+	''' A job used more memory or CPU time than it was allowed '''
 
-	__slots__ = ['_semaphore', '_idle']
+	def __init__(self, resource):
+		super().__init__('Job used too much {}'.format(resource))
+		self.resource = resource
 
-	def __init__(self, max_processess):
-		self._semaphore = asyncio.Semaphore(max_processess)
+
+class PoolStatistics:
+
+	__slots__ = ['jobs', 'queued', 'peak_queued', 'wait_time', 'slowest_wait',
+		'started', 'restarts', 'recycled', 'startup_failures', 'timeouts', 'exhausted']
+
+	def __init__(self):
+		self.jobs = 0
+		# Jobs waiting for a worker to be free
+		self.queued = 0
+		self.peak_queued = 0
+		self.wait_time = 0
+		self.slowest_wait = 0
+		# Workers that have been started
+		self.started = 0
+		# Workers that have been replaced because something went wrong
+		self.restarts = 0
+		# Workers that have been replaced because they did too much
+		self.recycled = 0
+		self.startup_failures = 0
+		# Jobs that took too long, or used too many resources, by resource
+		self.timeouts = 0
+		self.exhausted = collections.Counter()
+
+	@property
+	def mean_wait_time(self):
+		if self.jobs == 0:
+			return 0
+		return self.wait_time / self.jobs
+
+	def __repr__(self):
+		return 'jobs={} queued={} peak_queued={} mean_wait={:.3f}s slowest_wait={:.3f}s ' \
+			'started={} restarts={} recycled={} startup_failures={} timeouts={} exhausted={}'.format(
+			self.jobs, self.queued, self.peak_queued, self.mean_wait_time, self.slowest_wait,
+			self.started, self.restarts, self.recycled, self.startup_failures,
+			self.timeouts, dict(self.exhausted))
+
+
+class Pool:
+
+	''' Runs functions in worker processes.
+
+		At most size jobs are run at once. Workers are started the first
+		time they are needed, unless start is called, in which case they are
+		all started straight away and replaced as soon as they stop. Calling
+		start also keeps some spare workers running, so that jobs never
+		have to wait for a worker to start.
+
+		A worker is replaced if a job times out or runs out of resources.
+		Workers are also retired after they have run max_jobs jobs, or once
+		they are using more than max_memory bytes, since sympy's caches
+		grow over time.
+
+		Workers can't use more than memory_limit bytes of address space.
+		Each job can use as much CPU time as its timeout, or cpu_limit
+		seconds if that is smaller.
+	'''
+
+	__slots__ = ['size', 'spares', 'max_jobs', 'max_memory', 'memory_limit', 'cpu_limit',
+		'statistics', '_semaphore', '_idle', '_busy', '_starting', '_warm', '_replenishing']
+
+	def __init__(self, size, *, spares=0, max_jobs=None, max_memory=None,
+			memory_limit=None, cpu_limit=None):
+		self.size = size
+		self.spares = spares
+		self.max_jobs = max_jobs
+		self.max_memory = max_memory
+		self.memory_limit = memory_limit
+		self.cpu_limit = cpu_limit
+		self.statistics = PoolStatistics()
+		self._semaphore = asyncio.Semaphore(size)
 		self._idle = []
+		self._busy = 0
+		self._starting = 0
+		self._warm = False
+		self._replenishing = None
+
+	@property
+	def workers(self):
+		return len(self._idle) + self._busy + self._starting
+
+	async def start(self):
+		''' Start all the workers, and keep them running from now on '''
+		self._warm = True
+		await self._replenish()
+
+	def close(self):
+		''' Stop the idle workers. Busy ones stop when they finish. '''
+		self._warm = False
+		self.size = 0
+		self.spares = 0
+		while self._idle:
+			self._idle.pop().terminate()
 
 	async def run(self, function, arguments, *, timeout=5):
-		proc = None
-		result = None
-		async with self._semaphore:
+		queued_at = time.perf_counter()
+		self.statistics.queued += 1
+		self.statistics.peak_queued = max(self.statistics.peak_queued, self.statistics.queued)
+		try:
+			await self._semaphore.acquire()
+		finally:
+			self.statistics.queued -= 1
+		try:
+			waited = time.perf_counter() - queued_at
+			self.statistics.jobs += 1
+			self.statistics.wait_time += waited
+			self.statistics.slowest_wait = max(self.statistics.slowest_wait, waited)
+			self._busy += 1
 			try:
-				if self._idle:
-					proc = self._idle.pop()
-				else:
-					proc = Process()
-					log.info(f'Starting new process: {id(proc)}')
-					# Starting a new process has an overhead, so we shoudld wait
-					# for it before starting the real timer.
-					secret = random.randint(0, 1 << 20)
-					result = await self._roundtrip(proc, echo, (secret,), 20)
-					if result == secret:
-						log.info(f'Process successfully started {id(proc)}')
-					else:
-						log.warning('Crucible failed to start subprocess')
-						raise StartupFailure
-				result = await self._roundtrip(proc, function, arguments, timeout)
-			except Exception:
-				log.error(f'Process has failed: {id(proc)}')
-				try:
-					proc.terminate()
-				except Exception:
-					print('Termination caused an exception')
-				else:
-					print('Termination succeeded')
-				raise
-			else:
-				self._idle.append(proc)
-		return result
+				return await self._run_job(function, arguments, timeout)
+			finally:
+				self._busy -= 1
+				self._schedule_replenish()
+		finally:
+			self._semaphore.release()
+
+	async def _run_job(self, function, arguments, timeout):
+		proc = self._take_idle()
+		if proc is None:
+			proc = await self._launch()
+		cpu_limit = timeout if self.cpu_limit is None else min(timeout, self.cpu_limit)
+		try:
+			kind, value = await self._roundtrip(proc, (function, arguments, cpu_limit), timeout)
+		except Exception as e:
+			log.error(f'Process has failed: {id(proc)}')
+			self.statistics.restarts += 1
+			if isinstance(e, asyncio.TimeoutError):
+				self.statistics.timeouts += 1
+			proc.terminate()
+			if isinstance(e, (EOFError, OSError)):
+				# The worker died, which happens if the OS kills it
+				exhausted = await _cause_of_death(proc)
+				if exhausted is not None:
+					self.statistics.exhausted[exhausted] += 1
+					raise ResourceExhausted(exhausted) from None
+			raise
+		proc.jobs += 1
+		if kind == EXHAUSTED:
+			# The worker noticed in time, but might be in a bad state
+			self.statistics.exhausted[value] += 1
+			self.statistics.restarts += 1
+			proc.terminate()
+			raise ResourceExhausted(value)
+		if self._worn_out(proc):
+			log.info(f'Recycling process: {id(proc)}')
+			self.statistics.recycled += 1
+			proc.terminate()
+		else:
+			self._idle.append(proc)
+		if kind == FAILED:
+			raise JobFailed(value)
+		return value
+
+	def _take_idle(self):
+		while self._idle:
+			proc = self._idle.pop()
+			if proc.is_alive():
+				return proc
+			# Killed while it wasn't doing anything, perhaps by the OS
+			log.warning(f'Idle process has died: {id(proc)}')
+			self.statistics.restarts += 1
+		return None
+
+	def _worn_out(self, proc):
+		if self.max_jobs is not None and proc.jobs >= self.max_jobs:
+			return True
+		if self.max_memory is not None:
+			memory = proc.memory_usage()
+			return memory is not None and memory > self.max_memory
+		return False
+
+	async def _launch(self):
+		proc = Process(self.memory_limit)
+		self.statistics.started += 1
+		log.info(f'Starting new process: {id(proc)}')
+		# Starting a new process has an overhead, so we shoudld wait
+		# for it before starting the real timer.
+		secret = random.randint(0, 1 << 20)
+		try:
+			result = await self._roundtrip(proc, (echo, (secret,), None), STARTUP_TIMEOUT)
+		except Exception:
+			result = None
+		if result != (RESULT, secret):
+			log.warning('Crucible failed to start subprocess')
+			self.statistics.startup_failures += 1
+			proc.terminate()
+			raise StartupFailure
+		log.info(f'Process successfully started {id(proc)}')
+		return proc
+
+	async def _start_spare(self):
+		self._starting += 1
+		try:
+			proc = await self._launch()
+		finally:
+			self._starting -= 1
+		if self._warm:
+			self._idle.append(proc)
+		else:
+			proc.terminate()
+
+	async def _replenish(self):
+		while self._warm and self.workers < self.size + self.spares:
+			needed = self.size + self.spares - self.workers
+			results = await asyncio.gather(
+				*[self._start_spare() for i in range(needed)],
+				return_exceptions=True
+			)
+			if any(isinstance(i, Exception) for i in results):
+				# Don't keep trying if something is broken
+				break
+
+	def _schedule_replenish(self):
+		if self._warm and (self._replenishing is None or self._replenishing.done()):
+			if self.workers < self.size + self.spares:
+				self._replenishing = asyncio.get_event_loop().create_task(self._replenish())
 
 	@staticmethod
-	async def _roundtrip(proc, function, arguments, timeout):
+	async def _roundtrip(proc, job, timeout):
 		async with async_timeout.timeout(timeout):
-			proc.send((function, arguments))
-			while not proc.poll():
-				await asyncio.sleep(0.01)
+			proc.send(job)
+			await _readable(proc)
 			return proc.recv()
 
+
+async def _cause_of_death(proc):
+	''' The resource that a process was killed for using too much of,
+		or None if it died for some other reason.
+	'''
+	for i in range(50):
+		if proc.exitcode is not None:
+			break
+		await asyncio.sleep(0.01)
+	if proc.exitcode == -getattr(signal, 'SIGXCPU', -1):
+		return CPU_TIME
+	# GMP aborts if it can't allocate memory, and the
+	# Linux out-of-memory killer uses SIGKILL.
+	if proc.exitcode in (-signal.SIGABRT, -getattr(signal, 'SIGKILL', -1)):
+		return MEMORY
+	return None
+
+
+async def _readable(proc):
+	''' Wait until there is something to receive from a process.
+		This is also the case if the process has died.
+	'''
+	loop = asyncio.get_event_loop()
+	ready = loop.create_future()
+	def wakeup():
+		if not ready.done():
+			ready.set_result(None)
+	try:
+		loop.add_reader(proc.fileno(), wakeup)
+	except NotImplementedError:
+		# Some event loops (such as the one used on Windows) can't watch pipes
+		while not proc.poll():
+			await asyncio.sleep(0.01)
+		return
+	try:
+		await ready
+	finally:
+		loop.remove_reader(proc.fileno())
+
+
 GLOBAL_POOL = Pool(4)
+
+
+def configure(size, **kwargs):
+	''' Replace the pool that run uses with one that has different
+		settings. Takes the same arguments as Pool.
+	'''
+	global GLOBAL_POOL
+	GLOBAL_POOL.close()
+	GLOBAL_POOL = Pool(size, **kwargs)
+	return GLOBAL_POOL
+
+
 async def run(function, arguments, *, timeout=5):
 	return await GLOBAL_POOL.run(function, arguments, timeout=timeout)
 
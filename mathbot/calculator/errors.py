@@ -73,4 +73,10 @@ class AccessFailedError(EvaluationError):
 	''' Failed to access a variable '''
 	def __init__(self, name):
 		super().__init__('Failed to access variable {}', name)
-		self.name = name
\ No newline at end of file
+		self.name = name
+
+class ResourceExhaustedError(EvaluationError):
+	''' An operation used too much memory or CPU time, and was stopped '''
+	def __init__(self, resource):
+		super().__init__('Operation used too much {}. Perhaps the values were too large?'.format(resource))
+		self.resource = resource
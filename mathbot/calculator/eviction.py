@@ -0,0 +1,131 @@
+''' Eviction of idle terminals
+
+	Each channel that uses the calculator has a terminal, which is kept
+	so that the things defined in the channel are there for the next
+	command. An EvictionManager keeps track of when each terminal was
+	last used, and roughly how much memory it takes up. Once there are
+	too many terminals, or they take up too much memory, the ones that
+	have gone unused for the longest are evicted.
+
+	The manager doesn't hold the terminals itself. Whatever does is told
+	about each eviction through a callback, and is expected to rebuild
+	the terminal (from a snapshot or the command history) the next time
+	it's used, and to report how long that took.
+'''
+
+import collections
+import time
+
+
+class EvictionStatistics:
+
+	__slots__ = ['evictions', 'rehydrations', 'rehydration_time', 'slowest_rehydration']
+
+	def __init__(self):
+		self.evictions = 0
+		self.rehydrations = 0
+		self.rehydration_time = 0
+		self.slowest_rehydration = 0
+
+	@property
+	def mean_rehydration_time(self):
+		if self.rehydrations == 0:
+			return 0
+		return self.rehydration_time / self.rehydrations
+
+	def __repr__(self):
+		return 'evictions={} rehydrations={} mean={:.3f}s slowest={:.3f}s'.format(
+			self.evictions, self.rehydrations,
+			self.mean_rehydration_time, self.slowest_rehydration)
+
+
+class EvictionManager:
+
+	''' Decides which terminals to evict.
+
+		max_entries    - The number of terminals to keep. None for no limit.
+		memory_budget  - The estimated number of bytes that the terminals
+						 may use in total. None for no limit.
+		minimum_idle   - Terminals that have been used more recently than
+						 this many seconds ago are never evicted, even if that
+						 means going over budget.
+		on_evict       - Called with the key of each terminal that is evicted.
+		is_busy        - Called with a key, should return True if the
+						 terminal is in use and can't be evicted right now.
+	'''
+
+	def __init__(self, max_entries=None, memory_budget=None, *, minimum_idle=0,
+			on_evict=None, is_busy=None, clock=time.monotonic):
+		self.max_entries = max_entries
+		self.memory_budget = memory_budget
+		self.minimum_idle = minimum_idle
+		self.on_evict = on_evict
+		self.is_busy = is_busy
+		self.clock = clock
+		self.statistics = EvictionStatistics()
+		# Maps keys to [last used, size], least recently used first
+		self.entries = collections.OrderedDict()
+		self.size = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def touch(self, key, size=0):
+		''' Record that a terminal has just been used, along with how many
+			bytes it's now thought to take up. Other terminals may be
+			evicted to make room for it.
+		'''
+		entry = self.entries.get(key)
+		if entry is None:
+			entry = self.entries[key] = [0, 0]
+		else:
+			self.entries.move_to_end(key)
+		self.size += size - entry[1]
+		entry[0] = self.clock()
+		entry[1] = size
+		return self.enforce(keep=key)
+
+	def discard(self, key):
+		''' Stop tracking a terminal that has been removed some other way '''
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.size -= entry[1]
+
+	def over_budget(self, count=None, size=None):
+		count = len(self.entries) if count is None else count
+		size = self.size if size is None else size
+		return (self.max_entries is not None and count > self.max_entries) \
+			or (self.memory_budget is not None and size > self.memory_budget)
+
+	def enforce(self, keep=None):
+		''' Evict terminals until everything fits in the budget, other
+			than the one given by keep. Returns the keys of the terminals
+			that were evicted.
+		'''
+		evicted = []
+		count = len(self.entries)
+		size = self.size
+		cutoff = self.clock() - self.minimum_idle
+		for key, (last_used, entry_size) in self.entries.items():
+			if last_used > cutoff or not self.over_budget(count, size):
+				break
+			if key == keep or (self.is_busy is not None and self.is_busy(key)):
+				continue
+			evicted.append(key)
+			count -= 1
+			size -= entry_size
+		for key in evicted:
+			self.discard(key)
+			self.statistics.evictions += 1
+			if self.on_evict is not None:
+				self.on_evict(key)
+		return evicted
+
+	def record_rehydration(self, seconds):
+		''' Record the time it took to rebuild a terminal '''
+		self.statistics.rehydrations += 1
+		self.statistics.rehydration_time += seconds
+		self.statistics.slowest_rehydration = max(self.statistics.slowest_rehydration, seconds)
@@ -0,0 +1,242 @@
+''' Constant folding
+
+	Evaluates the parts of an AST that only depend on constants, so
+	that they don't have to be worked out every time the code is run.
+	This happens before the AST is converted into bytecode.
+
+	Anything that might fail, or produce an unreasonably large result,
+	is left alone so that it gets evaluated (and guarded) at runtime
+	in exactly the same way as it would have been without folding.
+'''
+
+import math
+import operator
+import sympy
+
+from . import bytecode
+from . import operators
+from . import nodes
+
+
+# Results (and arguments to builtin functions) with more digits
+# than this are not folded. This keeps clear of the size guards in
+# the interpereter, which send large powers off to the crucible.
+FOLD_DIGITS_LIMIT = 1000
+
+
+def exact_power(base, exponent):
+	result = operators.try_native(operators.operator_power, base, exponent)
+	if result is NotImplemented:
+		return operators.to_sympy(base) ** operators.to_sympy(exponent)
+	return result
+
+
+BINARY_OPERATORS = {
+	'+': operators.exact_add,
+	'-': operators.exact_subtract,
+	'*': operators.exact_multiply,
+	'/': operators.exact_division,
+	'~mod': operators.exact_modulo,
+	'^': exact_power,
+}
+
+
+def fold_constants(ast, known_values=None):
+	''' Returns a version of the AST with constant expressions precomputed.
+		The original AST is not modified.
+
+		known_values maps global names to the values that they are
+		guaranteed to hold while the code runs, which is only the case if
+		they are protected from being reassigned. Names that map to
+		sympy values are treated as constants, and names that map to
+		functions may be called during folding, so those functions must
+		not have side effects.
+	'''
+	return ConstantFolder(known_values or {}).fold(ast, frozenset())
+
+
+def is_constant(node):
+	return node.tag == '_exact_item_hack'
+
+
+def constant(value):
+	return nodes.Constant(value=value)
+
+
+def number_of_digits(value):
+	''' Roughly the number of digits in the largest number that makes up a value '''
+	if operators.is_native(value):
+		return operators.native_bits(value) * math.log10(2)
+	if isinstance(value, sympy.Rational):
+		bits = max(int(value.p).bit_length(), int(value.q).bit_length())
+		return bits * math.log10(2)
+	if isinstance(value, sympy.Basic):
+		return max(map(number_of_digits, value.atoms(sympy.Rational)), default=0)
+	return 0
+
+
+def unchanged(old, new):
+	return len(old) == len(new) and all(a is b for a, b in zip(old, new))
+
+
+def is_foldable_value(value):
+	return (isinstance(value, sympy.Basic) or operators.is_native(value)) \
+		and number_of_digits(value) <= FOLD_DIGITS_LIMIT
+
+
+def power_is_safe(base, exponent):
+	''' Determine whether base ^ exponent can be calculated without
+		running into the interpereter's protected_power guard.
+	'''
+	if not isinstance(base, sympy.Number) or not isinstance(exponent, sympy.Number):
+		return False
+	if isinstance(base, sympy.Float) or isinstance(exponent, sympy.Float):
+		return True
+	if base == 0:
+		return exponent > 0
+	return abs(exponent) * number_of_digits(base) <= FOLD_DIGITS_LIMIT
+
+
+class ConstantFolder:
+
+	def __init__(self, known_values):
+		self.known_values = known_values
+
+	def fold(self, node, bound):
+		''' Fold a single node. bound is the set of names that are
+			defined as function parameters at this point, and so
+			can't be one of the known values.
+		'''
+		handler = self.HANDLERS.get(node.tag)
+		if handler is None:
+			return node
+		return handler(self, node, bound)
+
+	def fold_number(self, node, bound):
+		return constant(bytecode.convert_number(node.string))
+
+	def fold_word(self, node, bound):
+		name = node.string.lower()
+		value = self.known_values.get(name)
+		if name not in bound and (isinstance(value, sympy.Basic) or operators.is_native(value)):
+			return constant(value)
+		return node
+
+	def fold_program(self, node, bound):
+		items = [self.fold(i, bound) for i in node.items]
+		return node if unchanged(node.items, items) else node.replace(items=items)
+
+	def fold_assignment(self, node, bound):
+		return node.replace(value=self.fold(node.value, bound))
+
+	def fold_function_definition(self, node, bound):
+		params = {i.string.lower() for i in node.parameters.items}
+		return node.replace(expression=self.fold(node.expression, bound | params))
+
+	def fold_output(self, node, bound):
+		return node.replace(expression=self.fold(node.expression, bound))
+
+	fold_not = fold_output
+	fold_head = fold_output
+	fold_tail = fold_output
+
+	def fold_factorial(self, node, bound):
+		# Large factorials are sent to the crucible, so these are never folded
+		return node.replace(value=self.fold(node.value, bound))
+
+	def fold_list_literal(self, node, bound):
+		items = [self.fold(i, bound) for i in node.items]
+		return node if unchanged(node.items, items) else node.replace(items=items)
+
+	def fold_comparison(self, node, bound):
+		rest = [dict(i, value=self.fold(i['value'], bound)) for i in node.rest]
+		return node.replace(first=self.fold(node.first, bound), rest=rest)
+
+	def fold_uminus(self, node, bound):
+		value = self.fold(node.value, bound)
+		if is_constant(value):
+			result = self.attempt(operator.neg, value.value)
+			if result is not None:
+				return result
+		return node.replace(value=value)
+
+	def fold_percent_op(self, node, bound):
+		value = self.fold(node.value, bound)
+		if is_constant(value):
+			result = self.attempt(operators.exact_division, value.value, 100)
+			if result is not None:
+				return result
+		return node.replace(value=value)
+
+	def fold_bin_op(self, node, bound):
+		# Chains such as 1+2+3+... are as deep as they are long, so they
+		# are folded from the bottom up without recursing down the chain
+		chain = [node]
+		while True:
+			if node.left.tag == 'bin_op':
+				node = node.left
+			elif node.right.tag == 'bin_op':
+				node = node.right
+			else:
+				break
+			chain.append(node)
+		folded = None
+		for link in reversed(chain):
+			if folded is None:
+				left = self.fold(link.left, bound)
+				right = self.fold(link.right, bound)
+			elif link.left.tag == 'bin_op':
+				left = folded
+				right = self.fold(link.right, bound)
+			else:
+				left = self.fold(link.left, bound)
+				right = folded
+			folded = self.fold_operator(link, left, right)
+		return folded
+
+	def fold_operator(self, node, left, right):
+		function = BINARY_OPERATORS.get(node.operator)
+		if function is not None and is_constant(left) and is_constant(right):
+			a = left.value
+			b = right.value
+			if function is not exact_power or power_is_safe(operators.to_sympy(a), operators.to_sympy(b)):
+				result = self.attempt(function, a, b)
+				if result is not None:
+					return result
+		return node.replace(left=left, right=right)
+
+	def fold_function_call(self, node, bound):
+		function = node.function
+		arguments = node.arguments
+		if arguments is None:
+			return node
+		items = [self.fold(i, bound) for i in arguments.items]
+		if function.tag == 'word':
+			name = function.string.lower()
+			value = self.known_values.get(name)
+			if name not in bound and callable(value) and all(map(is_constant, items)):
+				result = self.attempt(value, *[operators.to_sympy(i.value) for i in items])
+				if result is not None:
+					return result
+		else:
+			function = self.fold(function, bound)
+		if function is node.function and unchanged(arguments.items, items):
+			return node
+		return node.replace(function=function, arguments=arguments.replace(items=items))
+
+	def attempt(self, function, *arguments):
+		''' Try to calculate a value. Returns None if it couldn't be
+			done, in which case the work is left until runtime.
+		'''
+		if not all(map(is_foldable_value, arguments)):
+			return None
+		try:
+			result = function(*arguments)
+		except Exception:
+			return None
+		if not is_foldable_value(result):
+			return None
+		return constant(result)
+
+
+ConstantFolder.HANDLERS = nodes.visitor_table(ConstantFolder, 'fold_')
@@ -8,7 +8,11 @@
 import sympy
 from . import functions
 from . import errors
+from . import operators
+from . import crucible
+import math
 import re
+import functools
 
 
 ALL_SYMPY_CLASSES = tuple(sympy.core.all_classes) # pylint: disable=no-member
@@ -47,8 +51,79 @@ class Collector:
 		return output
 
 
+# Integers are shortened, showing only the digits at each end, when all of
+# their digits wouldn't fit in the output. Working out all of the digits takes
+# time that is quadratic in their number, so ones with more digits than this
+# are shortened even when there's no limit on the output.
+MAXIMUM_INTEGER_DIGITS = 4000
+EDGE_DIGITS = 10
+
+LOG10_2 = math.log10(2)
+
+
+def digits_that_fit(width):
+	''' The most digits that an integer can have and still be shown in full
+		within width characters, bearing in mind the separators between
+		each group of three digits.
+	'''
+	if not width:
+		return MAXIMUM_INTEGER_DIGITS
+	return min(MAXIMUM_INTEGER_DIGITS, width * 3 // 4)
+
+
+@functools.lru_cache(maxsize=None)
+def _power_of_ten(digits):
+	return 10 ** digits
+
+
+def is_large_integer(n, digits=MAXIMUM_INTEGER_DIGITS):
+	return abs(n) >= _power_of_ten(digits)
+
+
+def _digits_and_power(n):
+	''' The number of decimal digits in a positive integer,
+		along with the power of ten with that many digits.
+	'''
+	# The estimate from the number of bits is at most one digit out
+	digits = int((n.bit_length() - 1) * LOG10_2) + 1
+	power = 10 ** (digits - 1)
+	if n < power:
+		return digits - 1, power // 10
+	if n >= power * 10:
+		return digits + 1, power * 10
+	return digits, power
+
+
+def digit_count(n):
+	''' The number of decimal digits in an integer '''
+	if n == 0:
+		return 1
+	return _digits_and_power(abs(n))[0]
+
+
+def format_large_integer(n):
+	''' Format an integer without converting all of it to decimal,
+		such as 1234567890…1234567890 (31415 digits)
+	'''
+	sign = '-' if n < 0 else ''
+	n = abs(n)
+	digits, power = _digits_and_power(n)
+	# The quotient is small, so these divisions take linear time
+	leading = n // (power // 10 ** (EDGE_DIGITS - 1))
+	trailing = n % 10 ** EDGE_DIGITS
+	return '{}{}\N{HORIZONTAL ELLIPSIS}{:0{}d} ({} digits)'.format(
+		sign, leading, trailing, EDGE_DIGITS, digits)
+
+
 class CustomSympyPrinter(sympy.printing.str.StrPrinter):
 
+	def __init__(self, settings=None, integer_digits=MAXIMUM_INTEGER_DIGITS):
+		super().__init__(settings)
+		self.integer_digits = integer_digits
+
+	def _is_large(self, n):
+		return is_large_integer(n, self.integer_digits)
+
 	def _print_Mul(self, expr):
 		string = sympy.printing.str.StrPrinter._print_Mul(self, expr)
 		return re.sub(r'^1\.0\*', '', string)
@@ -72,6 +147,8 @@ class CustomSympyPrinter(sympy.printing.str.StrPrinter):
 		return 'π' if self._settings.get('unicode', True) else 'pi'
 
 	def _print_Integer(self, expr):
+		if self._is_large(expr.p):
+			return format_large_integer(expr.p)
 		SEP = '\N{SINGLE LOW-9 QUOTATION MARK}'
 		normal = super()._print_Integer(expr)[::-1]
 		out = []
@@ -81,6 +158,12 @@ class CustomSympyPrinter(sympy.printing.str.StrPrinter):
 			out.append(c)
 		return ''.join(out[::-1]).replace('-' + SEP, '-')
 
+	def _print_Rational(self, expr):
+		if self._is_large(expr.p) or self._is_large(expr.q):
+			parts = (format_large_integer(i) if self._is_large(i) else str(i) for i in (expr.p, expr.q))
+			return '/'.join(parts)
+		return super()._print_Rational(expr)
+
 
 class SimpleFormatter:
 
@@ -90,8 +173,9 @@ class SimpleFormatter:
 		different behaviour for specific cases.
 	'''
 
-	def __init__(self, limit=None):
+	def __init__(self, limit=None, width=None):
 		self._collector = Collector(limit=limit)
+		self._integer_digits = digits_that_fit(limit if width is None else width)
 
 	def drop(self):
 		''' Remove the most recently added item '''
@@ -113,10 +197,16 @@ class SimpleFormatter:
 				self.fmt_array(i)
 			elif isinstance(i, functions.ListBase):
 				self.fmt_list(i)
+			elif isinstance(i, functions.HashMap):
+				self.fmt_hash_map(i)
+			elif isinstance(i, functions.HashSet):
+				self.fmt_hash_set(i)
 			elif isinstance(i, functions.Glyph):
 				self.fmt_glyph(i)
 			elif isinstance(i, ALL_SYMPY_CLASSES):
 				self.fmt_sympy_object(i)
+			elif operators.is_native(i):
+				self.fmt_sympy_object(operators.to_sympy(i))
 			else:
 				self.fmt_py_string(str(i))
 
@@ -166,6 +256,24 @@ class SimpleFormatter:
 			self.drop()
 			self.fmt(']')
 
+	def fmt_hash_map(self, hash_map):
+		''' Format a map, as hashmap(key: value  key: value) '''
+		self.fmt('hashmap(')
+		for key, value in hash_map.items():
+			self.fmt(key, ': ', value, ELEMENT_SEPARATOR)
+		if hash_map:
+			self.drop()
+		self.fmt(')')
+
+	def fmt_hash_set(self, hash_set):
+		''' Format a set '''
+		self.fmt('hashset(')
+		for i in hash_set:
+			self.fmt(i, ELEMENT_SEPARATOR)
+		if hash_set:
+			self.drop()
+		self.fmt(')')
+
 	def fmt_py_list(self, lst):
 		''' Format a python list '''
 		self.fmt('(')
@@ -177,19 +285,63 @@ class SimpleFormatter:
 
 	def fmt_sympy_object(self, obj):
 		''' Format a sympy object '''
-		self._collector.print(sympy_cleanup(CustomSympyPrinter().doprint(obj)))
+		printer = CustomSympyPrinter(integer_digits=self._integer_digits)
+		self._collector.print(sympy_cleanup(printer.doprint(obj)))
 
 	def __str__(self):
 		return str(self._collector)
 
 
-def format(*values, limit=None): # pylint: disable=redefined-builtin
-	''' Format some values, producing a human-readable string. '''
-	fmtr = SimpleFormatter(limit=limit)
+def format(*values, limit=None, width=None): # pylint: disable=redefined-builtin
+	''' Format some values, producing a human-readable string.
+		Integers are shortened when they wouldn't fit in width
+		characters, which defaults to the limit.
+	'''
+	fmtr = SimpleFormatter(limit=limit, width=width)
 	fmtr.fmt(*values)
 	return str(fmtr)
 
 
+def truncate(string, limit=None):
+	''' Shorten a string to fit within limit, in the same way as a Collector '''
+	if limit and len(string) > limit:
+		return string[:limit - 3] + '...'
+	return string
+
+
+# Parts of the result of render that can take too long
+EXACT = 'exact'
+APPROXIMATION = 'approximation'
+
+
+def render(value, limit=None, time_limit=None):
+	''' Format the result of a command, along with its decimal approximation.
+		This is run in the crucible in one go, so that only the strings
+		have to be sent back, and each of them is truncated to limit.
+
+		Each part may take up to time_limit seconds. Returns the exact
+		string, the approximation (None if there isn't a useful one) and
+		a list of the parts that took too long.
+	'''
+	try:
+		with crucible.deadline(time_limit):
+			exact = truncate(format(value, width=limit), limit)
+	except crucible.DeadlineExceeded:
+		return None, None, [EXACT, APPROXIMATION]
+	try:
+		with crucible.deadline(time_limit):
+			approximation = format(value.evalf())
+	except crucible.DeadlineExceeded:
+		return exact, None, [APPROXIMATION]
+	except Exception:
+		return exact, None, []
+	approximation = re.sub(r'\d+\.\d+', lambda x: x.group(0).rstrip('0').rstrip('.'), approximation)
+	approximation = sympy_cleanup(approximation)
+	if approximation in ['inf', '-inf', exact.replace('\N{SINGLE LOW-9 QUOTATION MARK}', '')]:
+		return exact, None, []
+	return exact, truncate(approximation, limit), []
+
+
 def sympy_cleanup(string):
 	return string.replace('**', '^').replace('*', '×')
 
@@ -70,8 +70,59 @@ class Function:
 		return f'Function {self.name} @{id(self.segment)}-{self.address}'
 
 
+# Hash of a sequence with nothing in it. The hash of a non-empty sequence
+# is built from the hash of its head and the hash of its rest, so that
+# sequences with the same contents have the same hash regardless of how
+# they are stored.
+EMPTY_SEQUENCE_HASH = hash('empty sequence')
+
+
+def element_hash(value):
+	# Native numbers hash differently to the equivalent sympy numbers
+	value = operators.to_sympy(value)
+	try:
+		return hash(value)
+	except TypeError:
+		return id(value)
+
+
+def element_equals(a, b):
+	if isinstance(a, SequenceBase) and isinstance(b, SequenceBase):
+		return a == b
+	a = operators.to_sympy(a)
+	b = operators.to_sympy(b)
+	return a.__class__ is b.__class__ and a == b
+
+
+def chain_hash(head, rest_hash):
+	return hash((element_hash(head), rest_hash))
+
+
 class SequenceBase:
 
+	''' Sequences are hashed and compared (with ==) by their contents, which
+		lets them be used in the keys of the calling cache. Hashes are cached,
+		so a sequence only has to be hashed once. This equality is stricter
+		than the one used by the calculator (__aeq__), since the items have
+		to be of the same type.
+	'''
+
+	def __eq__(self, other):
+		if self is other:
+			return True
+		if not isinstance(other, SequenceBase):
+			return NotImplemented
+		if len(self) != len(other) or hash(self) != hash(other):
+			return False
+		return all(map(element_equals, self, other))
+
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		return result if result is NotImplemented else not result
+
+	def __hash__(self):
+		raise NotImplementedError
+
 	async def __aeq__(a, b):
 		if a is b:
 			return True
@@ -113,6 +164,19 @@ class Array(SequenceBase):
 		self.items = items
 		self.start = start or 0
 		self.end = end or len(items)
+		self._hash = None
+
+	def __reduce__(self):
+		# Cached hashes are only valid for the process that made them
+		return (Array, (self.items[self.start:self.end],))
+
+	def __hash__(self):
+		if self._hash is None:
+			result = EMPTY_SEQUENCE_HASH
+			for i in range(self.end - 1, self.start - 1, -1):
+				result = chain_hash(self.items[i], result)
+			self._hash = result
+		return self._hash
 
 	@property
 	def head(self):
@@ -173,12 +237,38 @@ class ListBase(SequenceBase):
 
 class List(ListBase):
 
-	__slots__ = ['head', 'rest', 'size']
+	__slots__ = ['head', 'rest', 'size', '_hash']
 
 	def __init__(self, head, rest):
 		self.head = head
 		self.rest = rest
 		self.size = len(rest) + 1
+		self._hash = None
+
+	def __reduce__(self):
+		# Stored flat, since pickling long chains of cells recursively
+		# would run into the recursion limit.
+		heads = []
+		current = self
+		while isinstance(current, List):
+			heads.append(current.head)
+			current = current.rest
+		return (rebuild_list, (heads, current))
+
+	def __hash__(self):
+		result = self._hash
+		if result is None:
+			# Find the part of the list that already has a known hash
+			# first, since recursing could go too deep on long lists.
+			unknown = []
+			current = self
+			while isinstance(current, List) and current._hash is None:
+				unknown.append(current)
+				current = current.rest
+			result = hash(current)
+			for cell in reversed(unknown):
+				result = cell._hash = chain_hash(cell.head, result)
+		return result
 
 	def __len__(self):
 		return self.size
@@ -215,8 +305,14 @@ class FlatList(ListBase):
 		def __len__(self):
 			return self.fl.size - self.place
 
+		def __hash__(self):
+			return self.fl.suffix_hash(self.place)
+
+		def __reduce__(self):
+			return (view_flat_list, (self.fl, self.place))
+
 
-	__slots__ = ['values', 'tail', 'place', 'size']
+	__slots__ = ['values', 'tail', 'place', 'size', '_hashes']
 
 	def __init__(self, values, tail):
 		if len(values) == 0:
@@ -226,6 +322,26 @@ class FlatList(ListBase):
 		self.values = values
 		self.tail = tail
 		self.size = len(tail) + len(values)
+		self._hashes = None
+
+	def __reduce__(self):
+		return (FlatList, (self.values, self.tail))
+
+	def suffix_hash(self, place):
+		''' Hash of the list starting at a given index. The hashes
+			for every position are calculated at once, since the
+			viewers that represent them are short-lived.
+		'''
+		if self._hashes is None:
+			result = hash(self.tail)
+			hashes = [None] * len(self.values)
+			for i in range(len(self.values) - 1, -1, -1):
+				result = hashes[i] = chain_hash(self.values[i], result)
+			self._hashes = hashes
+		return self._hashes[place]
+
+	def __hash__(self):
+		return self.suffix_hash(0)
 
 	@property
 	def head(self):
@@ -254,6 +370,12 @@ class EmptyList(ListBase):
 	def __len__(self):
 		return 0
 
+	def __hash__(self):
+		return EMPTY_SEQUENCE_HASH
+
+	def __reduce__(self):
+		return (EmptyList, ())
+
 	def __bool__(self):
 		return False
 
@@ -266,7 +388,7 @@ class EmptyList(ListBase):
 		raise errors.EvaluationError('Attempted to get the tail of an empty list')
 
 	def __str__(self):
-		return '.'
+		return 'list()'
 
 
 class SingularValue:
@@ -329,9 +451,339 @@ class Expanded:
 				cur = cur.rest
 
 
+# Maps and sets are stored as hash array mapped tries. Each node of the trie
+# uses HAMT_BITS bits of the hash to decide which of its children a key
+# belongs under, and only stores the children that are actually there.
+# Changing a trie copies the nodes along the path to the key and shares
+# everything else with the original.
+HAMT_BITS = 5
+HAMT_MASK = (1 << HAMT_BITS) - 1
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def _popcount(x):
+	return bin(x).count('1')
+
+
+class _TrieNode:
+
+	''' Stores the children whose bits of the hash are set in the bitmap.
+		Each child is either another node, or an entry, which is a tuple
+		of (hash, key, value, position).
+	'''
+
+	__slots__ = ['bitmap', 'children']
+
+	def __init__(self, bitmap, children):
+		self.bitmap = bitmap
+		self.children = children
+
+
+class _CollisionNode:
+
+	''' Holds entries whose keys have exactly the same hash. '''
+
+	__slots__ = ['children']
+
+	def __init__(self, children):
+		self.children = children
+
+
+EMPTY_TRIE = _TrieNode(0, ())
+
+
+def _replace(children, index, child):
+	return children[:index] + (child,) + children[index + 1:]
+
+
+def _trie_find(node, key_hash, key):
+	shift = 0
+	while True:
+		if node.__class__ is _CollisionNode:
+			for entry in node.children:
+				if entry[0] == key_hash and element_equals(entry[1], key):
+					return entry
+			return None
+		bit = 1 << ((key_hash >> shift) & HAMT_MASK)
+		if not node.bitmap & bit:
+			return None
+		child = node.children[_popcount(node.bitmap & (bit - 1))]
+		if child.__class__ is tuple:
+			if child[0] == key_hash and element_equals(child[1], key):
+				return child
+			return None
+		node = child
+		shift += HAMT_BITS
+
+
+def _trie_pair(first, second, shift):
+	''' Make a node that holds two entries with different keys '''
+	if shift >= HASH_BITS:
+		return _CollisionNode((first, second))
+	first_bit = 1 << ((first[0] >> shift) & HAMT_MASK)
+	second_bit = 1 << ((second[0] >> shift) & HAMT_MASK)
+	if first_bit == second_bit:
+		return _TrieNode(first_bit, (_trie_pair(first, second, shift + HAMT_BITS),))
+	if first_bit > second_bit:
+		first, second = second, first
+	return _TrieNode(first_bit | second_bit, (first, second))
+
+
+def _trie_insert(node, shift, entry):
+	''' Add an entry to a trie. Returns the new trie, and the entry that
+		had the same key before (or None). A replacement keeps the
+		position of the entry that it replaces.
+	'''
+	if node.__class__ is _CollisionNode:
+		for index, child in enumerate(node.children):
+			if element_equals(child[1], entry[1]):
+				entry = entry[:3] + (child[3],)
+				return _CollisionNode(_replace(node.children, index, entry)), child
+		return _CollisionNode(node.children + (entry,)), None
+	bit = 1 << ((entry[0] >> shift) & HAMT_MASK)
+	index = _popcount(node.bitmap & (bit - 1))
+	children = node.children
+	if not node.bitmap & bit:
+		return _TrieNode(node.bitmap | bit, children[:index] + (entry,) + children[index:]), None
+	child = children[index]
+	if child.__class__ is tuple:
+		if child[0] == entry[0] and element_equals(child[1], entry[1]):
+			entry = entry[:3] + (child[3],)
+			return _TrieNode(node.bitmap, _replace(children, index, entry)), child
+		replacement, previous = _trie_pair(child, entry, shift + HAMT_BITS), None
+	else:
+		replacement, previous = _trie_insert(child, shift + HAMT_BITS, entry)
+	return _TrieNode(node.bitmap, _replace(children, index, replacement)), previous
+
+
+def _trie_remove(node, shift, key_hash, key):
+	''' Remove a key from a trie. Returns the new trie, and the entry that
+		was removed (or None, in which case the trie is unchanged). Below
+		the root, the new trie is None if it would be empty, or just the
+		entry if it would only hold one.
+	'''
+	if node.__class__ is _CollisionNode:
+		for index, child in enumerate(node.children):
+			if child[0] == key_hash and element_equals(child[1], key):
+				children = node.children[:index] + node.children[index + 1:]
+				if len(children) == 1:
+					return children[0], child
+				return _CollisionNode(children), child
+		return node, None
+	bit = 1 << ((key_hash >> shift) & HAMT_MASK)
+	if not node.bitmap & bit:
+		return node, None
+	index = _popcount(node.bitmap & (bit - 1))
+	child = node.children[index]
+	if child.__class__ is tuple:
+		if child[0] != key_hash or not element_equals(child[1], key):
+			return node, None
+		replacement, removed = None, child
+	else:
+		replacement, removed = _trie_remove(child, shift + HAMT_BITS, key_hash, key)
+		if removed is None:
+			return node, None
+	if replacement is not None:
+		if shift and len(node.children) == 1 and replacement.__class__ is tuple:
+			return replacement, removed
+		return _TrieNode(node.bitmap, _replace(node.children, index, replacement)), removed
+	children = node.children[:index] + node.children[index + 1:]
+	if shift == 0:
+		return _TrieNode(node.bitmap & ~bit, children), removed
+	if not children:
+		return None, removed
+	if len(children) == 1 and children[0].__class__ is tuple:
+		return children[0], removed
+	return _TrieNode(node.bitmap & ~bit, children), removed
+
+
+def _trie_entries(node):
+	for child in node.children:
+		if child.__class__ is tuple:
+			yield child
+		else:
+			yield from _trie_entries(child)
+
+
+def key_hash(value):
+	return element_hash(value) & HASH_MASK
+
+
+def _entry_hash(entry):
+	return hash((entry[0], element_hash(entry[2])))
+
+
+class HashTrie:
+
+	''' Base for the calculator's maps and sets, which are immutable.
+		Adding or removing a key makes a new object that shares most of
+		its structure with the old one, so it takes logarithmic time.
+
+		Keys are hashed and compared in the same way as the items of
+		sequences (see SequenceBase), so 1 and 1.0 are different keys.
+		Things are listed in the order that their keys were first added.
+	'''
+
+	__slots__ = ['root', 'size', 'counter', 'content_hash']
+
+	def __init__(self, root=EMPTY_TRIE, size=0, counter=0, content_hash=0):
+		self.root = root
+		self.size = size
+		# The position given to the next new key
+		self.counter = counter
+		# The hashes of the entries xored together, which is kept up to date
+		# as things change so that hashing doesn't take linear time. It
+		# doesn't depend on the shape of the trie or the order of the keys.
+		self.content_hash = content_hash
+
+	@classmethod
+	def from_items(cls, items):
+		result = cls()
+		for key, value in items:
+			result = result.with_item(key, value)
+		return result
+
+	def __reduce__(self):
+		# Hashes of things like strings change between processes,
+		# so the trie has to be rebuilt from scratch
+		return (rebuild_hash_trie, (self.__class__, self.items()))
+
+	def __len__(self):
+		return self.size
+
+	def __bool__(self):
+		return self.size > 0
+
+	def __contains__(self, key):
+		return _trie_find(self.root, key_hash(key), key) is not None
+
+	def lookup(self, key, default=None):
+		entry = _trie_find(self.root, key_hash(key), key)
+		return default if entry is None else entry[2]
+
+	def with_item(self, key, value):
+		''' A copy with a key set to a value '''
+		entry = (key_hash(key), key, value, self.counter)
+		root, previous = _trie_insert(self.root, 0, entry)
+		content_hash = self.content_hash ^ _entry_hash(entry)
+		if previous is None:
+			return self.__class__(root, self.size + 1, self.counter + 1, content_hash)
+		content_hash ^= _entry_hash(previous)
+		return self.__class__(root, self.size, self.counter, content_hash)
+
+	def without(self, key):
+		''' A copy without a key '''
+		root, removed = _trie_remove(self.root, 0, key_hash(key), key)
+		if removed is None:
+			return self
+		return self.__class__(root, self.size - 1, self.counter, self.content_hash ^ _entry_hash(removed))
+
+	def items(self):
+		''' The keys and values, in the order that the keys were added '''
+		entries = sorted(_trie_entries(self.root), key=lambda entry: entry[3])
+		return [(entry[1], entry[2]) for entry in entries]
+
+	def __iter__(self):
+		return (key for key, _ in self.items())
+
+	def __hash__(self):
+		return hash((self.kind, self.size, self.content_hash))
+
+	def __eq__(self, other):
+		''' Strict comparison, like the one used by sequences '''
+		if self is other:
+			return True
+		if self.__class__ is not other.__class__:
+			return NotImplemented
+		if self.size != other.size or hash(self) != hash(other):
+			return False
+		for entry in _trie_entries(self.root):
+			found = _trie_find(other.root, entry[0], entry[1])
+			if found is None or not element_equals(entry[2], found[2]):
+				return False
+		return True
+
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		return result if result is NotImplemented else not result
+
+	async def __aeq__(a, b):
+		if a is b:
+			return True
+		if a.__class__ is not b.__class__:
+			raise errors.EvaluationError('Attempted to compare {0} to non-{0}'.format(a.kind))
+		if a.size != b.size:
+			return False
+		for entry in _trie_entries(a.root):
+			found = _trie_find(b.root, entry[0], entry[1])
+			if found is None:
+				return False
+			# Let the event loop do work in case this takes a while
+			await asyncio.sleep(0)
+			if not await operators.super_equals(entry[2], found[2]):
+				return False
+		return True
+
+	def __repr__(self):
+		return str(self)
+
+
+class HashMap(HashTrie):
+
+	''' Calculator object that maps keys to values. '''
+
+	__slots__ = []
+
+	kind = 'map'
+
+	def __str__(self):
+		return 'hashmap({})'.format(', '.join('{}: {}'.format(k, v) for k, v in self.items()))
+
+
+class HashSet(HashTrie):
+
+	''' Calculator object that represents a set of values. It's stored
+		as a map where every key has the value True.
+	'''
+
+	__slots__ = []
+
+	kind = 'set'
+
+	@classmethod
+	def from_keys(cls, keys):
+		result = cls()
+		for key in keys:
+			result = result.insert(key)
+		return result
+
+	def insert(self, key):
+		return self.with_item(key, True)
+
+	def __str__(self):
+		return 'hashset({})'.format(', '.join(map(str, self)))
+
+
+def rebuild_hash_trie(cls, items):
+	return cls.from_items(items)
+
+
 def create_list(sequence):
 	sequence = list(sequence)
 	return FlatList(sequence, EMPTY_LIST) if sequence else EMPTY_LIST
 
 
 EMPTY_LIST = EmptyList()
+
+
+def view_flat_list(fl, place):
+	''' Used to unpickle FlatList.Viewer, which can't be referred to by a dotted name '''
+	return FlatList.Viewer(fl, place)
+
+
+def rebuild_list(heads, tail):
+	''' Link a sequence of items onto the front of a list '''
+	for head in reversed(heads):
+		tail = List(head, tail)
+	return tail
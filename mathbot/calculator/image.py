@@ -0,0 +1,213 @@
+''' Precompiled images of the runtime library
+
+	Setting up a terminal means parsing the runtime library, compiling
+	it and then running it to define all of the builtins. An image holds
+	the result of doing that: the compiled runtime segment, the names
+	the compiler gave to the globals, and the root scope once the library
+	has been run. Loading an image into a new terminal is much faster
+	than setting it up from scratch.
+
+	Images are kept in memory once they have been made, and are also
+	saved to disk so that they can be reused by other processes. The file
+	is named after a hash of the library and the modules that affect the
+	compiled code, so changing any of those causes a new image to be
+	built. Running this module builds the images ahead of time.
+
+	Builtin functions are implemented in Python and often can't be
+	pickled, so they are stored by name.
+
+	When the runtime is protected, user code can't change any of the
+	values that it defines, so a single copy of them is shared between
+	all of the terminals that use the image. Each terminal only pays
+	for its own assignments.
+'''
+
+import asyncio
+import functools
+import hashlib
+import os
+import tempfile
+
+from . import bytecode
+from . import interpereter
+from . import runtime
+from . import snapshot
+
+
+# Increase this when the image format changes
+IMAGE_VERSION = 1
+
+SOURCES = [
+	'library.c5', 'runtime.py', 'bytecode.py', 'folding.py', 'functions.py',
+	'interpereter.py', 'nodes.py', 'operators.py', 'parser.py', 'image.py'
+]
+
+DIRECTORY = os.environ.get(
+	'MATHBOT_IMAGE_DIRECTORY',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+)
+
+
+# Images that have been loaded or built by this process, by protection level
+_IMAGES = {}
+
+
+@functools.lru_cache(None)
+def version():
+	''' Identifies the code that produced an image '''
+	digest = hashlib.sha256(str(IMAGE_VERSION).encode('utf-8'))
+	directory = os.path.dirname(os.path.abspath(__file__))
+	for name in SOURCES:
+		with open(os.path.join(directory, name), 'rb') as f:
+			digest.update(f.read())
+	return digest.hexdigest()[:16]
+
+
+def filename(protection_level):
+	return os.path.join(DIRECTORY, 'runtime-{}-{}.image'.format(protection_level, version()))
+
+
+@functools.lru_cache(None)
+def _builtins():
+	objects = {}
+	for name, func in runtime.BUILTIN_FUNCTIONS.items():
+		objects['function', name] = func
+	for name, func in runtime.BUILTIN_COROUTINES.items():
+		objects['coroutine', name] = func
+	return snapshot.References(objects)
+
+
+class Image:
+
+	''' The state of a terminal once the runtime library has been run '''
+
+	def __init__(self, protection_level, data):
+		self.protection_level = protection_level
+		self.data = data
+		self._shared = None
+		self._references = None
+
+	def shared(self):
+		''' The runtime, loaded once for every terminal to use '''
+		if self._shared is None:
+			state = snapshot.load_bytes(self.data, _builtins())
+			# Nothing should change these, and the terminals' root scopes
+			# copy them before assigning anything (see IndexedScope)
+			scope = state['scope']
+			scope.values = tuple(scope.values)
+			scope.security = tuple(scope.security)
+			self._references = snapshot.runtime_references(scope.values, state['segment'])
+			self._shared = state
+		return self._shared
+
+	def install(self, builder, interp):
+		''' Put the runtime into a builder and the interpereter that runs
+			its code. Returns the runtime segment, and the references that
+			snapshots of the terminal should use (or None if the terminal
+			needs its own).
+		'''
+		if self.protection_level > 0:
+			state = self.shared()
+			base = state['scope']
+			root = interpereter.IndexedScope(None, len(base.values), base.values)
+			root.security = base.security
+			# The compiler adds new names to these
+			builder.globalscope.name_mapping = dict(state['globals'])
+			builder.extrascope = dict(state['names'])
+			references = self._references
+		else:
+			# Unprotected values can be changed, so each terminal needs its own copy
+			state = snapshot.load_bytes(self.data, _builtins())
+			root = state['scope']
+			builder.globalscope.name_mapping = state['globals']
+			builder.extrascope = state['names']
+			references = None
+		interp.root_scope = root
+		interp.current_scope = root
+		return state['segment'], references
+
+
+async def build(protection_level):
+	''' Compile and run the runtime library to create an image '''
+	builder = bytecode.Builder()
+	if protection_level > 0:
+		builder.known_values = runtime.known_values()
+	segment = runtime.prepare_runtime(builder)
+	interp = interpereter.Interpereter()
+	await interp.run_async(
+		segment=segment,
+		assignment_auth_level=protection_level,
+		assignment_protection_level=protection_level
+	)
+	data = snapshot.dump_bytes({
+		'globals': builder.globalscope.name_mapping,
+		'names': builder.extrascope,
+		'scope': interp.root_scope,
+		'segment': segment
+	}, _builtins())
+	return Image(protection_level, data)
+
+
+def read(protection_level):
+	''' Read an image from disk, returning None if there isn't one '''
+	try:
+		with open(filename(protection_level), 'rb') as f:
+			return Image(protection_level, f.read())
+	except OSError:
+		return None
+
+
+def write(image):
+	''' Save an image to disk. This fails quietly, since the image
+		can always be rebuilt.
+	'''
+	try:
+		os.makedirs(DIRECTORY, exist_ok=True)
+		# Written to a temporary file first so that other processes never see half an image
+		descriptor, path = tempfile.mkstemp(dir=DIRECTORY, suffix='.tmp')
+		with os.fdopen(descriptor, 'wb') as f:
+			f.write(image.data)
+		os.chmod(path, 0o644)
+		os.replace(path, filename(image.protection_level))
+		return True
+	except OSError:
+		return False
+
+
+async def load(protection_level=0):
+	''' Get the image for a protection level, building it if needed '''
+	image = _IMAGES.get(protection_level)
+	if image is None:
+		image = read(protection_level)
+		if image is None:
+			image = await build(protection_level)
+			write(image)
+		_IMAGES[protection_level] = image
+	return image
+
+
+async def prepare(builder, interp, protection_level=0):
+	''' Set up the runtime library in a builder and the interpereter
+		that runs its code. Returns the same things as Image.install.
+	'''
+	image = await load(protection_level)
+	try:
+		return image.install(builder, interp)
+	except snapshot.SnapshotError:
+		# The file on disk is damaged, or was made by something else
+		image = _IMAGES[protection_level] = await build(protection_level)
+		write(image)
+		return image.install(builder, interp)
+
+
+def main():
+	for level in [0, 2]:
+		image = asyncio.get_event_loop().run_until_complete(build(level))
+		if not write(image):
+			print('Could not write', filename(level))
+		else:
+			print('Built', filename(level))
+
+
+if __name__ == '__main__':
+	main()
@@ -10,77 +10,143 @@ import sympy
 import operator
 import warnings
 import traceback
+import functools
+import weakref
 
 from . import runtime
 from . import bytecode
 from . import errors
+from . import formatter
 from .errors import EvaluationError
 from .parser import parse
 from .functions import *
 from . import functions
 from . import operators
 from . import crucible
+from . import quota
 
 
 class ScopeMissedError(Exception):
 	pass
 
 
-DataSlot = collections.namedtuple('DataSlot', 'value security')
+class IndexedScope:
+	''' A single frame of variables, accessed by index.
 
+		Values are stored in a flat sequence. Frames for function calls
+		are only ever read from, so the argument tuple or list can be
+		used as-is, and is only copied if something is assigned to it.
 
-class IndexedScope:
+		Security levels are kept in a separate list, which is only
+		created once a slot is protected. Frames without any protected
+		slots (which is almost all of them) don't pay for it.
+
+		The root scopes of terminals that use a protected runtime library
+		start out with the values (and security levels) of the library,
+		as tuples that are shared between all of them. These are also
+		only copied once something is assigned.
+	'''
+
+	__slots__ = ['superscope', 'values', 'security']
 
-	# NOTE: Not really sure why I have both size and values here. 
 	def __init__(self, superscope, size, values):
 		self.superscope = superscope
 		if size != len(values):
 			raise errors.SystemError('Attempted to create a scope with number of values unequal to the size')
-		self.slots = [DataSlot(i, 0) for i in values]
+		self.values = values
+		self.security = None
 
 	def get(scope, index, depth):
 		while depth > 0:
 			scope = scope.superscope
 			depth -= 1
-		if index >= len(scope.slots) or scope.slots[index].value is None:
+		values = scope.values
+		if index >= len(values) or values[index] is None:
 			raise ScopeMissedError
-		return scope.slots[index].value
+		return values[index]
+
+	def security_level(self, index):
+		if self.security is None or index >= len(self.security):
+			return 0
+		return self.security[index]
+
+	def _make_writable(self, index, protection):
+		if not isinstance(self.values, list):
+			self.values = list(self.values)
+		if len(self.values) <= index:
+			self.values.extend([None] * (index + 1 - len(self.values)))
+		if protection and self.security is None:
+			self.security = []
+		if self.security is not None and not isinstance(self.security, list):
+			self.security = list(self.security)
+		if self.security is not None and len(self.security) < len(self.values):
+			self.security.extend([0] * (len(self.values) - len(self.security)))
 
 	def set(scope, index, depth, value, permission = 0, protection = None):
 		while depth > 0:
 			scope = scope.superscope
 			depth -= 1
-		while len(scope.slots) <= index:
-			scope.slots.append(DataSlot(None, 0))
-		_, current_security = scope.slots[index]
+		current_security = scope.security_level(index)
 		if current_security > permission:
 			raise EvaluationError('Not permitted to perform this assignment')
-		scope.slots[index] = DataSlot(value, protection if protection is not None else current_security)
+		scope._make_writable(index, protection)
+		scope.values[index] = value
+		if protection is not None and scope.security is not None:
+			scope.security[index] = protection
 
 	def reset(scope, index, depth, permission = 0, protection = None):
 		while depth > 0:
 			scope = scope.superscope
 			depth -= 1
-		if index < len(scope.slots):
-			_, current_security = scope.slots[index]
+		if index < len(scope.values):
+			current_security = scope.security_level(index)
 			if current_security > permission:
 				raise EvaluationError('Not permitted to perform this unassignment')
-			scope.slots[index] = DataSlot(None, protection if protection is not None else current_security)
+			scope._make_writable(index, protection)
+			scope.values[index] = None
+			if protection is not None and scope.security is not None:
+				scope.security[index] = protection
 
 	def __repr__(self):
 		return 'indexed-scope'
 
 
-async def do_nothing_async():
+def do_nothing():
 	pass
 
 
+class CallbackBoundary:
+	''' Marks the bottom of the part of the stack used by a call that was
+		made with Interpereter.call. Errors aren't unwound past it, and are
+		raised from the call instead.
+	'''
+
+	def __repr__(self):
+		return 'callback-boundary'
+
+
+CALLBACK_BOUNDARY = CallbackBoundary()
+
+
+@functools.lru_cache(None)
+def callback_segment(count):
+	''' Code that calls the function on the stack with count
+		arguments and then stops.
+	'''
+	segment = bytecode.CodeSegment(None)
+	segment.bytecode = [bytecode.I.ARG_LIST_END, count, bytecode.I.END]
+	segment.error_link = [None] * len(segment.bytecode)
+	return segment.constructed()
+
+
 async def protected_power(use_crucible, a, b):
 	if use_crucible:
 		try:
 			return await crucible.run(_protected_power_crucible, (a, b), timeout=2)
 		except asyncio.TimeoutError:
 			raise EvaluationError('Operation timed out. Perhaps the values were too large?')
+		except crucible.ResourceExhausted as e:
+			raise errors.ResourceExhaustedError(e.resource)
 	else:
 		return _protected_power_crucible(a, b)
 
@@ -89,11 +155,21 @@ async def protected_power(use_crucible, a, b):
 def _protected_power_crucible(a, b):
 	result = a ** b
 	# ensure that the result isn't going to expode on the main program
-	# if str(result) explodes, this process will time out
-	str(result)
+	# if formatting it explodes, this process will time out
+	formatter.format(result)
 	return result
 
 
+def raise_builtin_failure(function, arguments):
+	# pylint: disable=raising-format-tuple
+	if not arguments:
+		raise EvaluationError('Failed to call {} with no arguments.', function)
+	elif len(arguments) == 1:
+		raise EvaluationError('Failed to call {} on {}', function, arguments[0])
+	else:
+		raise EvaluationError('Failed to call {} on {}', function, arguments)
+
+
 class FunctionInspector:
 	''' Used to provide an abstraction around accessing information about a function,
 		as opposed to looking at the bytecode directly.
@@ -139,51 +215,438 @@ class FunctionInspector:
 		return self.function_object.segment
 
 
+# Returned by CallingCache.lookup when the result is not in the cache
+CACHE_MISS = object()
+
+
+# Rough guesses at memory usage, used to keep the cache within its budget
+CACHE_ENTRY_OVERHEAD = 200
+SEQUENCE_ITEM_SIZE = 64
+SYMPY_NODE_SIZE = 64
+
+
+def estimate_size(value):
+	''' Cheap estimate of the number of bytes that a value keeps alive '''
+	if isinstance(value, (ListBase, Array)):
+		return SEQUENCE_ITEM_SIZE * len(value)
+	if isinstance(value, sympy.Rational):
+		return SYMPY_NODE_SIZE + (int(value.p).bit_length() + int(value.q).bit_length()) // 8
+	if isinstance(value, sympy.Basic):
+		return SYMPY_NODE_SIZE * (len(value.args) + 1)
+	return sys.getsizeof(value)
+
+
+class CacheKey:
+
+	''' Key for an entry in the calling cache. The hash is only
+		worked out once, since each key is used several times.
+	'''
+
+	__slots__ = ['function', 'arguments', 'hash']
+
+	def __init__(self, function, arguments):
+		self.function = function
+		self.arguments = tuple(arguments)
+		self.hash = hash((function, self.arguments))
+
+	def __hash__(self):
+		return self.hash
+
+	def __eq__(self, other):
+		return self.hash == other.hash \
+			and self.function is other.function \
+			and self.arguments == other.arguments
+
+	def __repr__(self):
+		return '{}{}'.format(self.function, self.arguments)
+
+
+class CacheStatistics:
+
+	__slots__ = ['name', 'hits', 'misses', 'evictions']
+
+	def __init__(self, name=None):
+		self.name = name
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __repr__(self):
+		return f'hits={self.hits} misses={self.misses} evictions={self.evictions}'
+
+
+class CachedDefinition:
+
+	''' What the calling cache knows about one function definition '''
+
+	__slots__ = ['cache', 'priority', 'statistics']
+
+	def __init__(self, name):
+		self.cache = True
+		self.priority = 0
+		self.statistics = CacheStatistics(name)
+
+
 class CallingCache:
 
-	def __init__(self, capacity=10000):
+	''' Remembers the results of function calls.
+
+		Entries are dropped in least-recently-used order once there are more
+		than capacity of them, or their estimated total size is more than
+		memory_budget bytes. Entries belonging to functions with a higher
+		priority are only dropped once there are no lower priority entries
+		left. Functions can also be excluded from the cache entirely.
+
+		Policies and statistics are kept per function definition, so the
+		functions made by running the same code share them, while functions
+		that just have the same name don't. They are stored by segment and
+		then address, and go away along with the segment.
+	'''
+
+	def __init__(self, capacity=10000, memory_budget=32 * 1024 * 1024):
+		self.capacity = capacity
+		self.memory_budget = memory_budget
+		self.definitions = weakref.WeakKeyDictionary()
+		self._last_segment = None
+		self._last_definitions = None
 		self.clear()
-		self.capacity = 10000
 
-	def __contains__(self, key):
-		return key in self.values
+	def definition(self, function):
+		''' The policy and statistics for a function's definition '''
+		segment = function.segment
+		# Calls tend to come from the same segment, and looking things
+		# up in a WeakKeyDictionary is relatively slow
+		if segment is self._last_segment:
+			by_address = self._last_definitions
+		else:
+			by_address = self.definitions.get(segment)
+			if by_address is None:
+				by_address = self.definitions[segment] = {}
+			self._last_segment = segment
+			self._last_definitions = by_address
+		definition = by_address.get(function.address)
+		if definition is None:
+			definition = by_address[function.address] = CachedDefinition(function.name)
+		return definition
+
+	def set_policy(self, function, *, cache=True, priority=0):
+		''' Set whether calls to functions with the same definition as the
+			given one should be cached at all, and how reluctant the cache
+			is to drop their results.
+		'''
+		definition = self.definition(function)
+		definition.cache = cache
+		definition.priority = priority
 
-	def __setitem__(self, key, value):
-		assert key not in self.values
-		self.values[key] = value
-		self.queue.append(key)
-		if len(self.queue) > self.capacity:
-			drop = self.queue.popleft()
-			del self.values[drop]
+	def should_cache(self, function):
+		return self.definition(function).cache
+
+	def all_statistics(self):
+		for by_address in list(self.definitions.values()):
+			for definition in by_address.values():
+				yield definition.statistics
+
+	def __contains__(self, key):
+		return key in self.entries
 
 	def __getitem__(self, key):
-		return self.values[key]
+		return self.entries[key][0]
+
+	def __len__(self):
+		return len(self.entries)
+
+	def items(self):
+		for key, (value, _, _) in self.entries.items():
+			yield key, value
+
+	def lookup(self, key):
+		''' Get the result for a call, or CACHE_MISS if it isn't known '''
+		entry = self.entries.get(key)
+		if entry is None:
+			self.definition(key.function).statistics.misses += 1
+			return CACHE_MISS
+		self.definition(key.function).statistics.hits += 1
+		self.tiers[entry[2]].move_to_end(key)
+		return entry[0]
+
+	def __setitem__(self, key, value):
+		definition = self.definition(key.function)
+		if not definition.cache:
+			return
+		if key in self.entries:
+			self.remove(key)
+		size = CACHE_ENTRY_OVERHEAD + estimate_size(value) + sum(map(estimate_size, key.arguments))
+		priority = definition.priority
+		self.entries[key] = (value, size, priority)
+		if priority not in self.tiers:
+			self.tiers[priority] = collections.OrderedDict()
+		self.tiers[priority][key] = None
+		self.size += size
+		while self.entries and (len(self.entries) > self.capacity or self.size > self.memory_budget):
+			self.evict()
+
+	def remove(self, key):
+		_, size, priority = self.entries.pop(key)
+		tier = self.tiers[priority]
+		del tier[key]
+		if not tier:
+			del self.tiers[priority]
+		self.size -= size
+
+	def evict(self):
+		''' Drop the least recently used entry with the lowest priority '''
+		key = next(iter(self.tiers[min(self.tiers)]))
+		self.remove(key)
+		self.definition(key.function).statistics.evictions += 1
 
 	def clear(self):
-		self.values = {}
-		self.queue = collections.deque()
+		''' Remove all the entries. The statistics are kept. '''
+		self.entries = {}
+		self.tiers = {}
+		self.size = 0
+
+	def total_statistics(self):
+		total = CacheStatistics()
+		for i in self.all_statistics():
+			total.hits += i.hits
+			total.misses += i.misses
+			total.evictions += i.evictions
+		return total
 
 
 class ErrorStopGap:
 
-	__slots__ = ['handler_segment', 'handler_address', 'should_pass']
+	__slots__ = ['handler_segment', 'handler_address', 'should_pass', 'profile_depth']
 
-	def __init__(self, segment, address, should_pass):
+	def __init__(self, segment, address, should_pass, profile_depth=0):
 		self.handler_segment = segment
 		self.handler_address = address
 		self.should_pass = should_pass
+		# Number of functions the profiler had entered when this was created
+		self.profile_depth = profile_depth
+
+
+class ThreadedCode:
+	''' Closure-threaded version of the code for a single function.
+
+		Each instruction is converted into a closure that has its operands
+		already decoded. The closures take the interpereter as their only
+		argument, perform the instruction, and leave the playhead on the
+		next instruction to be run. Like normal instruction handlers, they
+		may return an awaitable if they need to wait on something, in which
+		case the playhead is left on the last operand of the instruction.
+
+		error_places gives, for each instruction, the location that
+		errors raised by the instruction should be linked to. This is the
+		same place the playhead would have been in had the instruction
+		been run normally.
+	'''
+
+	__slots__ = ['handlers', 'error_places']
+
+	def __init__(self, segment, start, switch_dictionary):
+		b = bytecode.I # pylint: no-invalid-name
+		code = segment.bytecode
+		self.handlers = [None] * len(code)
+		self.error_places = [None] * len(code)
+		# Need the plain functions rather than the bound methods so that the
+		# compiled code can be shared between interpereters.
+		plain = {k: getattr(v, '__func__', v) for k, v in switch_dictionary.items()}
+		place = start
+		while place < len(code):
+			inst = code[place]
+			if not isinstance(inst, b) or inst not in plain:
+				raise SystemError('Tried to compile unknown instruction: ' + repr(inst))
+			width = bytecode.OPERAND_COUNT.get(inst, 0)
+			operands = code[place + 1 : place + 1 + width]
+			self.handlers[place] = self.make_handler(segment, place, inst, operands, plain)
+			self.error_places[place] = place + width
+			place += width + 1
+
+	@staticmethod
+	def make_handler(segment, place, inst, operands, plain):
+		b = bytecode.I # pylint: no-invalid-name
+		handler = plain[inst]
+		following = place + len(operands) + 1
+		last = following - 1
+		if inst == b.NOTHING:
+			def nothing(vm):
+				vm.place = following
+			return nothing
+		if inst == b.CONSTANT:
+			value, = operands
+			def constant(vm):
+				vm.stack.append(value)
+				vm.place = following
+			return constant
+		if inst == b.ACCESS_LOCAL:
+			index, = operands
+			def access_local(vm):
+				vm.stack.append(vm.current_scope.get(index, 0))
+				vm.place = following
+			return access_local
+		if inst == b.ACCESS_SEMI:
+			depth, index = operands
+			def access_semi(vm):
+				vm.stack.append(vm.current_scope.get(index, depth))
+				vm.place = following
+			return access_semi
+		if inst == b.ACCESS_GLOBAL:
+			index, name = operands
+			def access_global(vm):
+				try:
+					vm.stack.append(vm.root_scope.get(index, 0))
+				except ScopeMissedError:
+					raise errors.AccessFailedError(name)
+				vm.place = following
+			return access_global
+		if inst == b.FUNCTION_NORMAL:
+			(function_segment, address), = operands
+			name = function_segment[address + 1]
+			def function_normal(vm):
+				vm.stack.append(Function(function_segment, address, vm.current_scope, name))
+				vm.place = following
+			return function_normal
+		if inst in (b.JUMP, b.JUMP_IF_TRUE, b.JUMP_IF_FALSE, b.JUMP_IF_MACRO):
+			(target_segment, target), = operands
+			# Jumps always land on an empty instruction, so skip over it
+			if target_segment.bytecode[target] is b.NOTHING:
+				target += 1
+			if inst == b.JUMP:
+				def jump(vm):
+					vm.bytes = target_segment
+					vm.place = target
+				return jump
+			if inst == b.JUMP_IF_MACRO:
+				def jump_if_macro(vm):
+					top = vm.stack[-1]
+					if isinstance(top, Function) and top.segment.bytecode[top.address + 4]:
+						vm.bytes = target_segment
+						vm.place = target
+					else:
+						vm.place = following
+				return jump_if_macro
+			jump_when = inst == b.JUMP_IF_TRUE
+			def conditional_jump(vm):
+				if bool(vm.stack.pop()) == jump_when:
+					vm.bytes = target_segment
+					vm.place = target
+				else:
+					vm.place = following
+			return conditional_jump
+		if inst in (b.ARG_LIST_END, b.ARG_LIST_END_NO_CACHE, b.ARG_LIST_END_WITH_TCO):
+			count, = operands
+			disable_cache = inst == b.ARG_LIST_END_NO_CACHE
+			do_tco = inst == b.ARG_LIST_END_WITH_TCO
+			return_to = (segment, following)
+			def arg_list_end(vm):
+				stack = vm.stack
+				arguments = []
+				for _ in range(count):
+					arg = stack.pop()
+					if isinstance(arg, Expanded):
+						arguments.extend(arg)
+					else:
+						arguments.append(arg)
+				function = stack.pop()
+				vm.place = following - 1
+				pending = vm.call_function(function, arguments, return_to,
+					disable_cache=disable_cache, do_tco=do_tco)
+				if pending is None:
+					vm.place += 1
+				return pending
+			return arg_list_end
+		if inst == b.STORE_IN_CACHE:
+			def store_in_cache(vm):
+				stack = vm.stack
+				value = stack.pop()
+				cache_key = stack.pop()
+				if cache_key is not None:
+					vm.calling_cache[cache_key] = value
+				stack.append(value)
+				vm.place = following
+			return store_in_cache
+		if inst == b.RETURN:
+			def return_(vm):
+				stack = vm.stack
+				result = stack.pop()
+				vm.current_scope = stack.pop()
+				vm.bytes, vm.place = stack.pop()
+				stack.append(result)
+			return return_
+		if inst == b.RETURN_CACHED:
+			def return_cached(vm):
+				stack = vm.stack
+				result = stack.pop()
+				cache_key = stack.pop()
+				if cache_key is not None:
+					vm.calling_cache[cache_key] = result
+				vm.current_scope = stack.pop()
+				vm.bytes, vm.place = stack.pop()
+				stack.append(result)
+			return return_cached
+		if inst == b.CALL_THUNK:
+			(function_segment, address), = operands
+			code_address = address + 5 # Skip the function header
+			return_to = (segment, following)
+			def call_thunk(vm):
+				stack = vm.stack
+				stack.append(return_to)
+				stack.append(vm.current_scope)
+				stack.append(None)
+				if function_segment.threaded is None:
+					vm.count_segment_call(function_segment, code_address)
+				vm.bytes = function_segment
+				vm.place = code_address
+			return call_thunk
+		if inst in (b.LOCAL_OPERATOR, b.CONSTANT_OPERATOR):
+			value, operator = operands
+			# Build the operator as if it was sitting in the last operand
+			# slot, which is where the playhead is while it runs.
+			run_operator = ThreadedCode.make_handler(segment, last, operator, (), plain)
+			if inst == b.LOCAL_OPERATOR:
+				def local_operator(vm):
+					vm.stack.append(vm.current_scope.get(value, 0))
+					vm.place = last
+					return run_operator(vm)
+				return local_operator
+			def constant_operator(vm):
+				vm.stack.append(value)
+				vm.place = last
+				return run_operator(vm)
+			return constant_operator
+		# Fall back to the normal instruction handler
+		def generic(vm):
+			pending = handler(vm)
+			if pending is None:
+				vm.place += 1
+			return pending
+		return generic
 
 
 class Interpereter:
 
-	def __init__(self, *, trace=False, yield_rate=100, use_crucible=False):
+	def __init__(self, *, trace=False, yield_rate=100, use_crucible=False, compile_threshold=20):
 		self.use_crucible = use_crucible
+		# Functions that are called more than this number of times are compiled
+		# to closure-threaded code. None disables the compilation.
+		self.compile_threshold = compile_threshold
 		self.calling_cache = CallingCache()
 		self.trace = trace
+		# Set to a profiler.Profiler to collect information about what
+		# the code spends its time doing.
+		self.profiler = None
 		self.bytes = None
 		self.place = 0
 		self.stack = [None]
 		self.yield_rate = yield_rate
+		self.usage = quota.Meter()
+		# The ticks that the current run has left, shared with any
+		# functions that builtins call while it's going
+		self.tick_limit = None
+		# Ticks run by those functions since control was last handed back
+		# to the event loop
+		self.callback_ticks = 0
 		self.root_scope = IndexedScope(None, 0, [])
 		self.current_scope = self.root_scope
 		self.protected_assignment_mode = False
@@ -192,7 +655,7 @@ class Interpereter:
 		self.enable_exception_handler = True
 		b = bytecode.I # pylint: no-invalid-name
 		self.switch_dictionary = {
-			b.NOTHING: do_nothing_async,
+			b.NOTHING: do_nothing,
 			b.CONSTANT: self.inst_constant,
 			b.BIN_ADD: self.inst_add,
 			b.BIN_SUB: self.inst_sub,
@@ -252,7 +715,11 @@ class Interpereter:
 			b.LIST_PREPEND: self.inst_list_prepend,
 			b.PUSH_ERROR_STOPGAP: self.inst_push_error_stopgap,
 			b.CONSTANT_STRING: self.inst_constant_string,
-			b.CONSTANT_GLYPH: self.inst_constant_glyph
+			b.CONSTANT_GLYPH: self.inst_constant_glyph,
+			b.CALL_THUNK: self.inst_call_thunk,
+			b.RETURN_CACHED: self.inst_return_cached,
+			b.LOCAL_OPERATOR: self.inst_local_operator,
+			b.CONSTANT_OPERATOR: self.inst_constant_operator
 		}
 
 	# def swap_bytecode(self, constructed_bytecode):
@@ -263,17 +730,15 @@ class Interpereter:
 		''' Clears the function call cache '''
 		self.calling_cache.clear()
 
-	# def state_freeze(self):
-	# 	''' Returns the state of the interpereter so that it may be recovered later.
-	# 		Global variables are not considered 'frozen'
-	# 	'''
-	# 	return FrozenState(self)
+	def state_freeze(self):
+		''' Returns the global state of the interpereter so that it may be recovered later '''
+		return FrozenState(self.root_scope.values, self.root_scope.security)
 
-	# def state_thaw(self, frozen):
-	# 	''' Returns to a frozen state '''
-	# 	self.place = frozen.place
-	# 	self.stack = frozen.stack[:]
-	# 	self.current_scope = frozen.current_scope
+	def state_thaw(self, frozen):
+		''' Returns to a frozen state '''
+		self.root_scope.values = list(frozen.values)
+		self.root_scope.security = None if frozen.security is None else list(frozen.security)
+		self.calling_cache.clear()
 
 	@property
 	def erlnk(self):
@@ -313,32 +778,157 @@ class Interpereter:
 		return loop.run_until_complete(self.run_async(**kwargs))
 
 	async def run_async(self, segment=None, tick_limit=None, error_if_exhausted=False,
-			get_entire_stack=False, assignment_protection_level=None, assignment_auth_level=0):
+			get_entire_stack=False, assignment_protection_level=None, assignment_auth_level=0,
+			budget=None):
 		''' Run some number of ticks.
 			tick_limit         - The maximum number of ticks to run. If not specified there is no limit.
 			error_if_exhausted - If True, an error will be thrown if execution is not finished in the
 								 specified number of ticks.
 			expect_complete    - Deprecated
+			budget             - A quota.Budget limiting the CPU time and ticks that can be used.
+								 A QuotaExceededError is raised if it runs out.
+			Control is only handed back to the event loop every yield_rate ticks,
+			or when an instruction needs to wait on something. The resources used
+			are recorded in self.usage.
 		'''
 		self.assignment_protection_level = assignment_protection_level
 		self.assignment_auth_level = assignment_auth_level
 		self.bytes = segment
 		self.place = 0
-		if tick_limit is None:
-			while self.head != bytecode.I.END:
-				await self.tick()
-		else:
-			while self.head != bytecode.I.END and tick_limit > 0:
-				tick_limit -= 1
-				await self.tick()
+		meter = self.usage = quota.Meter(budget)
+		profiler = self.profiler
+		meter.resume()
+		try:
+			tick_limit, ticks = await self.run_until_end(meter, tick_limit)
+			meter.ticks += ticks
+		finally:
+			meter.pause()
+			self.tick_limit = None
+			if profiler is not None:
+				profiler.finish()
 		if error_if_exhausted and tick_limit == 0:
 			raise EvaluationError('Execution timed out (by tick count)')
 		if get_entire_stack:
-			return self.stack[1:]
-		return self.top
+			return [operators.to_sympy(i) for i in self.stack[1:]]
+		return operators.to_sympy(self.top)
+
+	async def run_until_end(self, meter, tick_limit=None):
+		''' Run ticks until an END instruction is reached, or tick_limit
+			runs out. The meter must be running. Returns the remaining
+			tick_limit, and the number of ticks that haven't been
+			recorded in the meter yet.
+		'''
+		end = bytecode.I.END
+		yield_rate = max(1, self.yield_rate)
+		since_yield = 0
+		profiler = self.profiler
+		# Compiled code skips the parts of the interpereter that do these
+		interpret_only = self.trace or profiler is not None
+		while True:
+			threaded = self.bytes.threaded
+			place = self.place
+			if self.bytes.bytecode[place] is end:
+				break
+			if tick_limit is not None:
+				if tick_limit <= 0:
+					break
+				tick_limit -= 1
+			if threaded is None or interpret_only:
+				if profiler is not None:
+					profiler.instruction(self.bytes.bytecode[place])
+				pending = self.tick()
+			else:
+				try:
+					pending = threaded.handlers[place](self)
+				except EvaluationError as error:
+					if not self.enable_exception_handler:
+						raise
+					self.place = threaded.error_places[place]
+					self.handle_error(error)
+					self.place += 1
+					pending = None
+			since_yield += 1
+			if pending is not None:
+				self.check_quota(meter, since_yield)
+				meter.pause()
+				self.tick_limit = tick_limit
+				await self.finish_tick(pending)
+				tick_limit = self.tick_limit
+				meter.resume()
+				since_yield = 0
+			elif since_yield >= yield_rate:
+				self.check_quota(meter, since_yield)
+				if profiler is not None:
+					profiler.flush()
+				# Let the event loop do some work.
+				meter.pause()
+				await asyncio.sleep(0)
+				meter.resume()
+				since_yield = 0
+		return tick_limit, since_yield
+
+	async def call(self, function, *arguments):
+		''' Call a calculator function from Python and return the result.
+			This is how builtin coroutines that take the interpereter (see
+			runtime.uses_interpereter) call the functions they are given.
+			Calls can be nested. Errors that the function doesn't catch
+			itself are raised from here.
+		'''
+		if isinstance(function, Function) and FunctionInspector(self, function).is_macro:
+			arguments = tuple(map(SingularValue, arguments))
+		stack = self.stack
+		base = len(stack)
+		saved = (self.bytes, self.place, self.current_scope)
+		meter = self.usage
+		stack.append(CALLBACK_BOUNDARY)
+		stack.append(function)
+		stack.extend(reversed(arguments))
+		self.bytes = callback_segment(len(arguments))
+		self.place = 0
+		# The builtins that make calls already have the meter running
+		was_running = meter.running
+		if not was_running:
+			meter.resume()
+		try:
+			self.tick_limit, ticks = await self.run_until_end(meter, self.tick_limit)
+			self.check_quota(meter, ticks)
+			if self.bytes.bytecode[self.place] is not bytecode.I.END:
+				# The function can't be stopped part way through like the
+				# rest of the code can, so this is treated like any other quota
+				raise quota.QuotaExceededError('Execution timed out (by tick count)')
+			result = stack[-1]
+		finally:
+			if not was_running:
+				meter.pause()
+			del stack[base:]
+			self.bytes, self.place, self.current_scope = saved
+		# Each call is usually too short to yield by itself, but a builtin
+		# that makes lots of them shouldn't hold up the event loop either
+		self.callback_ticks += ticks
+		if self.callback_ticks >= self.yield_rate:
+			self.callback_ticks = 0
+			if was_running:
+				meter.pause()
+			await asyncio.sleep(0)
+			if was_running:
+				meter.resume()
+		return result
+
+	def check_quota(self, meter, ticks):
+		''' Count ticks towards the quota. Errors from running out
+			can't be caught by the code that is being run.
+		'''
+		try:
+			meter.record(ticks)
+		except quota.QuotaExceededError as error:
+			error._linking = self.erlnk[self.place]
+			raise
 
-	async def tick(self):
-		''' Run a single tick '''
+	def tick(self):
+		''' Run a single tick.
+			If the instruction needs to wait on something, an awaitable is
+			returned and finish_tick should be used to complete the tick.
+		'''
 		if self.trace:
 			print(self.place, self.head, self.stack)
 		inst = self.switch_dictionary.get(self.head)
@@ -346,111 +936,161 @@ class Interpereter:
 			raise SystemError('Tried to run unknown instruction: ' + repr(self.head))
 		if self.enable_exception_handler:
 			try:
-				await inst()
+				pending = inst()
 			except EvaluationError as error:
-				error._linking = self.erlnk[self.place]
-				if self.panic(error):
-					raise error
+				self.handle_error(error)
+				pending = None
 		else:
-			await inst()
-		# Let the event loop do some work.
-		await asyncio.sleep(0)
+			pending = inst()
+		if pending is None:
+			self.place += 1
+		return pending
+
+	async def finish_tick(self, pending):
+		''' Wait for an instruction that returned an awaitable to complete '''
+		if self.enable_exception_handler:
+			try:
+				await pending
+			except quota.QuotaExceededError:
+				# Running out inside a call made by a builtin
+				raise
+			except EvaluationError as error:
+				self.handle_error(error)
+		else:
+			await pending
 		self.place += 1
 
+	def handle_error(self, error):
+		''' Attach debugging information to an error and unwind to the nearest stopgap '''
+		# Errors raised from inside a call made by a builtin already know where they came from
+		if getattr(error, '_linking', None) is None:
+			error._linking = self.erlnk[self.place]
+		if self.panic(error):
+			raise error
+
 	def panic(self, error):
 		try:
 			while not isinstance(self.top, ErrorStopGap):
+				if self.top is CALLBACK_BOUNDARY:
+					return True
 				# No stopgap found, raise the error instead
 				self.pop()
 		except IndexError:
 			return True
 		stopgap = self.pop()
+		if self.profiler is not None:
+			self.profiler.unwind(stopgap.profile_depth)
 		self.bytes = stopgap.handler_segment
 		self.place = stopgap.handler_address - 1
 		return False
 
-	async def inst_constant(self):
+	def inst_constant(self):
 		''' Push a constant to the stack '''
 		self.place += 1
 		self.push(self.head)
 
-	async def inst_constant_empty_array(self):
+	def inst_constant_empty_array(self):
 		''' Push an empty array to the stack '''
 		warnings.warn('Instruction CONSTANT_EMPTY_ARRAY is deprecated', DeprecationWarning)
 		self.push(Array([]))
 
-	async def inst_constant_string(self):
+	def inst_constant_string(self):
 		''' Push a string to the stack '''
 		string = self.next()
 		self.push(create_list(map(Glyph, string)))
 
-	async def inst_constant_glyph(self):
+	def inst_constant_glyph(self):
 		''' Push a glyph to the stack '''
 		c = self.next()
 		self.push(Glyph(c))
 
-	async def inst_duplicate(self):
+	def inst_duplicate(self):
 		''' Duplicate the top item of the stack '''
 		self.push(self.top)
 
-	async def inst_stack_swap(self):
+	def inst_stack_swap(self):
 		''' Swap the top two items of the stack '''
 		a = self.pop()
 		b = self.pop()
 		self.push(a)
 		self.push(b)
 
-	async def inst_protected_mode_enable(self):
+	def inst_protected_mode_enable(self):
 		''' Specify that any assignments from now on should be protected '''
 		warnings.warn('Instruction BEGIN_PROTECTED_GLOBAL_BLOCK is deprecated', DeprecationWarning)
 		self.protected_assignment_mode = True
 
-	async def inst_protected_mode_disable(self):
+	def inst_protected_mode_disable(self):
 		''' Specify that any assignments from now on should not be protected '''
 		warnings.warn('Instruction END_PROTECTED_GLOBAL_BLOCK is deprecated', DeprecationWarning)
 		self.protected_assignment_mode = False
 
-	def make_bin_op_instruction(op, is_coroutine=False):
-		''' Create a handler for a binary operator instruction '''
-		async def internal(self):
+	def make_bin_op_instruction(op, is_coroutine=False, sync_op=None):
+		''' Create a handler for a binary operator instruction.
+			If the operator is a coroutine, sync_op can be provided to avoid awaiting
+			when neither of the operands need to be compared asyncronously.
+		'''
+		def internal(self):
 			left = self.pop()
 			right = self.pop()
+			if is_coroutine and (sync_op is None or operators.needs_async_comparison(left, right)):
+				return self.push_awaited_operation(op(left, right), left, right)
 			try:
-				result = op(left, right)
-				if is_coroutine:
-					result = await result
-				self.push(result)
+				self.push((sync_op or op)(left, right))
 			except EvaluationError:
 				raise
 			except Exception:
 				raise EvaluationError('Operation failed on {} and {}', left, right)
 		return internal
 
-	inst_add = make_bin_op_instruction(operator.add)
-	inst_mul = make_bin_op_instruction(operator.mul)
-	inst_sub = make_bin_op_instruction(operator.sub)
-	inst_div = make_bin_op_instruction(operator.truediv)
-	inst_mod = make_bin_op_instruction(operator.mod)
+	async def push_awaited_operation(self, awaitable, left, right):
+		''' Wait for the result of an operator and push it to the stack '''
+		try:
+			self.push(await awaitable)
+		except EvaluationError:
+			raise
+		except Exception:
+			raise EvaluationError('Operation failed on {} and {}', left, right)
+
+	inst_add = make_bin_op_instruction(operators.exact_add)
+	inst_mul = make_bin_op_instruction(operators.exact_multiply)
+	inst_sub = make_bin_op_instruction(operators.exact_subtract)
+	inst_div = make_bin_op_instruction(operators.exact_division)
+	inst_mod = make_bin_op_instruction(operators.exact_modulo)
 	# inst_pow = make_bin_op_instruction(protected_power, is_coroutine=True)
-	inst_bin_less = make_bin_op_instruction(operators.super_less_than, is_coroutine=True)
-	inst_bin_more = make_bin_op_instruction(operators.super_more_than, is_coroutine=True)
-	inst_bin_l_eq = make_bin_op_instruction(operators.super_less_eq, is_coroutine=True)
-	inst_bin_m_eq = make_bin_op_instruction(operators.super_more_eq, is_coroutine=True)
-	inst_bin_equl = make_bin_op_instruction(operators.super_equals, is_coroutine=True)
-	inst_bin_n_eq = make_bin_op_instruction(operators.super_not_equals, is_coroutine=True)
+	inst_bin_less = make_bin_op_instruction(operators.super_less_than, is_coroutine=True, sync_op=operators.sync_less_than)
+	inst_bin_more = make_bin_op_instruction(operators.super_more_than, is_coroutine=True, sync_op=operators.sync_more_than)
+	inst_bin_l_eq = make_bin_op_instruction(operators.super_less_eq, is_coroutine=True, sync_op=operators.sync_less_eq)
+	inst_bin_m_eq = make_bin_op_instruction(operators.super_more_eq, is_coroutine=True, sync_op=operators.sync_more_eq)
+	inst_bin_equl = make_bin_op_instruction(operators.super_equals, is_coroutine=True, sync_op=operators.sync_equals)
+	inst_bin_n_eq = make_bin_op_instruction(operators.super_not_equals, is_coroutine=True, sync_op=operators.sync_not_equals)
 	# inst_bin_die = make_bin_op_instruction(rolldie)
 	inst_and = make_bin_op_instruction(lambda a, b: (bool(a) and bool(b)))
 	inst_or = make_bin_op_instruction(lambda a, b: (bool(a) or bool(b)))
 
-	async def inst_pow(self):
-		def _internal(a, b):
-			return protected_power(self.use_crucible, a, b)
-		await Interpereter.make_bin_op_instruction(_internal, is_coroutine=True)(self)
+	def inst_pow(self):
+		left = self.pop()
+		right = self.pop()
+		# Small powers of integers and rationals don't need to be protected
+		result = operators.try_native(operators.operator_power, left, right)
+		if result is not NotImplemented:
+			self.push(result)
+			return None
+		left = operators.to_sympy(left)
+		right = operators.to_sympy(right)
+		if self.use_crucible:
+			return self.push_awaited_operation(protected_power(True, left, right), left, right)
+		try:
+			self.push(_protected_power_crucible(left, right))
+		except EvaluationError:
+			raise
+		except Exception:
+			raise EvaluationError('Operation failed on {} and {}', left, right)
 
-	async def inst_unr_min(self):
+	def inst_unr_min(self):
 		self.push(-self.pop())
 
-	async def inst_unr_fac(self):
+	def inst_unr_fac(self):
 		''' Factorial operator '''
 		try:
 			original_value = self.pop()
@@ -466,17 +1106,19 @@ class Interpereter:
 		self.push(result)
 		# self.push(operators.function_factorial(self.pop()))
 
-	async def inst_unr_not(self):
+	def inst_unr_not(self):
 		''' Unary not operator '''
 		self.push(int(not bool(self.pop())))
 
-	def make_comparison_instruction(comparator):
+	def make_comparison_instruction(comparator, sync_comparator):
 		''' Create a handler for a binary comparison instruction '''
-		async def internal(self):
+		def internal(self):
 			right = self.pop()
 			left = self.pop()
+			if operators.needs_async_comparison(left, right):
+				return self.push_awaited_comparison(comparator(left, right), left, right)
 			try:
-				result = bool(await comparator(left, right))
+				result = bool(sync_comparator(left, right))
 			except EvaluationError:
 				raise
 			except Exception:
@@ -485,18 +1127,29 @@ class Interpereter:
 			self.push(right)
 		return internal
 
-	inst_cmp_less = make_comparison_instruction(operators.super_less_than)
-	inst_cmp_more = make_comparison_instruction(operators.super_more_than)
-	inst_cmp_l_eq = make_comparison_instruction(operators.super_less_eq)
-	inst_cmp_m_eq = make_comparison_instruction(operators.super_more_eq)
-	inst_cmp_equl = make_comparison_instruction(operators.super_equals)
-	inst_cmp_n_eq = make_comparison_instruction(operators.super_not_equals)
-
-	async def inst_discard(self):
+	async def push_awaited_comparison(self, awaitable, left, right):
+		''' Wait for the result of a chained comparison and update the stack '''
+		try:
+			result = bool(await awaitable)
+		except EvaluationError:
+			raise
+		except Exception:
+			raise EvaluationError('Operation failed on {} and {}', left, right)
+		self.stack[-1] = self.stack[-1] and result
+		self.push(right)
+
+	inst_cmp_less = make_comparison_instruction(operators.super_less_than, operators.sync_less_than)
+	inst_cmp_more = make_comparison_instruction(operators.super_more_than, operators.sync_more_than)
+	inst_cmp_l_eq = make_comparison_instruction(operators.super_less_eq, operators.sync_less_eq)
+	inst_cmp_m_eq = make_comparison_instruction(operators.super_more_eq, operators.sync_more_eq)
+	inst_cmp_equl = make_comparison_instruction(operators.super_equals, operators.sync_equals)
+	inst_cmp_n_eq = make_comparison_instruction(operators.super_not_equals, operators.sync_not_equals)
+
+	def inst_discard(self):
 		''' Discard the top item of the stack '''
 		self.pop()
 
-	async def inst_jump_if_macro(self):
+	def inst_jump_if_macro(self):
 		''' Jumps to a place specified by the next instruction IFF the thing on the
 			top of the stack is both a function and a macro.
 		'''
@@ -504,7 +1157,7 @@ class Interpereter:
 		if isinstance(self.top, Function) and FunctionInspector(self, self.top).is_macro:
 			self.perform_jump()
 
-	async def inst_arg_list_end(self, disable_cache = False, do_tco = False):
+	def inst_arg_list_end(self, disable_cache = False, do_tco = False):
 		''' Specify the end of an argument list.
 			Pop the arguments off the stack and call the function.
 		'''
@@ -520,7 +1173,7 @@ class Interpereter:
 			else:
 				arguments.append(arg)
 		function = self.pop()
-		await self.call_function(
+		return self.call_function(
 			function,
 			arguments,
 			(self.bytes, self.place + 1),
@@ -528,24 +1181,24 @@ class Interpereter:
 			do_tco=do_tco
 		)
 
-	async def inst_arg_list_end_no_cache(self):
+	def inst_arg_list_end_no_cache(self):
 		''' Specify the end of an argument list, but explicitly disable the cache. '''
-		await self.inst_arg_list_end(disable_cache = True)
+		return self.inst_arg_list_end(disable_cache = True)
 
-	async def inst_arg_list_end_with_tco(self):
+	def inst_arg_list_end_with_tco(self):
 		''' Specify the end of an argument list, but specify that tail call optimation can be employed.
 			An implementation of the interpereter _should_ be able to treat this as a normal ARG_LIST_END
 			with no penalty.
 		'''
-		await self.inst_arg_list_end(do_tco = True)
+		return self.inst_arg_list_end(do_tco = True)
 
-	async def inst_word(self):
+	def inst_word(self):
 		''' This is very deprecated '''
 		assert(False)
 		self.place += 1
 		self.push(self.current_scope[self.head])
 
-	async def inst_access_gobal(self):
+	def inst_access_gobal(self):
 		''' Retreive a global variable and push it to the top of the stack '''
 		index = self.next()
 		name = self.next()
@@ -555,12 +1208,12 @@ class Interpereter:
 		except ScopeMissedError:
 			raise errors.AccessFailedError(name)
 
-	async def inst_access_local(self):
+	def inst_access_local(self):
 		''' Access a local variable '''
 		self.place += 1
 		self.push(self.current_scope.get(self.head, 0))
 
-	async def inst_access_semi(self):
+	def inst_access_semi(self):
 		''' Access a variable from a scope above this one '''
 		depth = self.next()
 		index = self.next()
@@ -571,7 +1224,7 @@ class Interpereter:
 			)
 		)
 
-	async def inst_access_array_element(self):
+	def inst_access_array_element(self):
 		index = self.pop()
 		array = self.pop()
 		if not isinstance(array, (Array, Interval)):
@@ -582,25 +1235,36 @@ class Interpereter:
 			raise EvaluationError('Attempted to access out-of-bounds element of an array')
 		self.push(array(index))
 
-	async def inst_unload(self):
+	def forget_cached_results(self):
+		''' Cached results might depend on the old value of a global
+			variable, so the cache is cleared when one is changed. This
+			includes globals that didn't have a value before, since code
+			that failed to access them (and caught the error) is cached too.
+		'''
+		self.calling_cache.clear()
+
+	def inst_unload(self):
 		index = self.next()
+		self.forget_cached_results()
 		self.root_scope.reset(index, 0)
 
-	async def inst_assignment(self):
+	def inst_assignment(self):
 		value = self.pop()
 		index = self.next()
+		self.forget_cached_results()
 		self.root_scope.set(index, 0, value,
 			permission=self.assignment_auth_level, protection=self.assignment_protection_level)
 
-	async def inst_declare_symbol(self):
+	def inst_declare_symbol(self):
 		self.place += 1
 		index = self.head
 		self.place += 1
 		name = self.head
 		value = sympy.symbols(name)
+		self.forget_cached_results()
 		self.root_scope.set(index, 0, value)
 
-	async def inst_function(self):
+	def inst_function(self):
 		self.place += 1
 		segment, address = self.head
 		# print(id(self.bytes), id(segment), address)
@@ -617,13 +1281,48 @@ class Interpereter:
 	# 	self.place += 1
 	# 	self.push(Function(self.head, self.current_scope, True))
 
-	async def inst_return(self):
+	def inst_return(self):
+		if self.profiler is not None:
+			self.profiler.leave()
 		result = self.pop()
 		self.current_scope = self.pop()
 		self.bytes, self.place = self.pop()
 		self.place -= 1
 		self.push(result)
 
+	def inst_return_cached(self):
+		self.inst_store_in_cache()
+		self.inst_return()
+
+	def inst_call_thunk(self):
+		''' Call a function that has no parameters and is not a macro, without
+			creating an object for it. The result is never cached.
+		'''
+		segment, address = self.next()
+		self.push((self.bytes, self.place + 1))
+		self.push(self.current_scope)
+		self.push(None)
+		code_address = address + 5 # Skip the function header
+		if self.profiler is not None:
+			self.profiler.enter(segment[address + 1])
+		self.count_segment_call(segment, code_address)
+		self.bytes = segment
+		self.place = code_address - 1
+
+	def inst_local_operator(self):
+		''' Push a local variable and then run an operator on it '''
+		index = self.next()
+		operator = self.next()
+		self.push(self.current_scope.get(index, 0))
+		return self.switch_dictionary[operator]()
+
+	def inst_constant_operator(self):
+		''' Push a constant and then run an operator on it '''
+		value = self.next()
+		operator = self.next()
+		self.push(value)
+		return self.switch_dictionary[operator]()
+
 	def perform_jump(self, allow_leap=False):
 		''' Jumps to the destination that is sitting under the head.
 			If allow_leap is False, landing in a different segment
@@ -634,21 +1333,21 @@ class Interpereter:
 		self.bytes = segment
 		self.place = index - 1
 
-	async def inst_jump(self):
+	def inst_jump(self):
 		self.place += 1
 		self.perform_jump()
 
-	async def inst_jump_if_true(self):
+	def inst_jump_if_true(self):
 		self.place += 1
 		if self.pop():
 			self.perform_jump()
 
-	async def inst_jump_if_false(self):
+	def inst_jump_if_false(self):
 		self.place += 1
 		if not self.pop():
 			self.perform_jump()
 
-	async def inst_store_in_cache(self):
+	def inst_store_in_cache(self):
 		# print(self.stack)
 		value = self.pop()
 		cache_key = self.pop()
@@ -656,69 +1355,92 @@ class Interpereter:
 			self.calling_cache[cache_key] = value
 		self.push(value)
 
-	async def inst_special_reduce_store(self):
+	def inst_special_reduce_store(self):
 		result = self.pop()
 		self.stack[-2] = result
 		self.stack[-1] += 1
 		self.place -= 1 + 1
 
-	async def inst_list_create_empty(self):
+	def inst_list_create_empty(self):
 		self.push(functions.EmptyList())
 
-	async def inst_list_extract_first(self):
+	def inst_list_extract_first(self):
 		value = self.pop()
 		if not isinstance(value, (functions.ListBase, functions.Array)):
 			raise EvaluationError('Attempted to extract head of non-list')
 		self.push(value.head)
 
-	async def inst_list_extract_rest(self):
+	def inst_list_extract_rest(self):
 		value = self.pop()
 		if not isinstance(value, (functions.ListBase, functions.Array)):
 			raise EvaluationError('Attempted to extract tail of non-list')
 		self.push(value.rest)
 
-	async def inst_list_prepend(self):
+	def inst_list_prepend(self):
 		new = self.pop()
 		lst = self.pop()
 		if not isinstance(lst, functions.ListBase):
 			raise EvaluationError('Attempt to prepend to start of non-list')
 		self.push(functions.List(new, lst))
 
-	async def inst_push_error_stopgap(self):
+	def inst_push_error_stopgap(self):
 		handler_segment, handler_address = self.next()
 		should_pass = self.next()
-		self.push(ErrorStopGap(handler_segment, handler_address, should_pass))
+		depth = 0 if self.profiler is None else self.profiler.depth
+		self.push(ErrorStopGap(handler_segment, handler_address, should_pass, depth))
 
-	async def call_builtin_function(self, function, arguments, return_to):
+	def call_builtin_function(self, function, arguments, return_to):
+		''' Call a builtin function. Coroutine builtins return an awaitable
+			that must be waited on before execution can continue.
+		'''
+		if isinstance(function, BuiltinFunction) and function.is_coroutine:
+			return self.call_builtin_coroutine(function, arguments, return_to)
 		try:
-			if isinstance(function, BuiltinFunction) and function.is_coroutine:
-				result = await function(*arguments)
-			else:
-				result = function(*arguments)
+			result = function(*map(operators.to_sympy, arguments))
 		except Exception:
-			# arg = arguments if len(arguments)
-			# pylint: disable=raising-format-tuple
-			if not arguments:
-				raise EvaluationError('Failed to call {} with no arguments.', function)
-			elif len(arguments) == 1:
-				raise EvaluationError('Failed to call {} on {}', function, arguments[0])
-			else:
-				raise EvaluationError('Failed to call {} on {}', function, arguments)
+			raise_builtin_failure(function, arguments)
 		except EvaluationError:
 			raise
 		self.push(result)
 		self.bytes, self.place = return_to
+		self.place -= 1 # Negate the +1 after this
 
-	async def call_function(self, function, arguments, return_to, disable_cache=False, macro_unprepped=False, do_tco=False):
+	async def call_builtin_coroutine(self, function, arguments, return_to):
+		values = list(map(operators.to_sympy, arguments))
+		uses_interpereter = getattr(function.func, 'uses_interpereter', False)
+		meter = self.usage
+		if uses_interpereter:
+			values.insert(0, self)
+			# These do their work in Python on behalf of the command,
+			# so the time they take is charged to it like any other
+			meter.resume()
+		try:
+			result = await function(*values)
+			if uses_interpereter:
+				self.check_quota(meter, 0)
+		except EvaluationError:
+			raise
+		except Exception:
+			raise_builtin_failure(function, arguments)
+		finally:
+			if uses_interpereter:
+				meter.pause()
+		self.push(result)
+		self.bytes, self.place = return_to
+		self.place -= 1 # Negate the +1 after this
+
+	def call_function(self, function, arguments, return_to, disable_cache=False, macro_unprepped=False, do_tco=False):
 		if isinstance(function, (BuiltinFunction, Array, Interval, SingularValue)):
-			await self.call_builtin_function(function, arguments, return_to)
+			return self.call_builtin_function(function, arguments, return_to)
 		elif isinstance(function, Function):
 			inspector = FunctionInspector(self, function)
 			need_to_call = True
-			if not disable_cache:
-				cache_key = tuple([function] + arguments)
-				if not inspector.is_macro and cache_key in self.calling_cache:
-					self.push(self.calling_cache[cache_key])
+			cache_key = None
+			if not disable_cache and not inspector.is_macro and self.calling_cache.should_cache(function):
+				cache_key = CacheKey(function, arguments)
+				result = self.calling_cache.lookup(cache_key)
+				if result is not CACHE_MISS:
+					self.push(result)
 					self.bytes, self.place = return_to
 					need_to_call = False
 			if need_to_call:
@@ -747,27 +1469,41 @@ class Interpereter:
 					self.push(self.current_scope)
 					# For normal functions, the last thing that happens is that the result is
 					# stored in a cache. Need the key in order to do that.
-					self.push(None if disable_cache or inspector.is_macro else cache_key)
+					self.push(cache_key)
 				# Enter the function
+				if self.profiler is not None:
+					self.profiler.enter(inspector.name, tail=do_tco)
+				segment = inspector.code_segment
+				self.count_segment_call(segment, inspector.code_address)
 				self.current_scope = new_scope
-				self.bytes = inspector.code_segment
+				self.bytes = segment
 				self.place = inspector.code_address
 		else:
 			raise EvaluationError('{} is not a function', function)
 		self.place -= 1 # Negate the +1 after this
 
+	def count_segment_call(self, segment, code_address):
+		''' Keep track of how many times a segment is entered,
+			and compile it once it has been used enough.
+		'''
+		if segment.threaded is None and self.compile_threshold is not None:
+			segment.call_count += 1
+			if segment.call_count > self.compile_threshold:
+				segment.threaded = ThreadedCode(segment, code_address, self.switch_dictionary)
+
 	def get_memory_usage(self):
 		return deep_getsizeof(self)
 
 
 class FrozenState:
 
-	__slots__ = ['place', 'stack', 'current_scope']
+	''' The values of the global variables, and how they're protected '''
+
+	__slots__ = ['values', 'security']
 
-	def __init__(self, interpereter: Interpereter):
-		self.place = interpereter.place
-		self.stack = interpereter.stack[:]
-		self.current_scope = interpereter.current_scope
+	def __init__(self, values, security):
+		self.values = list(values)
+		self.security = None if security is None else list(security)
 
 
 def test(string):
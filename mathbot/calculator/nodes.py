@@ -0,0 +1,232 @@
+''' Nodes of the abstract syntax tree
+
+	The parser produces a tree of these, which is described in ast.md.
+	Nodes can be indexed in the same way as the dictionaries that the
+	AST used to be made of, where node['#'] is the type of the node,
+	and they can be converted to and from JSON in that same format.
+
+	Each type of node has a fixed set of fields, which are stored in
+	slots. Fields that haven't been given a value are None, and are
+	left out of the JSON.
+'''
+
+
+class Source:
+
+	''' The code that a token came from '''
+
+	__slots__ = ['name', 'code']
+
+	def __init__(self, name, code):
+		self.name = name
+		self.code = code
+
+
+class Node:
+
+	__slots__ = []
+	tag = None
+	fields = ()
+
+	def __init__(self, **values):
+		for field in self.fields:
+			setattr(self, field, values.pop(field, None))
+		if values:
+			raise TypeError('Unknown fields for {} node: {}'.format(self.tag, ', '.join(values)))
+
+	def __getitem__(self, key):
+		if key == '#':
+			return self.tag
+		value = getattr(self, key) if key in self.fields else None
+		if value is None:
+			raise KeyError(key)
+		return value
+
+	def __setitem__(self, key, value):
+		if key not in self.fields:
+			raise KeyError(key)
+		setattr(self, key, value)
+
+	def __contains__(self, key):
+		return self.get(key) is not None
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def replace(self, **changes):
+		''' Create a copy of the node with some fields changed.
+			If nothing actually changed the original node is returned.
+		'''
+		if all(getattr(self, key) is value for key, value in changes.items()):
+			return self
+		copy = self.__class__.__new__(self.__class__)
+		for field in self.fields:
+			setattr(copy, field, changes.get(field, getattr(self, field)))
+		return copy
+
+	def to_json(self):
+		result = {'#': self.tag}
+		for field in self.fields:
+			value = getattr(self, field)
+			if value is not None:
+				result[field] = to_json(value)
+		return result
+
+	def __repr__(self):
+		return '<{} node>'.format(self.tag)
+
+
+class Token(Node):
+
+	''' A single token, which is also the node for words and constants.
+		The type of the token is the type of the node.
+	'''
+
+	__slots__ = ['tag', 'string', 'position', 'index', 'origin']
+	fields = ('string', 'position', 'index')
+
+	def __init__(self, tag, string, position=None, origin=None, index=None):
+		self.tag = tag
+		self.string = string
+		self.position = position
+		self.origin = origin
+		self.index = index
+
+	@property
+	def source(self):
+		''' Location of the token, used to link errors back to the code '''
+		if self.origin is None:
+			return None
+		return {
+			'name': self.origin.name,
+			'code': self.origin.code,
+			'position': self.position
+		}
+
+	def __getitem__(self, key):
+		if key == '#':
+			return self.tag
+		if key == 'source':
+			value = self.source
+		else:
+			value = getattr(self, key) if key in self.fields else None
+		if value is None:
+			raise KeyError(key)
+		return value
+
+	def replace(self, **changes):
+		if not changes:
+			return self
+		raise TypeError('Tokens cannot be changed')
+
+	def to_json(self):
+		result = {'#': self.tag, 'string': self.string}
+		if self.position is not None:
+			result['position'] = self.position
+		if self.origin is not None:
+			result['source'] = self.source
+		if self.index is not None:
+			result['index'] = self.index
+		return result
+
+	def __repr__(self):
+		return '<{} token {!r}>'.format(self.tag, self.string)
+
+
+NODE_TYPES = {}
+
+
+def node_type(name, tag, fields):
+	''' Create the class for a type of node. The constructor is generated
+		so that it assigns each field directly, since the parser creates
+		a lot of nodes.
+	'''
+	source = 'def __init__(self{}):{}'.format(
+		''.join(', {}=None'.format(i) for i in fields),
+		''.join('\n\tself.{0} = {0}'.format(i) for i in fields) or '\n\tpass'
+	)
+	namespace = {}
+	exec(source, namespace)
+	cls = type(name, (Node,), {
+		'__slots__': list(fields),
+		'__qualname__': name,
+		'__module__': __name__,
+		'__init__': namespace['__init__'],
+		'tag': tag,
+		'fields': tuple(fields)
+	})
+	NODE_TYPES[tag] = cls
+	return cls
+
+
+BinaryOperator = node_type('BinaryOperator', 'bin_op', ['operator', 'left', 'right', 'token'])
+PercentOperator = node_type('PercentOperator', 'percent_op', ['value', 'token'])
+UnaryMinus = node_type('UnaryMinus', 'uminus', ['value', 'token'])
+Not = node_type('Not', 'not', ['expression', 'token'])
+Factorial = node_type('Factorial', 'factorial', ['value', 'token'])
+Head = node_type('Head', 'head', ['expression', 'token'])
+Tail = node_type('Tail', 'tail', ['expression', 'token'])
+FunctionCall = node_type('FunctionCall', 'function_call', ['function', 'arguments'])
+Parameters = node_type('Parameters', 'parameters', ['items', 'edges'])
+ListLiteral = node_type('ListLiteral', 'list_literal', ['items', 'edges'])
+Comparison = node_type('Comparison', 'comparison', ['first', 'rest'])
+FunctionDefinition = node_type('FunctionDefinition', 'function_definition',
+	['parameters', 'kind', 'expression', 'variadic', 'token', 'name'])
+Assignment = node_type('Assignment', 'assignment', ['variable', 'value'])
+DeclareSymbol = node_type('DeclareSymbol', 'declare_symbol', ['name'])
+UnloadGlobal = node_type('UnloadGlobal', 'unload_global', ['variable'])
+Program = node_type('Program', 'program', ['items'])
+End = node_type('End', 'end', [])
+# A value that has already been worked out, such as a folded constant
+Constant = node_type('Constant', '_exact_item_hack', ['value'])
+
+
+def to_json(value):
+	''' Convert an AST (or part of one) into dicts and lists '''
+	if isinstance(value, Node):
+		return value.to_json()
+	if isinstance(value, list):
+		return [to_json(i) for i in value]
+	if isinstance(value, dict):
+		return {k: to_json(v) for k, v in value.items()}
+	return value
+
+
+def from_json(value, sources=None):
+	''' Convert the output of to_json back into nodes '''
+	if sources is None:
+		sources = {}
+	if isinstance(value, list):
+		return [from_json(i, sources) for i in value]
+	if not isinstance(value, dict):
+		return value
+	tag = value.get('#')
+	if tag is None:
+		# Parts of nodes that don't have a type, like the edges of argument lists
+		return {k: from_json(v, sources) for k, v in value.items()}
+	# Some tokens have the same type as a node, such as ->, but only tokens have strings
+	if 'string' in value:
+		origin = None
+		source = value.get('source')
+		if source is not None:
+			key = (source['name'], source['code'])
+			origin = sources.get(key)
+			if origin is None:
+				origin = sources[key] = Source(*key)
+		return Token(tag, value['string'], value.get('position'), origin, value.get('index'))
+	return NODE_TYPES[tag](**{k: from_json(v, sources) for k, v in value.items() if k != '#'})
+
+
+def visitor_table(cls, prefix):
+	''' Map node types to the methods of a class that handle them,
+		which are named with a prefix followed by the type.
+	'''
+	table = {}
+	for klass in reversed(cls.__mro__):
+		for name, function in vars(klass).items():
+			if name.startswith(prefix) and callable(function):
+				table[name[len(prefix):]] = function
+	return table
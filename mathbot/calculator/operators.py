@@ -48,6 +48,32 @@ async def super_more_than(a, b):
 async def super_more_eq(a, b):
 	return (await super_equals(a, b)) or (await super_less_than(b, a))
 
+# Syncronous versions of the above. These produce the same results
+# but can only be used when neither of the operands are asyncronous
+# comparables (check with needs_async_comparison first).
+
+def needs_async_comparison(a, b):
+	return hasattr(a, '__aeq__') or hasattr(b, '__aeq__') \
+		or hasattr(a, '__alt__') or hasattr(b, '__alt__')
+
+def sync_equals(a, b):
+	return rectify_bool(a == b)
+
+def sync_not_equals(a, b):
+	return not sync_equals(a, b)
+
+def sync_less_than(a, b):
+	return rectify_bool(a < b)
+
+def sync_less_eq(a, b):
+	return sync_equals(a, b) or sync_less_than(a, b)
+
+def sync_more_than(a, b):
+	return sync_less_than(b, a)
+
+def sync_more_eq(a, b):
+	return sync_equals(a, b) or sync_less_than(b, a)
+
 
 class Overloadable:
 
@@ -68,6 +94,10 @@ class Overloadable:
 			return function
 		return applier
 
+	def find(self, *args):
+		''' Get the function for some arguments, or None if there isn't one '''
+		return self.dict.get(tuple(i.__class__ for i in args))
+
 	def __call__(self, *args):
 		types = tuple(i.__class__ for i in args)
 		try:
@@ -90,52 +120,146 @@ def compose(*functions):
 	return composed
 
 
+# Numeric tower
+#
+# Integers and rationals are kept as native Python numbers (or gmpy2
+# rationals, if it is installed) rather than sympy objects, since
+# arithmetic on them is much faster. Anything else, including floats,
+# symbolic values, and results that aren't rational, is handled by sympy.
+# The native operations check how large the result will be before doing
+# any work, and defer to sympy if it would have more than DIGITS_LIMIT
+# digits, so the results are the same as if sympy had been used for
+# everything.
+
+try:
+	from gmpy2 import mpq as NativeRational
+except ImportError:
+	from fractions import Fraction as NativeRational
+
+NATIVE_BITS_LIMIT = int(DIGITS_LIMIT * math.log2(10))
+NATIVE = [int, NativeRational]
+NATIVE_CLASSES = frozenset(NATIVE)
+
+
+def is_native(x):
+	return x.__class__ in NATIVE_CLASSES
+
+
+def native_bits(x):
+	if x.__class__ is int:
+		return x.bit_length()
+	return max(int(x.numerator).bit_length(), int(x.denominator).bit_length())
+
+
+def normalise(x):
+	''' Rationals that are whole numbers are stored as integers '''
+	if x.__class__ is not int and x.denominator == 1:
+		return int(x.numerator)
+	return x
+
+
+def to_sympy(x):
+	cls = x.__class__
+	if cls is int:
+		return sympy.Integer(x)
+	if cls is NativeRational:
+		return sympy.Rational(int(x.numerator), int(x.denominator))
+	return x
+
+
+def to_native(x):
+	''' Convert sympy rationals to native numbers, if they're not too large '''
+	if isinstance(x, sympy.Rational):
+		if x.q == 1:
+			value = int(x.p)
+		else:
+			value = NativeRational(int(x.p), int(x.q))
+		if native_bits(value) <= NATIVE_BITS_LIMIT:
+			return value
+	return x
+
+
 def cap_integer_size(x):
 	if isinstance(x, int) and abs(x) > MAXIMUM_INTEGER:
 		raise errors.EvaluationError('Integer overflow')
 	return x
 
 
+def too_large(a, b):
+	''' Whether an operation on two native numbers could produce a
+		result with more than DIGITS_LIMIT digits. This is checked before
+		the operation is done, and the native overloads below return
+		NotImplemented if it's the case, leaving the work to sympy.
+	'''
+	if a.__class__ is int and b.__class__ is int:
+		return a.bit_length() + b.bit_length() > NATIVE_BITS_LIMIT
+	return native_bits(a) + native_bits(b) > NATIVE_BITS_LIMIT
+
+
+# Each operator has overloads for native numbers first, which are what
+# the interpereter uses (see exact_operation), followed by the ones for
+# floats and complex numbers. The first overload for a pair of types wins.
+
 operator_add = Overloadable('Cannot add {0} to {1}')
+
+@operator_add.overload(NATIVE, NATIVE)
+def add_native(a, b):
+	if too_large(a, b):
+		return NotImplemented
+	return normalise(a + b)
+
 operator_add.overload(COMPLEX, COMPLEX)(compose(cap_integer_size, operator.add))
 
 operator_subtract = Overloadable('Cannot subtract {1} from {0}')
+
+@operator_subtract.overload(NATIVE, NATIVE)
+def subtract_native(a, b):
+	if too_large(a, b):
+		return NotImplemented
+	return normalise(a - b)
+
 operator_subtract.overload(COMPLEX, COMPLEX)(compose(cap_integer_size, operator.sub))
 
 operator_multiply = Overloadable('Cannot multiply {0} and {1}')
 
 @operator_multiply.overload(int, int)
 def multiply_ints(a, b):
-	try:
-		if a != 0 and b != 0:
-			result_length = math.log10(abs(a)) + math.log10(abs(b))
-			if result_length > DIGITS_LIMIT:
-				return float(a) * float(b)
-		return cap_integer_size(a * b)
-	except OverflowError:
-		raise errors.EvaluationError('Cannot multiply {} and {}. Result too large.'.format(a, b))
+	if too_large(a, b):
+		return NotImplemented
+	return a * b
+
+@operator_multiply.overload(NATIVE, NATIVE)
+def multiply_native(a, b):
+	if too_large(a, b):
+		return NotImplemented
+	return normalise(a * b)
+
 operator_multiply.overload(COMPLEX, COMPLEX)(operator.mul)
 
 operator_modulo = Overloadable('Cannot perform modulo on {0} and {1}')
-@operator_modulo.overload(int, int)
+
+@operator_modulo.overload(NATIVE, NATIVE)
 def modulo_ints(a, b):
-	try:
-		return a % b
-	except (ZeroDivisionError, TypeError):
-		raise errors.EvaluationError('Cannot divide {} by {}'.format(a, b))
+	if b == 0 or too_large(a, b):
+		return NotImplemented
+	return normalise(a % b)
 
 operator_division = Overloadable('Cannot divide {0} by {1}')
 
 @operator_division.overload(int, int)
 def divison(a, b):
-	try:
-		if a % b == 0:
-			return a // b
-		return a / b
-	except (ZeroDivisionError, TypeError):
-		raise errors.EvaluationError('Cannot divide {} by {}'.format(a, b))
-	except OverflowError:
-		raise errors.EvaluationError('Diving {} by {} caused an overflow'.format(a, b))
+	# Division by zero produces complex infinity, which is left to sympy
+	if b == 0 or too_large(a, b):
+		return NotImplemented
+	if a % b == 0:
+		return a // b
+	return NativeRational(a, b)
+
+@operator_division.overload(NATIVE, NATIVE)
+def divison(a, b):
+	if b == 0 or too_large(a, b):
+		return NotImplemented
+	return normalise(NativeRational(a) / b)
 
 @operator_division.overload(COMPLEX, COMPLEX)
 def divison(a, b):
@@ -148,20 +272,23 @@ def divison(a, b):
 
 operator_power = Overloadable('Cannot raise {0} to the power of {1}')
 
-@operator_power.overload(int, int)
+@operator_power.overload(NATIVE, int)
 def power_int(base, exponent):
-	if base == 0 and exponent == 0:
-		raise errors.EvaluationError('Cannot raise 0 to the power of 0')
-	if base == 0:
-		return 0
-	try:
-		result_length = abs(exponent * math.log10(abs(base)))
-		if result_length > DIGITS_LIMIT:
-			return float(base) ** float(exponent)
-		result = base ** exponent
-		return cap_integer_size(result)
-	except OverflowError:
-		raise errors.EvaluationError('Overflow while calculating exponential')
+	# Rational exponents usually produce irrational results, so they
+	# aren't handled here. Zero to a negative power is complex infinity.
+	if base == 0 and exponent < 0:
+		return NotImplemented
+	if base in (0, 1, -1):
+		if exponent == 0:
+			return 1
+		if base == -1:
+			return 1 if exponent % 2 == 0 else -1
+		return int(base)
+	if native_bits(base) * abs(exponent) > NATIVE_BITS_LIMIT:
+		return NotImplemented
+	if exponent < 0:
+		return normalise(1 / NativeRational(base) ** -exponent)
+	return base ** exponent
 
 @operator_power.overload(NUMBER, NUMBER)
 def power_float(base, exponent):
@@ -249,3 +376,44 @@ function_lcm = Overloadable('Cannot get the lowest common multiple of {0} and {1
 @function_lcm.overload(int, int)
 def f_lcm(a, b):
 	return (a * b) // math.gcd(a, b)
+
+
+def try_native(operation, a, b):
+	''' Attempt to perform an operation (one of the operator_*
+		dispatchers) on native numbers. Sympy rationals are converted to
+		native numbers if the other operand is native. Returns
+		NotImplemented if it can't be done.
+	'''
+	types = (a.__class__, b.__class__)
+	if types[0] not in NATIVE_CLASSES or types[1] not in NATIVE_CLASSES:
+		if not (is_native(a) or is_native(b)):
+			return NotImplemented
+		a = to_native(a)
+		b = to_native(b)
+		if not (is_native(a) and is_native(b)):
+			return NotImplemented
+		types = (a.__class__, b.__class__)
+	function = operation.dict.get(types)
+	if function is None:
+		return NotImplemented
+	return function(a, b)
+
+
+def exact_operation(native, general):
+	''' Create an operator that uses one of the operator_* dispatchers
+		for native numbers if it can, and the general one (on sympy
+		values) otherwise.
+	'''
+	def operation(a, b):
+		result = try_native(native, a, b)
+		if result is NotImplemented:
+			return general(to_sympy(a), to_sympy(b))
+		return result
+	return operation
+
+
+exact_add = exact_operation(operator_add, operator.add)
+exact_subtract = exact_operation(operator_subtract, operator.sub)
+exact_multiply = exact_operation(operator_multiply, operator.mul)
+exact_division = exact_operation(operator_division, operator.truediv)
+exact_modulo = exact_operation(operator_modulo, operator.mod)
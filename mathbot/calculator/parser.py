@@ -2,6 +2,9 @@ import json
 import re
 import enum
 
+from . import nodes
+from .nodes import Token
+
 
 class DelimitedBinding(enum.Enum):
 	DONT_PROCESS     = 0
@@ -66,12 +69,20 @@ class UnexpectedLackOfToken(ParseFailedBlock): pass
 class DeprecatedSyntax(ParseFailedBlock): pass
 
 
+class NestingTooDeep(ParseFailed):
+
+	details = 'Expression is nested too deeply'
+
+	def __init__(self, token):
+		self.position = token.position
+
+
 class ImbalancedBraces(ParseFailed):
 
 	details = 'Imbalanced braces'
 
 	def __init__(self, token):
-		self.position = token['position']
+		self.position = token.position
 
 
 class TokenizationFailed(Exception):
@@ -87,6 +98,7 @@ class TokenRoot:
 	def __init__(self, string, original_tokens, nested_tokens):
 		self.string = string
 		self.rightmost = -1
+		self.depth = 0
 		self.original_tokens = original_tokens
 		self.tokens = self.process_nested_tokens(nested_tokens)
 
@@ -106,7 +118,7 @@ class TokenRoot:
 		# print(place)
 		# for i, v in enumerate(self.original_tokens):
 		# 	print('>>>' if i == place else '   ', v)
-		return self.original_tokens[place]['position']
+		return self.original_tokens[place].position
 
 
 class TokenBlock:
@@ -116,7 +128,7 @@ class TokenBlock:
 		self.values = values
 		self.root = root
 		self.edge_tokens = edge_tokens
-		self.edge_type = bracket_type(edge_tokens[0]['string'])
+		self.edge_type = bracket_type(edge_tokens[0].string)
 
 	@property
 	def edge_start(self):
@@ -130,7 +142,7 @@ class TokenBlock:
 		self.place += 1
 		token = self.values[self.place - 1]
 		if not isinstance(token, TokenBlock):
-			self.root.update_rightmost(token['index'])
+			self.root.update_rightmost(token.index)
 		return token
 
 	def details(self, index = 0):
@@ -144,8 +156,8 @@ class TokenBlock:
 			t = self.values[self.place + index]
 			if isinstance(t, TokenBlock):
 				return t.edge_type in valids or TokenBlock in valids
-			elif isinstance(t, dict):
-				return t['#'] in valids
+			elif isinstance(t, Token):
+				return t.tag in valids
 
 	def peek_sequence(self, index, *sequence):
 		for offset, item in enumerate(sequence):
@@ -156,8 +168,8 @@ class TokenBlock:
 	def peek_string(self, index, *valids):
 		if self.place + index < len(self.values):
 			t = self.values[self.place + index]
-			if isinstance(t, dict):
-				return t['string'] in valids
+			if isinstance(t, Token):
+				return t.string in valids
 
 	def peek_and_eat(self, index, *valids):
 		assert index == 0
@@ -175,8 +187,28 @@ class TokenBlock:
 		return self.place >= len(self.values)
 
 
+# The parser never goes back over tokens that it has already consumed.
+# Every choice between rules is made by peeking at the next few tokens,
+# so the time taken is linear in the number of tokens. The only other
+# thing that can go wrong is running out of stack, so the number of
+# things that can be nested inside each other is limited. Each level
+# of brackets uses about 25 stack frames.
+MAXIMUM_NESTING_DEPTH = 32
+
+
+def nested(rule, tokens):
+	''' Apply a rule to something that is nested inside another expression '''
+	root = tokens.root
+	if root.depth >= MAXIMUM_NESTING_DEPTH:
+		raise NestingTooDeep(root.original_tokens[root.rightmost + 1])
+	root.depth += 1
+	result = rule(tokens)
+	root.depth -= 1
+	return result
+
+
 def ensure_completed(function, tokens):
-	result = function(tokens)
+	result = nested(function, tokens)
 	if not tokens.is_complete():
 		raise UnableToFinishParsing(tokens)
 	return result
@@ -194,6 +226,8 @@ def eat_delimited(subrule, delimiters, binding, type, allow_nothing = False, alw
 	if not isinstance(binding, DelimitedBinding):
 		raise ValueError('{} is not a valid rule for binding'.format(binding))
 
+	node_class = nodes.NODE_TYPES[type]
+
 	def internal(tokens):
 		listing = []
 		if tokens.is_complete():
@@ -207,41 +241,33 @@ def eat_delimited(subrule, delimiters, binding, type, allow_nothing = False, alw
 		if len(listing) == 1 and not always_package:
 			return listing[0]
 		if binding == DelimitedBinding.DONT_PROCESS:
-			return {
-				'#': type,
-				'items': listing
-			}
+			return node_class(items=listing)
 		elif binding == DelimitedBinding.DROP_AND_FLATTEN:
-			return {
-				'#': type,
-				'items': listing[::2]
-			}
+			return node_class(items=listing[::2])
 		elif binding == DelimitedBinding.LEFT_FIRST:
 			listing = list(listing[::-1])
 			value = listing.pop()
 			while listing:
 				delimiter = listing.pop()
 				right = listing.pop()
-				value = {
-					'#': type,
-					'operator': delimiter['string'],
-					'left': value,
-					'right': right,
-					'token': delimiter
-				}
+				value = node_class(
+					operator=delimiter.string,
+					left=value,
+					right=right,
+					token=delimiter
+				)
 			return value
 		elif binding == DelimitedBinding.RIGHT_FIRST:
 			value = listing.pop()
 			while listing:
 				delimiter = listing.pop()
 				left = listing.pop()
-				value = {
-					'#': type,
-					'operator': delimiter['string'],
-					'left': left,
-					'right': value,
-					'token': delimiter
-				}
+				value = node_class(
+					operator=delimiter.string,
+					left=left,
+					right=value,
+					token=delimiter
+				)
 			return value
 
 	internal.__name__ = 'eat_delimited___' + type
@@ -253,6 +279,8 @@ def eat_optionally_delimited(subrule, delimiters, binding, type, allow_nothing =
 	if not isinstance(binding, DelimitedBinding):
 		raise ValueError('{} is not a valid rule for binding'.format(binding))
 
+	node_class = nodes.NODE_TYPES[type]
+
 	def internal(tokens):
 		listing = []
 		if tokens.is_complete():
@@ -267,28 +295,17 @@ def eat_optionally_delimited(subrule, delimiters, binding, type, allow_nothing =
 		if len(listing) == 1 and not always_package:
 			return listing[0]
 		if binding == DelimitedBinding.DONT_PROCESS or binding == DelimitedBinding.DROP_AND_FLATTEN:
-			return {
-				'#': type,
-				'items': listing
-			}
+			return node_class(items=listing)
 		elif binding == DelimitedBinding.LEFT_FIRST:
 			listing = list(listing[::-1])
 			value = listing.pop()
 			while listing:
-				value = {
-					'#': type,
-					'left': value,
-					'right': listing.pop()
-				}
+				value = node_class(left=value, right=listing.pop())
 			return listing
 		elif binding == DelimitedBinding.RIGHT_FIRST:
 			value = listing.pop()
 			while listing:
-				value = {
-					'#': type,
-					'left': listing.pop(),
-					'right': value
-				}
+				value = node_class(left=listing.pop(), right=value)
 			return listing
 
 	internal.__name__ == 'eat_optionally_delimited__' + type
@@ -303,11 +320,10 @@ def atom(tokens):
 
 def percentage(tokens):
 	if tokens.peek_sequence(0, 'number', 'percent_op'):
-		return {
-			'#': 'percent_op',
-			'value': atom(tokens),
-			'token': tokens.eat_details()
-		}
+		return nodes.PercentOperator(
+			value=atom(tokens),
+			token=tokens.eat_details()
+		)
 	return atom(tokens)
 
 
@@ -318,9 +334,7 @@ def word(tokens):
 
 
 def list_literal(tokens):
-	r = _argument_list(tokens)
-	r['#'] = 'list_literal'
-	return r
+	return nodes.ListLiteral(items=_argument_list(tokens).items)
 
 
 def wrapped_expression(tokens):
@@ -342,38 +356,34 @@ def function_call(tokens):
 		calls.append(ensure_completed(argument_list, tokens.eat_details()))
 	calls = calls[::-1]
 	while calls:
-		value = {
-			'#': 'function_call',
-			'function': value,
-			'arguments': calls.pop()
-		}
+		value = nodes.FunctionCall(
+			function=value,
+			arguments=calls.pop()
+		)
 	return value
 
 
 def operator_list_extract(tokens):
 	if tokens.peek(0, 'head_op'):
-		return {
-			'#': 'head',
-			'token': tokens.eat_details(),
-			'expression': expect(tokens, operator_list_extract)
-		}
+		return nodes.Head(
+			token=tokens.eat_details(),
+			expression=nested(operator_list_extract, tokens)
+		)
 	if tokens.peek(0, 'tail_op'):
-		return {
-			'#': 'tail',
-			'token': tokens.eat_details(),
-			'expression': expect(tokens, operator_list_extract)
-		}
+		return nodes.Tail(
+			token=tokens.eat_details(),
+			expression=nested(operator_list_extract, tokens)
+		)
 	return function_call(tokens)
 
 
 def logic_not(tokens):
 	if tokens.peek(0, 'bang'):
 		token = tokens.eat_details()
-		return {
-			'#': 'not',
-			'token': token,
-			'expression': expect(tokens, logic_not)
-		}
+		return nodes.Not(
+			token=token,
+			expression=nested(logic_not, tokens)
+		)
 	return operator_list_extract(tokens)
 
 
@@ -381,11 +391,10 @@ def factorial(tokens):
 	value = logic_not(tokens)
 	while tokens.peek(0, 'bang'):
 		token = tokens.eat_details()
-		value = {
-			'#': 'factorial',
-			'token': token,
-			'value': value
-		}
+		value = nodes.Factorial(
+			token=token,
+			value=value
+		)
 	return value
 
 
@@ -406,17 +415,12 @@ def superscript(tokens):
 	result = factorial(tokens)
 	while tokens.peek(0, 'superscript'):
 		tok = tokens.eat_details()
-		result = {
-			'#': 'bin_op',
-			'operator': '^',
-			'token': tok,
-			'left': result,
-			'right': {
-				'#': 'number',
-				'string': tok['string'].translate(SUPERSCRIPT_MAP),
-				'position': tok['position']
-			}
-		}
+		result = nodes.BinaryOperator(
+			operator='^',
+			token=tok,
+			left=result,
+			right=Token('number', tok.string.translate(SUPERSCRIPT_MAP), tok.position)
+		)
 	return result
 
 
@@ -444,7 +448,7 @@ def parameter_list(tokens):
 	is_variadic = False
 	if tokens.peek_and_eat(0, 'period'):
 		is_variadic = True
-	return {'#': 'parameters', 'items': params}, is_variadic
+	return nodes.Parameters(items=params), is_variadic
 
 
 _argument_list = eat_optionally_delimited(expression,
@@ -459,7 +463,7 @@ _argument_list = eat_optionally_delimited(expression,
 def argument_list(tokens):
 	result = _argument_list(tokens)
 	if result is not None:
-		result['edges'] = {
+		result.edges = {
 			'start': tokens.edge_start,
 			'end': tokens.edge_end
 		}
@@ -470,24 +474,22 @@ def power(tokens):
 	left = superscript(tokens)
 	if tokens.peek(0, 'pow_op'):
 		t = tokens.eat_details()
-		return {
-			'#': 'bin_op',
-			'operator': '^',
-			'token': t,
-			'left': left,
-			'right': expect(tokens, uminus)
-		}
+		return nodes.BinaryOperator(
+			operator='^',
+			token=t,
+			left=left,
+			right=nested(uminus, tokens)
+		)
 	return left
 
 
 def uminus(tokens):
 	if tokens.peek_string(0, '-'):
 		t = tokens.eat_details()
-		return {
-			'#': 'uminus',
-			'token': t,
-			'value': expect(tokens, uminus)
-		}
+		return nodes.UnaryMinus(
+			token=t,
+			value=nested(uminus, tokens)
+		)
 	return power(tokens)
 
 
@@ -499,16 +501,15 @@ addition  = eat_delimited(product,   ['add_op'],  DelimitedBinding.LEFT_FIRST,
 def comparison_list(tokens):
 	result = addition(tokens)
 	if result and tokens.peek(0, 'comp_op'):
-		result = {
-			'#': 'comparison',
-			'first': result,
-			'rest': [],
-		}
+		result = nodes.Comparison(
+			first=result,
+			rest=[]
+		)
 		while tokens.peek(0, 'comp_op'):
 			token = tokens.eat_details()
 			value = addition(tokens)
-			result['rest'].append({
-				'operator': token['string'],
+			result.rest.append({
+				'operator': token.string,
 				'token': token,
 				'value': value
 			})
@@ -525,23 +526,19 @@ def function_definition(tokens, delimiter):
 		if tokens.peek(0, BracketType.ROUND):
 			args, is_variadic = ensure_completed(parameter_list, tokens.eat_details())
 		elif tokens.peek(0, 'word'):
-			args = {
-				'#': 'parameters',
-				'items': [tokens.eat_details()]
-			}
+			args = nodes.Parameters(items=[tokens.eat_details()])
 			is_variadic = False
 		else:
 			raise UnableToFinishParsing(tokens)
 		kind = tokens.eat_details()
-		expr = expression(tokens)
-		return {
-			'#': 'function_definition',
-			'parameters': args,
-			'kind': kind['string'],
-			'expression': expr,
-			'variadic': is_variadic,
-			'token': kind
-		}
+		expr = nested(expression, tokens)
+		return nodes.FunctionDefinition(
+			parameters=args,
+			kind=kind.string,
+			expression=expr,
+			variadic=is_variadic,
+			token=kind
+		)
 	return prepend_op(tokens)
 
 
@@ -550,25 +547,18 @@ def statement(tokens):
 		name = word(tokens)
 		tokens.eat_details()
 		value = expression(tokens)
-		return {
-			'#': 'assignment',
-			'variable': name,
-			'value': value
-		}
+		return nodes.Assignment(
+			variable=name,
+			value=value
+		)
 	elif tokens.peek(0, 'kw_symbol'):
 		tokens.eat_details()
 		name = word(tokens)
-		return {
-			'#': 'declare_symbol',
-			'name': name
-		}
+		return nodes.DeclareSymbol(name=name)
 	elif tokens.peek(0, 'kw_unload'):
 		tokens.eat_details()
 		name = word(tokens)
-		return {
-			'#': 'unload_global',
-			'variable': name
-		}
+		return nodes.UnloadGlobal(variable=name)
 	elif tokens.peek_sequence(0, 'word', BracketType.ROUND, 'function_definition'):
 		tokens.eat_details()
 		tokens.eat_details()
@@ -576,12 +566,11 @@ def statement(tokens):
 	elif tokens.peek_sequence(0, 'word', BracketType.ROUND, 'assignment'):
 		name = word(tokens)
 		function = function_definition(tokens, 'assignment')
-		function['name'] = name['string']
-		return {
-			'#': 'assignment',
-			'variable': name,
-			'value': function
-		}
+		function.name = name.string
+		return nodes.Assignment(
+			variable=name,
+			value=function
+		)
 	return expression(tokens)
 
 
@@ -593,11 +582,13 @@ def process_tokens(tokens):
 	# Check that the brackets are balanced
 	stack = []
 	for tok in tokens:
-		btype = bracket_type(tok['string'])
+		btype = bracket_type(tok.string)
 		if btype != BracketType.NONE:
-			bdir = bracket_direction(tok['string'])
+			bdir = bracket_direction(tok.string)
 			if bdir == BracketDirection.LEFT:
 				stack.append(btype)
+				if len(stack) >= MAXIMUM_NESTING_DEPTH:
+					raise NestingTooDeep(tok)
 			elif not stack or stack.pop() != btype:
 				raise ImbalancedBraces(tok)
 	if stack:
@@ -610,9 +601,9 @@ def process_tokens(tokens):
 		result = [first_token]
 		while tokens:
 			tok = tokens.pop()
-			if tok['string'] in ['(', '[']:
+			if tok.string in ['(', '[']:
 				result.append(recurse(tok))
-			elif tok['string'] in [')', ']']:
+			elif tok.string in [')', ']']:
 				result.append(tok)
 				break
 			else:
@@ -631,7 +622,7 @@ def run(string):
 		print(' ' * e.position + '^')
 	else:
 		print(result)
-		print(json.dumps(result, indent = 4))
+		print(json.dumps(nodes.to_json(result), indent = 4))
 
 
 def run_script(module):
@@ -642,57 +633,75 @@ def run_script(module):
 	return run(data)
 
 
+class Scanner:
+
+	''' Matches every token type at once with a single regular expression.
+		Each type is wrapped in a lookahead with its own group, so one call
+		to match finds the candidates for all of them. The longest one wins,
+		and ties go to whichever type comes first in the specification.
+	'''
+
+	def __init__(self, ttypes):
+		parts = []
+		self.types = []
+		for index, spec in enumerate(ttypes):
+			name, regex = spec[0], spec[1]
+			replacement = spec[2] if len(spec) == 3 else None
+			parts.append('(?:(?=(?P<t{}>{})))?'.format(index, regex))
+			self.types.append((name, replacement))
+		self.regex = re.compile(''.join(parts))
+		# Position of each candidate in the tuple returned by match.groups()
+		self.groups = [self.regex.groupindex['t{}'.format(i)] - 1 for i in range(len(ttypes))]
+
+	def longest(self, string, position):
+		''' The (name, string, length) of the best token at a position, or None '''
+		found = self.regex.match(string, position).groups()
+		best = None
+		best_length = 0
+		for (name, replacement), group in zip(self.types, self.groups):
+			text = found[group]
+			if text is not None and len(text) > best_length:
+				best = (name, replacement or text)
+				best_length = len(text)
+		if best is None:
+			return None
+		return best[0], best[1], best_length
+
+
+_SCANNERS = {}
+
+
+def get_scanner(ttypes):
+	key = tuple(map(tuple, ttypes))
+	scanner = _SCANNERS.get(key)
+	if scanner is None:
+		scanner = _SCANNERS[key] = Scanner(ttypes)
+	return scanner
+
+
+WHITESPACE = re.compile(r'[ \n]*')
+
+
 def tokenizer(original_string, ttypes, source_name = '__unknown__'):
-	# print(string)
-	regexes = [x if len(x) == 3 else (x[0], x[1], None) for x in ttypes]
-	regexes = list(map(lambda x: (x[0], re.compile(x[1]), x[2]), regexes))
-	result = [{
-		'#': 'pseudotoken-start',
-		'string': '',
-		'position': 0,
-	}]
+	scanner = get_scanner(ttypes)
+	origin = nodes.Source(source_name, original_string)
+	result = [Token('pseudotoken-start', '', 0)]
 	# Hard coded thing here, maybe remove it.
 	string = original_string.replace('\t', ' ')
-	location = 0
-	while len(string) > 0:
-		if string[0] in ' \n':
-			string = string[1:]
-			location += 1
-		else:
-			possible = []
-			for name, cre, replacement in regexes:
-				# print(i)
-				match = cre.match(string)
-				if match is not None:
-					possible.append((name, replacement or match.group()))
-			possible.sort(key = lambda x: len(x[1]), reverse = True)
-			# print(possible)
-			if len(possible) == 0:
-				raise TokenizationFailed(location)
-				# raise TokenizationFailed(original_string, len(original_string) - len(string))
-			# print(possible[0][1])
-			if possible[0][0] == '__illegal__':
-				raise TokenizationFailed(location)
-			if possible[0][0] != '__remove__':
-				result.append({
-					'#': possible[0][0],
-					'string': possible[0][1],
-					'position': location,
-					'source': {
-						'name': source_name,
-						'code': original_string,
-						'position': location
-					}
-				})
-			location += len(possible[0][1])
-			string = string[len(possible[0][1]):]
-	result.append({
-		'#': 'pseudotoken-end',
-		'string': '',
-		'position': len(original_string.rstrip()) + 1
-	})
+	skip_whitespace = WHITESPACE.match
+	longest = scanner.longest
+	location = skip_whitespace(string).end()
+	while location < len(string):
+		token = longest(string, location)
+		if token is None or token[0] == '__illegal__':
+			raise TokenizationFailed(location)
+		name, text, length = token
+		if name != '__remove__':
+			result.append(Token(name, text, location, origin))
+		location = skip_whitespace(string, location + length).end()
+	result.append(Token('pseudotoken-end', '', len(original_string.rstrip()) + 1))
 	for i, v in enumerate(result):
-		v['index'] = i
+		v.index = i
 	return result
 
 TOKEN_SPEC = [
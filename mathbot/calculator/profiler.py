@@ -0,0 +1,185 @@
+''' Profiler for the interpereter
+
+	Counts the ticks and time spent on each kind of instruction, and
+	keeps track of calls, self time and total time for each function.
+	Time is also recorded against the stack of functions that were
+	active, which can be exported in the collapsed stack format that
+	flame graph tools use.
+
+	Profiling is enabled by setting the profiler attribute of an
+	interpereter. While it is enabled, the interpereter doesn't use
+	compiled (closure-threaded) code, so every instruction is seen.
+	Time is measured with a wall clock, but time spent letting other
+	tasks run is not counted.
+'''
+
+import time
+
+
+ROOT_NAME = '<main>'
+
+
+class OpcodeStats:
+
+	__slots__ = ['ticks', 'time']
+
+	def __init__(self):
+		self.ticks = 0
+		self.time = 0
+
+	def __repr__(self):
+		return 'ticks: {}, time: {:.6f}s'.format(self.ticks, self.time)
+
+
+class FunctionStats:
+
+	__slots__ = ['calls', 'ticks', 'self_time', 'total_time']
+
+	def __init__(self):
+		self.calls = 0
+		self.ticks = 0
+		self.self_time = 0
+		self.total_time = 0
+
+	def __repr__(self):
+		return 'calls: {}, ticks: {}, self: {:.6f}s, total: {:.6f}s'.format(
+			self.calls, self.ticks, self.self_time, self.total_time)
+
+
+class Frame:
+
+	__slots__ = ['name', 'path', 'started']
+
+	def __init__(self, name, path, started):
+		self.name = name
+		self.path = path
+		self.started = started
+
+
+class Profiler:
+
+	def __init__(self, clock=time.perf_counter):
+		self.clock = clock
+		self.opcodes = {}
+		self.functions = {}
+		# Maps a stack of function names (joined with ;) to [ticks, time]
+		self.stacks = {}
+		self.frames = []
+		# The number of times each function appears in self.frames, so that
+		# the total time of recursive functions isn't counted more than once.
+		self.active = {}
+		self._root = Frame(ROOT_NAME, ROOT_NAME, None)
+		# Information about the instruction that is currently being run.
+		# The time it takes is only known once the next one starts.
+		self._opcode = None
+		self._frame = None
+		self._started = None
+
+	@property
+	def depth(self):
+		return len(self.frames)
+
+	@property
+	def current_frame(self):
+		return self.frames[-1] if self.frames else self._root
+
+	def instruction(self, opcode):
+		''' Called just before each instruction is run '''
+		now = self.clock()
+		self._finish_instruction(now)
+		frame = self.current_frame
+		self._opcode = opcode
+		self._frame = frame
+		self._started = now
+		stats = self.opcodes.get(opcode)
+		if stats is None:
+			stats = self.opcodes[opcode] = OpcodeStats()
+		stats.ticks += 1
+		self._function_stats(frame.name).ticks += 1
+		self._stack_stats(frame.path)[0] += 1
+
+	def _finish_instruction(self, now):
+		if self._opcode is not None:
+			elapsed = now - self._started
+			self.opcodes[self._opcode].time += elapsed
+			self._function_stats(self._frame.name).self_time += elapsed
+			self._stack_stats(self._frame.path)[1] += elapsed
+			self._opcode = None
+
+	def flush(self):
+		''' Stop timing the current instruction. This is called before
+			control is handed to another task, so that its time isn't
+			counted.
+		'''
+		self._finish_instruction(self.clock())
+
+	def _function_stats(self, name):
+		stats = self.functions.get(name)
+		if stats is None:
+			stats = self.functions[name] = FunctionStats()
+		return stats
+
+	def _stack_stats(self, path):
+		stats = self.stacks.get(path)
+		if stats is None:
+			stats = self.stacks[path] = [0, 0]
+		return stats
+
+	def enter(self, name, tail=False):
+		''' Called when a function is entered. A tail call replaces
+			the function that makes it.
+		'''
+		now = self.clock()
+		if tail and self.frames:
+			self._pop(now)
+		self._function_stats(name).calls += 1
+		self.active[name] = self.active.get(name, 0) + 1
+		self.frames.append(Frame(name, self.current_frame.path + ';' + name, now))
+
+	def leave(self):
+		''' Called when a function returns '''
+		if self.frames:
+			self._pop(self.clock())
+
+	def _pop(self, now):
+		frame = self.frames.pop()
+		count = self.active[frame.name] - 1
+		self.active[frame.name] = count
+		if count == 0:
+			self._function_stats(frame.name).total_time += now - frame.started
+
+	def unwind(self, depth):
+		''' Leave functions until there are only depth left,
+			which happens when an error is caught.
+		'''
+		now = self.clock()
+		while len(self.frames) > depth:
+			self._pop(now)
+
+	def finish(self):
+		''' Called when the interpereter stops running '''
+		self.flush()
+		self.unwind(0)
+
+	def collapsed(self, weight='time'):
+		''' The stacks in collapsed stack format. Each line contains
+			a stack of function names separated by semicolons, followed by
+			either the number of ticks or microseconds spent in it.
+		'''
+		lines = []
+		for path, (ticks, elapsed) in sorted(self.stacks.items()):
+			value = ticks if weight == 'ticks' else int(elapsed * 1000000)
+			lines.append('{} {}'.format(path.replace(' ', '_'), value))
+		return '\n'.join(lines)
+
+	def report(self, limit=10):
+		''' Summary of the most expensive instructions and functions '''
+		lines = ['Instructions:']
+		opcodes = sorted(self.opcodes.items(), key=lambda x: x[1].time, reverse=True)
+		for opcode, stats in opcodes[:limit]:
+			lines.append('  {:30} {}'.format(getattr(opcode, 'name', str(opcode)), stats))
+		lines.append('Functions:')
+		functions = sorted(self.functions.items(), key=lambda x: x[1].self_time, reverse=True)
+		for name, stats in functions[:limit]:
+			lines.append('  {:30} {}'.format(name, stats))
+		return lines
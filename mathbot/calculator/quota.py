@@ -0,0 +1,204 @@
+''' Execution quotas
+
+	Limits the amount of work that the interpereter does on behalf
+	of a single command, and on behalf of everything that is run in a
+	channel or guild. Work is measured in CPU time (time spent waiting
+	for other tasks on the event loop isn't counted) and in ticks.
+
+	Channel and guild limits are token buckets. Each command takes
+	what it used out of the bucket, and the bucket slowly refills.
+'''
+
+import time
+
+from . import errors
+
+
+class QuotaExceededError(errors.EvaluationError):
+	''' Raised when a command has used up its budget '''
+
+
+class Budget:
+	''' An amount of CPU time (in seconds) and a number of ticks.
+		None for either means that there is no limit.
+	'''
+
+	__slots__ = ['cpu_time', 'ticks']
+
+	def __init__(self, cpu_time=None, ticks=None):
+		self.cpu_time = cpu_time
+		self.ticks = ticks
+
+	def limit(self, other):
+		''' The tighter of two budgets '''
+		return Budget(_smaller(self.cpu_time, other.cpu_time), _smaller(self.ticks, other.ticks))
+
+	def exceeded_by(self, usage):
+		return (self.cpu_time is not None and usage.cpu_time > self.cpu_time) \
+			or (self.ticks is not None and usage.ticks > self.ticks)
+
+	@property
+	def exhausted(self):
+		return (self.cpu_time is not None and self.cpu_time <= 0) \
+			or (self.ticks is not None and self.ticks <= 0)
+
+	def __repr__(self):
+		return 'Budget(cpu_time={}, ticks={})'.format(self.cpu_time, self.ticks)
+
+
+UNLIMITED = Budget()
+
+
+def _smaller(a, b):
+	if a is None:
+		return b
+	if b is None:
+		return a
+	return min(a, b)
+
+
+class Meter:
+	''' Measures the resources used by a single run of the interpereter.
+		The interpereter calls pause and resume around the points where
+		it hands control back to the event loop, so that work done by
+		other tasks isn't charged to this one.
+	'''
+
+	__slots__ = ['budget', 'cpu_time', 'ticks', '_started']
+
+	def __init__(self, budget=None):
+		self.budget = budget or UNLIMITED
+		self.cpu_time = 0
+		self.ticks = 0
+		self._started = None
+
+	@property
+	def running(self):
+		return self._started is not None
+
+	def resume(self):
+		self._started = time.process_time()
+
+	def pause(self):
+		if self._started is not None:
+			self.cpu_time += time.process_time() - self._started
+			self._started = None
+
+	def record(self, ticks):
+		''' Count some more ticks and make sure that the budget hasn't
+			been used up. The meter must be running.
+		'''
+		self.ticks += ticks
+		now = time.process_time()
+		self.cpu_time += now - self._started
+		self._started = now
+		if self.budget.exceeded_by(self):
+			raise QuotaExceededError('Operation timed out')
+
+	def __repr__(self):
+		return 'Meter(cpu_time={:.4f}, ticks={})'.format(self.cpu_time, self.ticks)
+
+
+class TokenBucket:
+	''' A budget that is used up by commands and refills over time.
+		refill_rate is the fraction of the capacity that is restored
+		each second.
+	'''
+
+	__slots__ = ['capacity', 'refill_rate', 'cpu_time', 'ticks', 'updated']
+
+	def __init__(self, capacity, refill_rate, clock=time.monotonic):
+		self.capacity = capacity
+		self.refill_rate = refill_rate
+		self.cpu_time = capacity.cpu_time
+		self.ticks = capacity.ticks
+		self.updated = clock()
+
+	def refill(self, now):
+		elapsed = max(0, now - self.updated)
+		self.updated = now
+		if self.cpu_time is not None:
+			self.cpu_time = min(self.capacity.cpu_time,
+				self.cpu_time + elapsed * self.refill_rate * self.capacity.cpu_time)
+		if self.ticks is not None:
+			self.ticks = min(self.capacity.ticks,
+				self.ticks + int(elapsed * self.refill_rate * self.capacity.ticks))
+
+	def remaining(self, now):
+		self.refill(now)
+		return Budget(self.cpu_time, self.ticks)
+
+	def charge(self, usage, now):
+		self.refill(now)
+		if self.cpu_time is not None:
+			self.cpu_time -= usage.cpu_time
+		if self.ticks is not None:
+			self.ticks -= usage.ticks
+
+	def time_until_available(self):
+		''' Seconds until the bucket has something in it again '''
+		waits = [0]
+		if self.cpu_time is not None and self.cpu_time <= 0:
+			waits.append(-self.cpu_time / (self.refill_rate * self.capacity.cpu_time))
+		if self.ticks is not None and self.ticks <= 0:
+			waits.append(-self.ticks / (self.refill_rate * self.capacity.ticks))
+		return max(waits)
+
+
+class QuotaManager:
+	''' Keeps track of the budgets for each channel and guild.
+
+		command - the Budget for any single command.
+		channel, guild - (capacity, refill_rate) pairs used to create
+			the token buckets for each channel and guild, or None
+			if there should be no limit at that level.
+	'''
+
+	def __init__(self, command, channel=None, guild=None, clock=time.monotonic):
+		self.command = command
+		self.channel = channel
+		self.guild = guild
+		self.clock = clock
+		self.buckets = {}
+		self._prune_at = 64
+
+	def _buckets(self, channel, guild):
+		keys = []
+		if self.channel is not None and channel is not None:
+			keys.append(('channel', channel, self.channel))
+		if self.guild is not None and guild is not None:
+			keys.append(('guild', guild, self.guild))
+		for kind, identifier, (capacity, refill_rate) in keys:
+			bucket = self.buckets.get((kind, identifier))
+			if bucket is None:
+				bucket = TokenBucket(capacity, refill_rate, self.clock)
+				self.buckets[(kind, identifier)] = bucket
+			yield bucket
+
+	def remaining(self, channel, guild=None):
+		''' The budget that the next command run in a channel can use '''
+		now = self.clock()
+		budget = self.command
+		for bucket in self._buckets(channel, guild):
+			budget = budget.limit(bucket.remaining(now))
+		return budget
+
+	def charge(self, channel, guild, usage):
+		''' Take the resources used by a command out of the buckets '''
+		now = self.clock()
+		for bucket in self._buckets(channel, guild):
+			bucket.charge(usage, now)
+		if len(self.buckets) >= self._prune_at:
+			self._forget_full_buckets(now)
+			self._prune_at = max(64, len(self.buckets) * 2)
+
+	def retry_after(self, channel, guild=None):
+		''' Seconds until a command can be run in a channel again '''
+		return max((i.time_until_available() for i in self._buckets(channel, guild)), default=0)
+
+	def _forget_full_buckets(self, now):
+		# Full buckets are the same as new ones, so there's no need to keep them
+		for key, bucket in list(self.buckets.items()):
+			bucket.refill(now)
+			if bucket.cpu_time == bucket.capacity.cpu_time and bucket.ticks == bucket.capacity.ticks:
+				del self.buckets[key]
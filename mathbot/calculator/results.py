@@ -0,0 +1,177 @@
+''' Cache of the output of pure commands
+
+	Lots of commands, such as 2+2 or sqrt(2), are run over and over in
+	different channels, and always produce the same output. A ResultCache
+	remembers that output so that the command doesn't have to be parsed,
+	compiled, run and formatted again. One cache is shared by all of
+	the terminals that use it.
+
+	A command can only be cached if its output can't depend on the state
+	of the terminal that ran it. is_pure checks this from the AST: the
+	command must not assign anything, and every name that it uses has to
+	be either a parameter of a function defined in the command, or one
+	of the builtins defined by a protected runtime library (which can't
+	be reassigned). None of the builtins have side effects.
+'''
+
+import collections
+import time
+
+from . import nodes
+
+
+class PurityChecker:
+
+	def __init__(self, runtime_names):
+		self.runtime_names = runtime_names
+
+	def check(self, node, bound):
+		''' Determine whether a node is pure. bound is the set of names
+			that are defined as function parameters at this point.
+		'''
+		handler = self.HANDLERS.get(node.tag)
+		if handler is None:
+			# Anything that isn't known to be safe is assumed not to be
+			return False
+		return handler(self, node, bound)
+
+	def check_all(self, items, bound):
+		return all(self.check(i, bound) for i in items)
+
+	def check_constant(self, node, bound):
+		return True
+
+	check_number = check_constant
+	check_string = check_constant
+	check_glyph = check_constant
+	check_end = check_constant
+	check__exact_item_hack = check_constant
+
+	def check_word(self, node, bound):
+		name = node.string.lower()
+		return name in bound or name in self.runtime_names
+
+	def check_program(self, node, bound):
+		return self.check_all(node.items, bound)
+
+	def check_function_definition(self, node, bound):
+		params = {i.string.lower() for i in node.parameters.items}
+		return self.check(node.expression, bound | params)
+
+	def check_output(self, node, bound):
+		return self.check(node.expression, bound)
+
+	check_not = check_output
+	check_head = check_output
+	check_tail = check_output
+
+	def check_value(self, node, bound):
+		return self.check(node.value, bound)
+
+	check_factorial = check_value
+	check_uminus = check_value
+	check_percent_op = check_value
+
+	def check_bin_op(self, node, bound):
+		# Long chains such as 1+2+3+... are followed without recursion
+		while node.tag == 'bin_op':
+			if node.left.tag == 'bin_op':
+				node, other = node.left, node.right
+			else:
+				node, other = node.right, node.left
+			if not self.check(other, bound):
+				return False
+		return self.check(node, bound)
+
+	def check_comparison(self, node, bound):
+		return self.check(node.first, bound) \
+			and self.check_all((i['value'] for i in node.rest), bound)
+
+	def check_list_literal(self, node, bound):
+		return self.check_all(node.items, bound)
+
+	def check_function_call(self, node, bound):
+		items = node.arguments.items if node.arguments is not None else []
+		return self.check(node.function, bound) and self.check_all(items, bound)
+
+
+PurityChecker.HANDLERS = nodes.visitor_table(PurityChecker, 'check_')
+
+
+def is_pure(ast, runtime_names):
+	''' Determine whether the output of some code depends only on the
+		code itself. runtime_names is the set of global names defined
+		by the runtime library, which must be protected.
+	'''
+	try:
+		return PurityChecker(runtime_names).check(ast, frozenset())
+	except RecursionError:
+		return False
+
+
+class ResultStatistics:
+
+	__slots__ = ['hits', 'misses', 'expirations', 'evictions']
+
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self.expirations = 0
+		self.evictions = 0
+
+	@property
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		if lookups == 0:
+			return 0
+		return self.hits / lookups
+
+	def __repr__(self):
+		return 'hits={} misses={} expirations={} evictions={} hit_rate={:.1%}'.format(
+			self.hits, self.misses, self.expirations, self.evictions, self.hit_rate)
+
+
+class ResultCache:
+
+	''' Remembers the output of commands, by key.
+
+		Entries are dropped in least-recently-used order once there are
+		more than capacity of them, and are forgotten ttl seconds after
+		they were stored.
+	'''
+
+	def __init__(self, capacity=4096, ttl=60 * 60, *, clock=time.monotonic):
+		self.capacity = capacity
+		self.ttl = ttl
+		self.clock = clock
+		self.statistics = ResultStatistics()
+		# Maps keys to (expiry time, output), least recently used first
+		self.entries = collections.OrderedDict()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key):
+		''' Get the output for a key, or None if it isn't known '''
+		entry = self.entries.get(key)
+		if entry is not None and entry[0] <= self.clock():
+			del self.entries[key]
+			self.statistics.expirations += 1
+			entry = None
+		if entry is None:
+			self.statistics.misses += 1
+			return None
+		self.statistics.hits += 1
+		self.entries.move_to_end(key)
+		return entry[1]
+
+	def put(self, key, output):
+		self.entries[key] = (self.clock() + self.ttl, output)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.capacity:
+			self.entries.popitem(last=False)
+			self.statistics.evictions += 1
+
+	def clear(self):
+		''' Remove all the entries. The statistics are kept. '''
+		self.entries.clear()
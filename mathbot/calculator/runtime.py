@@ -12,10 +12,12 @@ import functools
 
 from .bytecode import *
 from .functions import *
-from .errors import EvaluationError
+from .errors import EvaluationError, ResourceExhaustedError
 from . import parser
+from . import nodes
 from . import formatter
 from . import crucible
+from . import operators
 
 
 ALL_SYMPY_CLASSES = tuple(sympy.core.all_classes)
@@ -68,7 +70,7 @@ def format_smart(val):
 
 
 def array_length(val):
-	if not isinstance(val, (Array, Interval, ListBase)):
+	if not isinstance(val, (Array, Interval, ListBase, HashTrie)):
 		raise EvaluationError('Cannot get the length of non-array object')
 	return len(val)
 
@@ -124,6 +126,300 @@ def reduce_to_float(value):
 	return sympy.Number(float(value))
 
 
+def uses_interpereter(func):
+	''' Mark a builtin coroutine as taking the interpereter that called it
+		as its first argument, so that it can call the functions that it
+		is given with Interpereter.call. The CPU time that it uses is
+		charged to the command that called it, so it mustn't wait on
+		anything other than those calls.
+	'''
+	func.uses_interpereter = True
+	return func
+
+
+# Faster versions of the list functions in the library. Each one is given
+# the library version as its last argument, and hands the work over to it
+# for anything other than the common cases, so that the results and the
+# errors are always the same.
+
+
+def _is_plain_function(value):
+	if isinstance(value, BuiltinFunction):
+		return True
+	# Macros need thunks as their arguments, which the library versions give them
+	return isinstance(value, Function) and not value.segment[value.address + 4]
+
+
+def _is_count(value):
+	return isinstance(value, sympy.Integer)
+
+
+def _is_sortable(values):
+	return all(
+		operators.is_native(i) or (isinstance(i, sympy.Number) and i.is_comparable)
+		for i in values
+	)
+
+
+@uses_interpereter
+async def native_map(vm, f, l, fallback):
+	if not _is_plain_function(f) or not isinstance(l, ListBase):
+		return await vm.call(fallback, f, l)
+	return create_list([await vm.call(f, i) for i in l])
+
+
+@uses_interpereter
+async def native_filter(vm, f, l, fallback):
+	if not _is_plain_function(f) or not isinstance(l, ListBase):
+		return await vm.call(fallback, f, l)
+	result = []
+	while l:
+		keep = await vm.call(f, l.head)
+		try:
+			keep = bool(keep)
+		except TypeError:
+			# Things like symbolic comparisons, which the library version deals with.
+			# It carries on from here, rather than starting over.
+			rest = await vm.call(fallback, f, l)
+			return FlatList(result, rest) if result else rest
+		if keep:
+			result.append(l.head)
+		l = l.rest
+	return create_list(result)
+
+
+@uses_interpereter
+async def native_reverse(vm, l, fallback):
+	if not isinstance(l, ListBase):
+		return await vm.call(fallback, l)
+	return create_list(reversed(list(l)))
+
+
+@uses_interpereter
+async def native_foldl(vm, f, x, l, fallback):
+	if not _is_plain_function(f) or not isinstance(l, ListBase):
+		return await vm.call(fallback, f, x, l)
+	for i in l:
+		x = await vm.call(f, x, i)
+	return x
+
+
+@uses_interpereter
+async def native_foldr(vm, f, x, l, fallback):
+	if not _is_plain_function(f) or not isinstance(l, ListBase):
+		return await vm.call(fallback, f, x, l)
+	for i in reversed(list(l)):
+		x = await vm.call(f, i, x)
+	return x
+
+
+# Longer ranges are left to the library version, which runs into the
+# quota instead of trying to allocate the whole list at once
+NATIVE_RANGE_LIMIT = 10 ** 5
+
+
+@uses_interpereter
+async def native_range(vm, a, b, fallback):
+	if not _is_count(a) or not _is_count(b) or not 0 <= b - a <= NATIVE_RANGE_LIMIT:
+		return await vm.call(fallback, a, b)
+	return create_list(range(int(a), int(b)))
+
+
+@uses_interpereter
+async def native_sort(vm, x, fallback):
+	if not isinstance(x, ListBase):
+		return await vm.call(fallback, x)
+	if len(x) <= 1:
+		return x
+	values = list(x)
+	if not _is_sortable(values):
+		return await vm.call(fallback, x)
+	if all(map(operators.is_native, values)):
+		return create_list(sorted(values))
+	return create_list(sorted(values, key=operators.to_sympy))
+
+
+@uses_interpereter
+async def native_zip(vm, a, b, fallback):
+	if not isinstance(a, ListBase) or not isinstance(b, ListBase):
+		return await vm.call(fallback, a, b)
+	return create_list(create_list(pair) for pair in zip(a, b))
+
+
+@uses_interpereter
+async def native_join(vm, a, b, fallback):
+	if not isinstance(a, ListBase) or not isinstance(b, ListBase):
+		return await vm.call(fallback, a, b)
+	if not a:
+		return b
+	return FlatList(list(a), b)
+
+
+@uses_interpereter
+async def native_take(vm, x, n, fallback):
+	if not isinstance(x, ListBase) or not _is_count(n) or n > len(x):
+		return await vm.call(fallback, x, n)
+	return create_list(itertools.islice(x, max(0, int(n))))
+
+
+@uses_interpereter
+async def native_drop(vm, x, n, fallback):
+	if not isinstance(x, ListBase) or not _is_count(n) or n > len(x):
+		return await vm.call(fallback, x, n)
+	for _ in range(int(n)):
+		x = x.rest
+	return x
+
+
+def make_hash_map(*args):
+	''' hashmap() is an empty map. hashmap(pairs) makes one from a list of
+		[key value] pairs, such as an association list, where the first
+		pair with each key is the one that counts (as it is for get).
+	'''
+	if not args:
+		return HashMap()
+	if len(args) > 1:
+		raise EvaluationError('hashmap takes at most one argument')
+	pairs = args[0]
+	if isinstance(pairs, HashMap):
+		return pairs
+	if not isinstance(pairs, (Array, ListBase)):
+		raise EvaluationError('hashmap received non-list')
+	result = HashMap()
+	for pair in pairs:
+		if not isinstance(pair, (Array, ListBase)) or len(pair) != 2:
+			raise EvaluationError('hashmap received something other than a list of [key value] pairs')
+		key, value = pair
+		if key not in result:
+			result = result.with_item(key, value)
+	return result
+
+
+def make_hash_set(*args):
+	''' hashset() is an empty set. hashset(items) makes one from a list. '''
+	if not args:
+		return HashSet()
+	if len(args) > 1:
+		raise EvaluationError('hashset takes at most one argument')
+	items = args[0]
+	if isinstance(items, HashSet):
+		return items
+	if not isinstance(items, (Array, ListBase)):
+		raise EvaluationError('hashset received non-list')
+	return HashSet.from_keys(items)
+
+
+def is_hash_map(val):
+	return int(isinstance(val, HashMap))
+
+
+def is_hash_set(val):
+	return int(isinstance(val, HashSet))
+
+
+# Versions of the association list and set functions in the library that
+# work on maps and sets. Like the list functions above, they're given the
+# library version, which is used for everything else.
+
+
+async def _calculator_equals(a, b):
+	''' Same as equals in the library '''
+	try:
+		return bool(await operators.super_equals(a, b))
+	except Exception:
+		return False
+
+
+@uses_interpereter
+async def native_assoc(vm, ass, key, value, fallback):
+	if not isinstance(ass, HashMap):
+		return await vm.call(fallback, ass, key, value)
+	return ass.with_item(key, value)
+
+
+@uses_interpereter
+async def native_get(vm, ass, key, fallback):
+	if not isinstance(ass, HashMap):
+		return await vm.call(fallback, ass, key)
+	return ass.lookup(key, EMPTY_LIST)
+
+
+@uses_interpereter
+async def native_aremove(vm, ass, key, fallback):
+	if not isinstance(ass, HashMap):
+		return await vm.call(fallback, ass, key)
+	return ass.without(key)
+
+
+@uses_interpereter
+async def native_aremove_value(vm, ass, value, fallback):
+	if not isinstance(ass, HashMap):
+		return await vm.call(fallback, ass, value)
+	result = ass
+	for k, v in ass.items():
+		if await _calculator_equals(v, value):
+			result = result.without(k)
+	return result
+
+
+@uses_interpereter
+async def native_keys(vm, ass, fallback):
+	if not isinstance(ass, HashTrie):
+		return await vm.call(fallback, ass)
+	return create_list(ass)
+
+
+@uses_interpereter
+async def native_values(vm, ass, fallback):
+	if not isinstance(ass, HashTrie):
+		return await vm.call(fallback, ass)
+	return create_list(v for _, v in ass.items())
+
+
+@uses_interpereter
+async def native_set_insert(vm, s, elem, fallback):
+	if not isinstance(s, HashSet):
+		return await vm.call(fallback, s, elem)
+	return s.insert(elem)
+
+
+@uses_interpereter
+async def native_set_remove(vm, s, elem, fallback):
+	if not isinstance(s, HashSet):
+		return await vm.call(fallback, s, elem)
+	return s.without(elem)
+
+
+@uses_interpereter
+async def native_to_set(vm, ls, fallback):
+	if not isinstance(ls, HashSet):
+		return await vm.call(fallback, ls)
+	return ls
+
+
+@uses_interpereter
+async def native_in(vm, s, elem, fallback):
+	if not isinstance(s, HashTrie):
+		return await vm.call(fallback, s, elem)
+	return elem in s
+
+
+def _as_hash_set(value):
+	if isinstance(value, HashSet):
+		return value
+	if not isinstance(value, (Array, ListBase)):
+		raise EvaluationError('set_equals received something other than a set or list')
+	return HashSet.from_keys(value)
+
+
+@uses_interpereter
+async def native_set_equals(vm, a, b, fallback):
+	if not isinstance(a, HashSet) and not isinstance(b, HashSet):
+		return await vm.call(fallback, a, b)
+	# A list being compared to a set is treated as the set of its items
+	return await operators.super_equals(_as_hash_set(a), _as_hash_set(b))
+
+
 BUILTIN_FUNCTIONS = {
 	'log': mylog,
 	'ln': sympy.log,
@@ -141,10 +437,48 @@ BUILTIN_FUNCTIONS = {
 	'str': format_smart,
 	'ord': glyph_to_int,
 	'chr': int_to_glyph,
+	'hashmap': make_hash_map,
+	'hashset': make_hash_set,
+	'is_hashmap': is_hash_map,
+	'is_hashset': is_hash_set,
+}
+
+
+BUILTIN_COROUTINES = {
+	'_native_map': native_map,
+	'_native_filter': native_filter,
+	'_native_reverse': native_reverse,
+	'_native_foldl': native_foldl,
+	'_native_foldr': native_foldr,
+	'_native_range': native_range,
+	'_native_sort': native_sort,
+	'_native_zip': native_zip,
+	'_native_join': native_join,
+	'_native_take': native_take,
+	'_native_drop': native_drop,
+	'_native_assoc': native_assoc,
+	'_native_get': native_get,
+	'_native_aremove': native_aremove,
+	'_native_aremove_value': native_aremove_value,
+	'_native_keys': native_keys,
+	'_native_values': native_values,
+	'_native_set_insert': native_set_insert,
+	'_native_set_remove': native_set_remove,
+	'_native_to_set': native_to_set,
+	'_native_in': native_in,
+	'_native_set_equals': native_set_equals,
 }
 
 
-BUILTIN_COROUTINES = {}
+# Builtins that always give the same result for the same arguments and
+# have no side effects. Calls to these may be evaluated at compile time.
+PURE_FUNCTIONS = {'log', 'ln', 'decimal', 'float', 'deg', 'rad'}
+
+
+# Pure builtins that aren't folded anyway. These work out as many digits
+# as they need, or search for exact roots, so even small arguments such
+# as exp(10^20) can keep them busy for a very long time.
+SLOW_FUNCTIONS = {'int', 'ceiling', 'floor', 'frac', 'root', 'sqrt'}
 
 
 FIXED_VALUES = {
@@ -170,7 +504,10 @@ def _extract_from_sympy():
 	def _wrap_with_crucible(function, condition=lambda x: True):
 		async def _replacement(*args):
 			if condition(*args):
-				return await crucible.run(function, args, timeout=2)
+				try:
+					return await crucible.run(function, args, timeout=2)
+				except crucible.ResourceExhausted as e:
+					raise ResourceExhaustedError(e.resource)
 			return function(*args)
 		return protect_sympy_function(_replacement)
 	names = '''
@@ -188,6 +525,8 @@ def _extract_from_sympy():
 		for name in map(str.lower, external_names):
 			if isinstance(value, (sympy.FunctionClass, types.FunctionType)):
 				BUILTIN_FUNCTIONS[name] = protect_sympy_function(value)
+				if name not in SLOW_FUNCTIONS:
+					PURE_FUNCTIONS.add(name)
 			else:
 				FIXED_VALUES[name] = value
 	BUILTIN_COROUTINES['factorial'] = _wrap_with_crucible(sympy.factorial, lambda x: x > 100)
@@ -201,16 +540,10 @@ with open(os.path.join(os.path.dirname(__file__), 'library.c5')) as f:
 
 
 def _assignment_code(name, value, add_terminal_byte=False):
-	return {
-		'#': 'assignment',
-		'variable': {
-			'string': name,
-		},
-		'value': {
-			'#': '_exact_item_hack',
-			'value': value
-		}
-	}
+	return nodes.Assignment(
+		variable=nodes.Token('word', name),
+		value=nodes.Constant(value=value)
+	)
 
 
 def _prepare_runtime(exportable=False):
@@ -228,9 +561,22 @@ def _prepare_runtime(exportable=False):
 	yield ast
 
 
-@functools.lru_cache(4)
+@functools.lru_cache(None)
+def known_values():
+	''' Values of the builtins that can be used when folding constants.
+		This is only valid if the runtime is protected from reassignment.
+		The same dictionary is given to every builder, so don't change it.
+	'''
+	values = {name: BUILTIN_FUNCTIONS[name] for name in PURE_FUNCTIONS}
+	values.update(FIXED_VALUES)
+	return values
+
+
 def prepare_runtime(builder, **kwargs):
-	return  builder.build(*list(_prepare_runtime(**kwargs)), unsafe=True)
+	''' Compile the runtime library. Terminals get the compiled
+		library from image.prepare instead, so it isn't done every time.
+	'''
+	return builder.build(*list(_prepare_runtime(**kwargs)), unsafe=True)
 
 
 def wrap_simple(ast):
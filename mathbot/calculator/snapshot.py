@@ -0,0 +1,240 @@
+''' Snapshots of a terminal's global state
+
+	Restoring a snapshot is a lot faster than re-running every command
+	that was used to build up the state in the first place.
+
+	A snapshot holds the values of all the global variables, which
+	includes user-defined functions (along with their bytecode and
+	closures), and the names of the globals. Anything that was created
+	by the runtime library is stored as a reference rather than a copy,
+	and is linked back up to the equivalent object in the terminal that
+	the snapshot is restored into.
+
+	Snapshots are tied to a specific version of the runtime library and
+	of the modules that make up the interpereter. Restoring a snapshot
+	that was made by a different version raises a SnapshotError, in which
+	case the state has to be rebuilt some other way.
+'''
+
+import base64
+import fractions
+import functools
+import hashlib
+import io
+import os
+import pickle
+import zlib
+
+import sympy
+from sympy.core.assumptions import StdFactKB
+
+from . import bytecode
+from . import functions
+from . import interpereter
+from . import runtime
+
+
+# Increase this when the snapshot format changes
+SNAPSHOT_VERSION = 1
+
+SOURCES = ['runtime.py', 'bytecode.py', 'functions.py', 'interpereter.py', 'snapshot.py']
+
+# The only classes and functions that can be loaded from a snapshot,
+# other than sympy's expression classes (see safe_globals)
+SAFE_OBJECTS = [
+	complex, frozenset, set, slice, object, tuple, list, dict,
+	fractions.Fraction,
+	StdFactKB,
+	bytecode.I, bytecode.GlobalToken, bytecode.ConstructedBytecode,
+	interpereter.IndexedScope,
+	functions.Glyph, functions.BuiltinFunction, functions.Function,
+	functions.Array, functions.List, functions.FlatList, functions.EmptyList,
+	functions.SingularValue, functions.Interval, functions.HashMap, functions.HashSet,
+	functions.rebuild_list, functions.view_flat_list, functions.rebuild_hash_trie,
+]
+
+try:
+	import gmpy2
+except ImportError:
+	pass
+else:
+	SAFE_OBJECTS += [gmpy2.mpz, gmpy2.mpq, gmpy2.from_binary]
+
+
+class SnapshotError(Exception):
+	''' A snapshot could not be made, or could not be restored '''
+
+
+@functools.lru_cache(None)
+def version():
+	''' Identifies the code that produced a snapshot '''
+	digest = hashlib.sha256(str(SNAPSHOT_VERSION).encode('utf-8'))
+	digest.update(runtime.LIBRARY_CODE.encode('utf-8'))
+	directory = os.path.dirname(os.path.abspath(__file__))
+	for filename in SOURCES:
+		with open(os.path.join(directory, filename), 'rb') as f:
+			digest.update(f.read())
+	return digest.hexdigest()[:16]
+
+
+class References:
+	''' Objects that are stored by a key rather than being copied '''
+
+	def __init__(self, objects):
+		self.objects = objects
+		self.keys = {id(v): k for k, v in objects.items()}
+
+	def key(self, obj):
+		key = self.keys.get(id(obj))
+		if key is not None and self.objects[key] is obj:
+			return key
+		return None
+
+	def get(self, key):
+		return self.objects[key]
+
+
+def runtime_references(values, runtime_segment):
+	''' The objects that exist once the runtime library has been loaded,
+		given the values of the globals at that point.
+	'''
+	objects = {'runtime': runtime_segment}
+	for index, value in enumerate(values):
+		if value is not None:
+			objects[index] = value
+	return References(objects)
+
+
+class Base:
+	''' The objects that exist once the runtime library has been
+		loaded, which are stored in snapshots by reference.
+		Terminals that share a runtime can share the references to it.
+	'''
+
+	def __init__(self, interpereter, runtime_segment, references=None):
+		self.root_scope = interpereter.root_scope
+		if references is None:
+			references = runtime_references(self.root_scope.values, runtime_segment)
+		self.references = references
+
+	def key(self, obj):
+		if obj is self.root_scope:
+			return 'root-scope'
+		return self.references.key(obj)
+
+	def get(self, key):
+		if key == 'root-scope':
+			return self.root_scope
+		return self.references.get(key)
+
+
+# Most sympy classes turn strings that they're given into expressions by
+# evaluating them as code (see sympify), so they're only allowed to be
+# given strings if they're one of these, which don't
+STRING_ARGUMENT_CLASSES = (sympy.Symbol, sympy.Float)
+
+
+def _contains_string(value):
+	if isinstance(value, str):
+		return True
+	if isinstance(value, (tuple, list, set, frozenset)):
+		return any(map(_contains_string, value))
+	if isinstance(value, dict):
+		return _contains_string(list(value.items()))
+	return False
+
+
+def _without_strings(cls):
+	''' Wrap a sympy class so that it can't be given strings '''
+	def construct(*args):
+		if _contains_string(args):
+			raise SnapshotError('Snapshot passes a string to {}'.format(cls.__name__))
+		return cls(*args)
+	return construct
+
+
+@functools.lru_cache(None)
+def safe_globals():
+	''' The objects that snapshots may refer to, by module and name.
+		Computed when first needed, since sympy defines some of its
+		classes as other modules are imported.
+	'''
+	result = {(i.__module__, i.__name__): i for i in SAFE_OBJECTS}
+	for cls in sympy.core.all_classes:
+		if issubclass(cls, STRING_ARGUMENT_CLASSES):
+			result[cls.__module__, cls.__name__] = cls
+		elif issubclass(cls, sympy.Basic):
+			result[cls.__module__, cls.__name__] = _without_strings(cls)
+	return result
+
+
+def is_safe_global(module, name):
+	# Dotted names would let pickle look up attributes of safe objects
+	return '.' not in name and (module, name) in safe_globals()
+
+
+class _Pickler(pickle.Pickler):
+
+	def __init__(self, file, base):
+		super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+		self.base = base
+
+	def persistent_id(self, obj):
+		return self.base.key(obj)
+
+
+class _Unpickler(pickle.Unpickler):
+
+	def __init__(self, file, base):
+		super().__init__(file)
+		self.base = base
+
+	def persistent_load(self, key):
+		try:
+			return self.base.get(key)
+		except KeyError:
+			raise SnapshotError('Snapshot refers to an unknown runtime object: {}'.format(key))
+
+	def find_class(self, module, name):
+		# Objects are never imported or looked up, only taken from the list
+		if is_safe_global(module, name):
+			return safe_globals()[module, name]
+		raise SnapshotError('Snapshot contains a forbidden object: {}.{}'.format(module, name))
+
+
+def dump_bytes(state, base):
+	''' Pickle a state, storing the objects in base by reference '''
+	buffer = io.BytesIO()
+	try:
+		_Pickler(buffer, base).dump(state)
+	except (pickle.PicklingError, TypeError, AttributeError, RecursionError) as e:
+		raise SnapshotError('Could not create snapshot: {}'.format(e))
+	return buffer.getvalue()
+
+
+def load_bytes(data, base):
+	''' Unpickle something made by dump_bytes '''
+	try:
+		return _Unpickler(io.BytesIO(data), base).load()
+	except SnapshotError:
+		raise
+	except Exception as e:
+		raise SnapshotError('Could not load snapshot: {}'.format(e))
+
+
+def dump(state, base):
+	''' Turn a state (a dict of picklable things) into a string '''
+	encoded = base64.b64encode(zlib.compress(dump_bytes(state, base))).decode('ascii')
+	return version() + ':' + encoded
+
+
+def load(string, base):
+	''' Turn a string made by dump back into a state '''
+	tag, _, encoded = string.partition(':')
+	if tag != version():
+		raise SnapshotError('Snapshot was created by a different version')
+	try:
+		data = zlib.decompress(base64.b64decode(encoded))
+	except Exception as e:
+		raise SnapshotError('Could not load snapshot: {}'.format(e))
+	return load_bytes(data, base)
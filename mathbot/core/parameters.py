@@ -79,6 +79,22 @@ class ShardsModel(BaseModel):
 class CalculatorModel(BaseModel):
 	persistent: bool
 	libraries: bool
+	# Channels whose calculator state is kept in memory, and the estimated
+	# number of bytes it may take up. Channels that have been idle for at
+	# least terminal_minimum_idle seconds are evicted to stay under these.
+	terminal_limit: Optional[int]
+	terminal_memory: Optional[int]
+	terminal_minimum_idle: float
+	# Worker processes that run the calculator's risky operations, and how
+	# many jobs they can do or bytes they can use before being replaced.
+	crucible_workers: int
+	crucible_spares: int
+	crucible_max_jobs: Optional[int]
+	crucible_max_memory: Optional[int]
+	# Hard limits on the address space of each worker (in bytes) and the
+	# CPU time of each job (in seconds). Workers that go over are killed.
+	crucible_memory_limit: Optional[int]
+	crucible_cpu_limit: Optional[float]
 
 
 class AdvertisingModel(BaseModel):
@@ -5,12 +5,18 @@ from mathbot import utils
 from mathbot import safe
 from mathbot import core
 from mathbot.calculator import blackbox
+from mathbot.calculator import quota
+from mathbot.calculator import snapshot
+from mathbot.calculator import eviction
+from mathbot.calculator import crucible
+from mathbot.calculator import results
 import collections
 import traceback
 from mathbot import patrons
 import aiohttp
 import async_timeout
 import json
+import math
 import time
 import traceback
 import typing
@@ -44,6 +50,10 @@ HISTORY_DISABLED = '''\
 Command history is not avaiable on this server.
 '''
 
+QUOTA_EXHAUSTED = '''\
+The calculator has been doing a lot of work here recently. Try again in {seconds} seconds.
+'''
+
 HISTORY_DISABLED_PRIVATE = '''\
 Private command history is only avaiable to quadratic Patreon supporters: https://www.patreon.com/dxsmiley
 A support teir of **quadratic** or higher is required.
@@ -52,13 +62,31 @@ A support teir of **quadratic** or higher is required.
 
 SCOPES = dict()
 
+# Memory (in bytes) that each scope may use to remember function results between commands
+CACHE_BUDGET = 4 * 1024 * 1024
+
+# Output of commands that don't depend on the channel's state, shared by every
+# channel. The hit rate is printed after every RESULT_CACHE_REPORT_INTERVAL hits.
+RESULT_CACHE = results.ResultCache(capacity=4096, ttl=60 * 60)
+RESULT_CACHE_REPORT_INTERVAL = 1000
+
+# CPU time (in seconds) that the calculator may use for a single command, and
+# for all the commands in a channel and a guild. The channel and guild
+# allowances refill completely over the course of a minute.
+QUOTAS = quota.QuotaManager(
+	command=quota.Budget(cpu_time=5),
+	channel=(quota.Budget(cpu_time=20), 1 / 60),
+	guild=(quota.Budget(cpu_time=60), 1 / 60)
+)
+
 async def get_scope(place):
 	if place not in SCOPES:
 		SCOPES[place] = await blackbox.Terminal.new_blackbox(
-			retain_cache=False,
+			retain_cache=True,
+			cache_budget=CACHE_BUDGET,
 			output_limit=1950,
-			yield_rate=1,
-			runtime_protection_level=2
+			runtime_protection_level=2,
+			result_cache=RESULT_CACHE
 		)
 	return SCOPES[place]
 
@@ -79,6 +107,11 @@ class ReplayState:
 
 ENABLE_LIBS = True
 ENABLE_HISTORY = True
+ENABLE_SNAPSHOTS = True
+
+# Snapshots larger than this (in bytes, after encoding) aren't stored,
+# and the channel's state is restored by replaying its history instead.
+MAXIMUM_SNAPSHOT_SIZE = 512 * 1024
 
 # Servers on which history is enabled, even if the server
 # owners are not patrons.
@@ -91,12 +124,33 @@ HISTORY_ENABLED_SERVERS = \
 
 class CalculatorModule(Cog):
 
-	__slots__ = ['bot', 'command_history', 'replay_state']
+	__slots__ = ['bot', 'command_history', 'replay_state', 'residency']
 
 	def __init__(self, bot: 'MathBot'):
 		self.bot = bot
 		self.command_history = collections.defaultdict(lambda : '')
 		self.replay_state = collections.defaultdict(ReplayState)
+		settings = bot.parameters.calculator
+		self.residency = eviction.EvictionManager(
+			max_entries=settings.terminal_limit,
+			memory_budget=settings.terminal_memory,
+			minimum_idle=settings.terminal_minimum_idle,
+			on_evict=self.evict_channel,
+			is_busy=lambda channel: channel in LOCKS and LOCKS[channel].locked()
+		)
+
+	async def cog_load(self):
+		settings = self.bot.parameters.calculator
+		pool = crucible.configure(
+			settings.crucible_workers,
+			spares=settings.crucible_spares,
+			max_jobs=settings.crucible_max_jobs,
+			max_memory=settings.crucible_max_memory,
+			memory_limit=settings.crucible_memory_limit,
+			cpu_limit=settings.crucible_cpu_limit
+		)
+		# Starting the workers takes a few seconds, which shouldn't hold up the bot
+		self.bot.loop.create_task(pool.start())
 
 	@hybrid_command()
 	@core.settings.command_allowed('c-calc')
@@ -217,12 +271,27 @@ class CalculatorModule(Cog):
 	async def handle_calc_reload(self, ctx):
 		channel = ctx.channel.id
 		async with LOCKS[channel]:
-			if channel in SCOPES:
-				del SCOPES[channel]
-			if channel in self.replay_state:
-				del self.replay_state[channel]
+			self.forget_channel(channel)
+			await self.bot.keystore.delete('calculator', 'snapshot', str(channel))
 		await ctx.send('Calculator state has been flushed from this channel.')
 
+	def forget_channel(self, channel):
+		''' Drop the calculator state of a channel from memory. It gets
+			loaded again by ensure_loaded the next time it's needed.
+		'''
+		SCOPES.pop(channel, None)
+		self.replay_state.pop(channel, None)
+		self.residency.discard(channel)
+
+	def evict_channel(self, channel):
+		''' Called when a channel hasn't been used for a while and
+			its state is taking up space that's needed elsewhere.
+		'''
+		# The lock is kept. It may have just been released to a command that
+		# hasn't started yet, and a new lock wouldn't keep out the next one.
+		self.forget_channel(channel)
+		print('Evicted calculator state for channel', channel, '-', self.residency.statistics)
+
 	@Cog.listener()
 	async def on_message_discarded(self, message):
 		''' Trigger the calculator when the message is prefixed by "==" '''
@@ -253,9 +322,21 @@ class CalculatorModule(Cog):
 				prefix = await self.bot.settings.get_server_prefix(message)
 				await send(SHORTCUT_HELP_CLARIFICATION.format(prefix=prefix))
 			else:
+				channel_id = message.channel.id
+				guild_id = message.guild.id if message.guild is not None else None
+				budget = QUOTAS.remaining(channel_id, guild_id)
+				if budget.exhausted:
+					wait = QUOTAS.retry_after(channel_id, guild_id)
+					await send(QUOTA_EXHAUSTED.format(seconds=math.ceil(wait)))
+					return
 				safe.sprint('Doing calculation:', arg)
-				scope = await get_scope(message.channel.id)
-				result, worked, details = await scope.execute_async(arg)
+				scope = await get_scope(channel_id)
+				result, worked, details = await scope.execute_async(arg, budget=budget)
+				self.residency.touch(channel_id, scope.memory_usage())
+				if 'usage' in details:
+					QUOTAS.charge(channel_id, guild_id, details['usage'])
+				if details.get('cached') and RESULT_CACHE.statistics.hits % RESULT_CACHE_REPORT_INTERVAL == 0:
+					print('Calculator result cache:', RESULT_CACHE.statistics)
 				if result.count('\n') > 7:
 					lines = result.split('\n')
 					num_removed_lines = len(lines) - 8
@@ -280,6 +361,7 @@ class CalculatorModule(Cog):
 					# await self.bot.advertise_to(message.author, message.channel, message.channel)
 					if expression_has_side_effect(arg):
 						await self.add_command_to_history(message.channel, arg)
+						await self.save_snapshot(message.channel)
 				safe.sprint('Finished calculation:', arg)
 
 	async def ensure_loaded(self, channel, blame):
@@ -289,13 +371,54 @@ class CalculatorModule(Cog):
 		# in this block at once.
 		async with self.replay_state[channel.id].semaphore:
 			if not self.replay_state[channel.id].loaded:
-				if ENABLE_LIBS and not utils.is_private(channel):
-					print('Loading libraries for channel', channel)
-					await self.run_libraries(channel, channel.guild)
-				if ENABLE_HISTORY and await self.allow_calc_history(channel):
-					print('Replaying calculator commands for', channel)
-					await self.restore_history(channel, blame)
+				started = time.perf_counter()
+				if not await self.restore_snapshot(channel):
+					if ENABLE_LIBS and not utils.is_private(channel):
+						print('Loading libraries for channel', channel)
+						await self.run_libraries(channel, channel.guild)
+					if ENABLE_HISTORY and await self.allow_calc_history(channel):
+						print('Replaying calculator commands for', channel)
+						await self.restore_history(channel, blame)
+						await self.save_snapshot(channel)
 				self.replay_state[channel.id].loaded = True
+				# This is either the first time the channel has been used since
+				# the bot started, or it was evicted since the last time
+				self.residency.record_rehydration(time.perf_counter() - started)
+				scope = await get_scope(channel.id)
+				self.residency.touch(channel.id, scope.memory_usage())
+
+	async def restore_snapshot(self, channel):
+		''' Load the state of the channel from a snapshot, if there is
+			a usable one. Returns True if this worked.
+		'''
+		if not ENABLE_SNAPSHOTS or not await self.allow_calc_history(channel):
+			return False
+		data = await self.bot.keystore.get('calculator', 'snapshot', str(channel.id))
+		if data is None:
+			return False
+		scope = await get_scope(channel.id)
+		try:
+			scope.restore(data)
+		except snapshot.SnapshotError as e:
+			print('Could not restore snapshot for', channel, '-', e)
+			return False
+		print('Restored calculator snapshot for', channel)
+		return True
+
+	async def save_snapshot(self, channel):
+		if not ENABLE_SNAPSHOTS or not await self.allow_calc_history(channel):
+			return
+		scope = await get_scope(channel.id)
+		try:
+			data = scope.snapshot()
+		except snapshot.SnapshotError as e:
+			print('Could not create snapshot for', channel, '-', e)
+			data = None
+		if data is None or len(data) > MAXIMUM_SNAPSHOT_SIZE:
+			# An older snapshot would be out of date
+			await self.bot.keystore.delete('calculator', 'snapshot', str(channel.id))
+		else:
+			await self.bot.keystore.set('calculator', 'snapshot', str(channel.id), data, expire = EXPIRE_TIME)
 
 	async def restore_history(self, channel, blame):
 		commands_unpacked = await self.unpack_commands(channel)
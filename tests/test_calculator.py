@@ -3,6 +3,9 @@ import pytest
 import math
 import cmath
 import sympy
+import asyncio
+import json
+import os
 
 from tests.test_calc_helpers import *
 
@@ -402,6 +405,79 @@ def test_unicode():
 	doformatted('ord(;🐱)', '128\u201A049')
 	doformatted('chr(ord(;🐱))', '🐱')
 
+def test_tokenizer():
+	tokenize = lambda x: calculator.parser.tokenizer(x, calculator.parser.TOKEN_SPEC)
+	tokens = tokenize('a==b ++ symbol?\t2 ÷ x # comment\n->')
+	assert [(i['#'], i['string'], i['position']) for i in tokens[1:-1]] == [
+		('word', 'a', 0),
+		('comp_op', '==', 1),
+		('word', 'b', 3),
+		('concat_op', '++', 5),
+		('kw_symbol', 'symbol?', 8),
+		('number', '2', 16),
+		('mul_op', '/', 18),
+		('word', 'x', 20),
+		('function_definition', '->', 32),
+	]
+	assert [i['index'] for i in tokens] == list(range(len(tokens)))
+	assert tokens[-1]['position'] == 35
+	for code, position in [('1 + 2x', 4), ('1e1000000', 0), ('a $', 2)]:
+		with pytest.raises(calculator.parser.TokenizationFailed) as error:
+			tokenize(code)
+		assert error.value.position == position
+
+def test_ast_json():
+	nodes = calculator.nodes
+	code = 'f(x) = x ^ 2 + 1, z = 3 < f(2) <= 9, g = (a, b.) ~> [-a!, \'b] : \\b'
+	_, ast = calculator.parser.parse(code, source_name='test')
+	assert ast['#'] == 'program'
+	assert ast['items'][0]['value']['name'] == 'f'
+	assert ast['items'][0]['variable']['source'] == {'name': 'test', 'code': code, 'position': 0}
+	data = nodes.to_json(ast)
+	rebuilt = nodes.from_json(json.loads(json.dumps(data)))
+	assert nodes.to_json(rebuilt) == data
+	assert rebuilt['items'][1]['value']['rest'][0]['token']['source']['code'] == code
+	builder = calculator.bytecode.Builder()
+	interp = calculator.interpereter.Interpereter()
+	interp.run(segment=builder.build(rebuilt))
+	assert interp.run(segment=builder.build(calculator.parser.parse('z')[1])) == True
+
+def test_parser_nesting_limit():
+	parse = calculator.parser.parse
+	depth = calculator.parser.MAXIMUM_NESTING_DEPTH - 2
+	for template in ['({})', '[{}]', 'f({})', 'x -> {}', '-{}', '2^{}', '!{}']:
+		code = '1'
+		for _ in range(depth):
+			code = template.format(code)
+		parse(code)
+		for _ in range(depth):
+			code = template.format(code)
+		with pytest.raises(calculator.parser.NestingTooDeep):
+			parse(code)
+	# Long expressions that aren't nested are fine
+	parse('+'.join(['x'] * 5000))
+	parse('f(' + ','.join(['x'] * 5000) + ')')
+	doit('(' * depth + '1' + ')' * depth, 1)
+	# Chains of operators are deep in the tree, but are compiled without recursion
+	from mathbot.calculator import blackbox
+	terminal = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	chains = [
+		(lambda n: '+'.join(['1'] * n), lambda n: n),
+		(lambda n: 'x = 2, ' + '-'.join(['x'] * n), lambda n: 4 - 2 * n),
+		(lambda n: 'length(' + '1:' * n + '[])', lambda n: n),
+		(lambda n: '&&'.join(['1'] * n) + ' || 0', lambda n: True),
+	]
+	for chain, expected in chains:
+		for n in [250, 400, 2000]:
+			dort(chain(n), expected(n))
+			assert terminal.execute(chain(n))[0] == calculator.formatter.format(expected(n))
+	# Other things that are too deep to compile are errors in the calculator
+	for code in ['1' + '!' * 3000, 'f(x) = f, is_function(f' + '(1)' * 3000 + ')']:
+		with pytest.raises(calculator.errors.CompilationError):
+			calculator.calculate(code)
+		output, worked, _ = terminal.execute(code)
+		assert not worked and output.startswith('Compilation error')
+
 def test_small_floats():
 	doformatted('0.2', '1/5')
 	doformatted('0.1 + 0.2 - 0.3', '0')
@@ -489,3 +565,704 @@ def test_unicode_operators():
 	doit('4 ≤ 2 ≤ 3', False)
 	doit('1 ≤ 2 ≤ 1', False)
 
+
+def test_yield_rate():
+	async def run(yield_rate):
+		interp = calculator.interpereter.Interpereter(yield_rate=yield_rate)
+		builder = calculator.bytecode.Builder()
+		await interp.run_async(segment=calculator.runtime.prepare_runtime(builder))
+		_, ast = calculator.parser.parse('length(map(x -> x * 2, range(0, 500)))')
+		ticker_count = 0
+		async def ticker():
+			nonlocal ticker_count
+			while True:
+				ticker_count += 1
+				await asyncio.sleep(0)
+		task = asyncio.ensure_future(ticker())
+		result = await interp.run_async(segment=builder.build(ast))
+		task.cancel()
+		return result, ticker_count
+	loop = asyncio.new_event_loop()
+	few_result, few_yields = loop.run_until_complete(run(1000))
+	many_result, many_yields = loop.run_until_complete(run(1))
+	loop.close()
+	assert few_result == many_result == 500
+	assert 0 < few_yields < many_yields
+
+def test_threaded_code():
+	programs = [
+		'f = (n) -> if (n < 2, 1, f(n - 1) + f(n - 2)), f(30)',
+		'length(filter(x -> x ~mod 3 == 0, range(0, 100)))',
+		'sort(map(x -> (x * 37) ~mod 11, range(0, 40)))',
+		'g(x) = try(if(x < 5, x, nothing), 0 - x), map(g, range(0, 10))',
+		'foldl(msum, 0, range(0, 30)) + 0 * length(map((x) ~> x() * 2, range(0, 30)))',
+		'h(a.) = length(a), h(expand(range(0, 20)), 1, 2)',
+	]
+	def run(code, threshold):
+		interp = calculator.interpereter.Interpereter(compile_threshold=threshold)
+		builder = calculator.bytecode.Builder()
+		interp.run(segment=calculator.runtime.prepare_runtime(builder))
+		_, ast = calculator.parser.parse('msum = (x, y) ~> x() + y(), ' + code)
+		return calculator.formatter.format(interp.run(segment=builder.build(ast)))
+	for code in programs:
+		assert run(code, 0) == run(code, None)
+
+def test_threaded_code_errors():
+	code = '''
+		f(x) = if(x < 10, x, nothing),
+		g(x) = try(f(x), -1),
+		map(g, range(0, 40)),
+		f(20)
+	'''
+	with pytest.raises(calculator.errors.EvaluationError) as error:
+		calculator.calculate(code, tick_limit=TIMEOUT, use_runtime=True)
+	assert 'nothing' in str(error.value)
+	position = error.value._linking['position']
+	assert code[position:].startswith('nothing')
+
+def test_peephole_optimiser():
+	programs = [
+		'f = (n) -> if (n < 2, 1, f(n - 1) + f(n - 2)), f(20)',
+		'g(x) = if(!(x < 5), x, -x), map(g, range(0, 10))',
+		'h(x) = ifelse(x == 0, 10, x == 1, 20, x == 2, 30, 40), map(h, range(0, 5))',
+		'sort(filter(x -> x ~mod 3 != 0 && x > 2 || x == 1, range(0, 30)))',
+		'k(x) = try(\'x, 5), [k(list(1, 2)), k(3)]',
+		'x = 1 < 2 < 3 <= 3, [x, 1 < 2 > 3]',
+	]
+	def run(code, optimise, threshold):
+		interp = calculator.interpereter.Interpereter(compile_threshold=threshold)
+		builder = calculator.bytecode.Builder(optimise=optimise)
+		interp.run(segment=calculator.runtime.prepare_runtime(builder))
+		_, ast = calculator.parser.parse(code)
+		return calculator.formatter.format(interp.run(segment=builder.build(ast)))
+	for code in programs:
+		expected = run(code, False, None)
+		assert run(code, True, None) == expected
+		assert run(code, True, 0) == expected
+
+def test_peephole_optimiser_errors():
+	code = 'f(x) = 1 + x, f(2) + f(3) + f("a")'
+	_, ast = calculator.parser.parse(code)
+	segment = calculator.bytecode.Builder().build(ast)
+	function_segment = segment[segment.bytecode.index(calculator.bytecode.I.FUNCTION_NORMAL) + 1][0]
+	assert calculator.bytecode.I.CONSTANT_OPERATOR in function_segment.bytecode
+	with pytest.raises(calculator.errors.EvaluationError) as error:
+		calculator.calculate(code, tick_limit=TIMEOUT)
+	position = error.value._linking['position']
+	assert code[position:].startswith('+ x')
+
+def test_constant_folding():
+	known = calculator.runtime.known_values()
+	def build(code, known_values={}):
+		builder = calculator.bytecode.Builder()
+		builder.known_values = known_values
+		_, ast = calculator.parser.parse(code)
+		return builder.build(ast).bytecode
+	I = calculator.bytecode.I
+	assert build('2 ^ 10 * 3 + 5%') == [I.CONSTANT, sympy.Rational(61441, 20), I.END]
+	assert build('2 ^ 10 * sin(pi / 6) + 3', known) == [I.CONSTANT, 515, I.END]
+	# Builtins are only folded if they're known to be safe
+	assert 'sin' in build('sin(pi / 6) + 3')
+	# Things that could explode are left until runtime
+	assert I.BIN_POW in build('10 ^ 100000')
+	assert I.BIN_MOD in build('5 ~mod 0')
+	# As are ones that could take forever to work out, even when they're never used
+	build('f(x) = x + floor(exp(10^20))', known)
+	build('if(0, ceiling(exp(10^20)), 1)', known)
+	for name, code in [('frac', 'frac(exp(10^20))'), ('int', 'int(-exp(10^20))'), ('sqrt', 'sqrt(10^999 + 7)')]:
+		assert name in build(code, known)
+	for code in ['2 ^ 10 * sin(pi / 6) + 3', 'sqrt(8) + 5% - -1', 'f(pi) = pi * 2, f(3)', '(sin -> sin(1))(cos)', '1 / 0', 'decimal(1/3) ^ 2']:
+		folded = calculator.interpereter.Interpereter()
+		builder = calculator.bytecode.Builder()
+		builder.known_values = known
+		folded.run(segment=calculator.runtime.prepare_runtime(builder))
+		_, ast = calculator.parser.parse(code)
+		assert calculator.formatter.format(folded.run(segment=builder.build(ast))) == \
+			calculator.formatter.format(calculator.calculate(code))
+
+def test_calling_cache():
+	interpereter = calculator.interpereter
+	segment = calculator.bytecode.CodeSegment(None)
+	f = calculator.functions.Function(segment, 0, None, 'f')
+	g = calculator.functions.Function(segment, 10, None, 'g')
+	key = lambda function, *arguments: interpereter.CacheKey(function, arguments)
+	cache = interpereter.CallingCache(capacity=2)
+	cache[key(f, 1)] = 10
+	cache[key(f, 2)] = 20
+	assert cache.lookup(key(f, 1)) == 10
+	cache[key(f, 3)] = 30
+	# f(2) was the least recently used
+	assert cache.lookup(key(f, 2)) is interpereter.CACHE_MISS
+	assert cache.lookup(key(f, 3)) == 30
+	stats = cache.definition(f).statistics
+	assert (stats.name, stats.hits, stats.misses, stats.evictions) == ('f', 2, 1, 1)
+	# Higher priority functions are evicted last
+	cache.set_policy(g, priority=1)
+	cache[key(g, 1)] = 1
+	cache[key(f, 4)] = 40
+	cache[key(f, 5)] = 50
+	assert key(g, 1) in cache and key(f, 5) in cache
+	# Functions can opt out entirely
+	cache.set_policy(g, cache=False)
+	assert not cache.should_cache(g)
+	# Policies and statistics belong to the definition, not the name
+	assert not cache.should_cache(calculator.functions.Function(segment, 10, None, 'h'))
+	assert cache.should_cache(calculator.functions.Function(segment, 20, None, 'g'))
+	other = calculator.functions.Function(calculator.bytecode.CodeSegment(None), 0, None, 'f')
+	assert cache.lookup(key(other, 1)) is interpereter.CACHE_MISS
+	assert cache.definition(other).statistics.misses == 1
+	assert cache.definition(f).statistics.misses == 1
+	assert cache.total_statistics().misses == 2
+	# They go away along with the code
+	del other
+	assert sorted(i.name for i in cache.all_statistics()) == ['f', 'g', 'g']
+	# Big entries are limited by the memory budget
+	cache = interpereter.CallingCache(memory_budget=10000)
+	big = calculator.functions.create_list(range(100))
+	for i in range(10):
+		cache[key(f, i)] = big
+	assert 0 < len(cache) < 10
+	assert cache.size <= 10000
+
+def test_calling_cache_reassignment():
+	doit('g = 1, f(x) = x + g, a = f(1), g = 2, a + f(1)', 5)
+	# Defining a global for the first time also matters, since the
+	# error from failing to access it can be caught
+	doit('f(x) = try(g * x, 0), a = f(2), g = 5, a + f(2)', 10)
+	from mathbot.calculator import blackbox
+	terminal = blackbox.Terminal.new_blackbox_sync(retain_cache=True)
+	outputs = [terminal.execute(line)[0] for line in [
+		'f(x) = try(g * x, 0)', 'f(2)', 'g = 5', 'f(2)', 'unload? g', 'f(2)', 'symbol? g', 'f(2)'
+	]]
+	assert outputs[1::2] == ['0', '10', '0', '2×g']
+
+def test_sequence_hashing():
+	functions = calculator.functions
+	flat = functions.create_list([1, 2, 3])
+	linked = functions.List(1, functions.List(2, functions.List(3, functions.EMPTY_LIST)))
+	array = functions.Array([0, 1, 2, 3], 1)
+	for sequence in [linked, flat.rest.rest, array]:
+		assert hash(sequence) == hash(sequence)
+	assert hash(flat) == hash(linked) == hash(array)
+	assert flat == linked == array
+	assert flat.rest == linked.rest == array.rest
+	assert flat != functions.create_list([1, 2, 4])
+	assert flat != functions.create_list([1, 2])
+	# Items must have the same type
+	glyphs = functions.create_list(map(functions.Glyph, 'abc'))
+	assert glyphs != functions.create_list([1, 2, 3])
+	# Long lists don't hit the recursion limit
+	long = functions.EMPTY_LIST
+	for i in range(20000):
+		long = functions.List(i, long)
+	assert hash(long) == hash(functions.create_list(range(19999, -1, -1)))
+	# Equal sequences are treated as the same key by the cache
+	doit('f(x) = length(x), f([1, 2, 3]) + f(list(1, 2, 3))', 6, use_runtime=True)
+
+def test_indexed_scope():
+	IndexedScope = calculator.interpereter.IndexedScope
+	root = IndexedScope(None, 0, [])
+	root.set(2, 0, 'protected', protection=1)
+	root.set(0, 0, 'free')
+	assert root.get(0, 0) == 'free'
+	assert root.get(2, 0) == 'protected'
+	with pytest.raises(calculator.interpereter.ScopeMissedError):
+		root.get(1, 0)
+	with pytest.raises(calculator.errors.EvaluationError):
+		root.set(2, 0, 'changed')
+	with pytest.raises(calculator.errors.EvaluationError):
+		root.reset(2, 0)
+	root.set(2, 0, 'changed', permission=1)
+	assert root.get(2, 0) == 'changed'
+	# Parameter frames use the arguments directly
+	arguments = (1, 2)
+	frame = IndexedScope(root, 2, arguments)
+	assert frame.values is arguments
+	assert frame.security is None
+	assert frame.get(1, 0) == 2
+	assert frame.get(2, 1) == 'changed'
+	frame.set(0, 0, 3)
+	assert frame.get(0, 0) == 3
+	assert arguments == (1, 2)
+	with pytest.raises(calculator.errors.SystemError):
+		IndexedScope(root, 3, arguments)
+
+def test_execution_quota():
+	from mathbot.calculator import blackbox, quota
+	terminal = blackbox.Terminal.new_blackbox_sync(
+		command_quota=quota.Budget(cpu_time=5, ticks=5000)
+	)
+	output, worked, details = terminal.execute('f(n) = if (n == 0, 0, 1 + f(n - 1)), f(10)')
+	assert worked and output == '10'
+	assert 0 < details['usage'].ticks < 5000
+	output, worked, details = terminal.execute('g(n) = g(n + 1), g(0)')
+	assert not worked and output == 'Operation timed out'
+	assert details['usage'].ticks >= 5000
+	# Quotas can be tightened for a single command
+	output, worked, details = asyncio.get_event_loop().run_until_complete(
+		terminal.execute_async('f(100)', budget=quota.Budget(ticks=100))
+	)
+	assert not worked and output == 'Operation timed out'
+	# The work done by the builtins written in Python counts as well
+	import time
+	started = time.process_time()
+	output, worked, details = terminal.execute('foldl((a b) -> a + b, 0, map(x -> length(range(0, 100000)), range(0, 100)))')
+	assert worked and details['usage'].cpu_time > (time.process_time() - started) / 2
+	# Running out of quota can't be caught by the error handling in the language
+	with pytest.raises(quota.QuotaExceededError):
+		calculator.interpereter.Interpereter().run(
+			segment=calculator.bytecode.Builder().build(calculator.parser.parse('h(x) = h(x), h(1)')[1]),
+			budget=quota.Budget(ticks=1000)
+		)
+
+def test_quota_buckets():
+	from mathbot.calculator import quota
+	now = [0]
+	manager = quota.QuotaManager(
+		command=quota.Budget(cpu_time=5),
+		channel=(quota.Budget(cpu_time=20), 0.1),
+		guild=(quota.Budget(cpu_time=30), 0.1),
+		clock=lambda: now[0]
+	)
+	assert manager.remaining('a', 'x').cpu_time == 5
+	manager.charge('a', 'x', quota.Budget(cpu_time=18, ticks=100))
+	assert manager.remaining('a', 'x').cpu_time == 2
+	assert manager.remaining('b', 'x').cpu_time == 5
+	manager.charge('b', 'x', quota.Budget(cpu_time=14, ticks=100))
+	assert manager.remaining('c', 'x').exhausted
+	assert manager.remaining('c', None).cpu_time == 5
+	assert manager.retry_after('c', 'x') == pytest.approx(2 / 3)
+	now[0] = 1
+	assert manager.remaining('a', 'x').cpu_time == pytest.approx(1)
+	now[0] = 100
+	assert manager.remaining('a', 'x').cpu_time == 5
+
+def test_snapshot():
+	from mathbot.calculator import blackbox, snapshot
+	original = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	for line in ['x = 3', 'f(a) = a * x', 'add = a -> b -> a + b', 'inc = add(1)',
+				 'l = map(f, range(1, 4))', 's = "hi"', 'sq = reverse(array(1, 4, 9))',
+				 't = hashmap([["a", 1], [[2], hashset([3])]])']:
+		assert original.execute(line)[1]
+	data = original.snapshot()
+	restored = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	restored.restore(data)
+	assert restored.execute('f(2)')[0] == '6'
+	assert restored.execute('inc(4)')[0] == '5'
+	assert restored.execute('l')[0] == '[3  6  9]'
+	assert restored.execute('s')[0] == '"hi"'
+	assert restored.execute('sq')[0] == '[9  4  1]'
+	assert restored.execute('get(t, "a") + length(get(t, [2]))')[0] == '2'
+	# Runtime protection still applies, and new globals don't collide with old ones
+	assert not restored.execute('map = 4')[1]
+	assert restored.execute('y = 10, x = 2, f(y)')[0] == '20'
+	assert restored.execute('l')[0] == '[3  6  9]'
+	# Snapshots from other versions, or that try to load strange things, are rejected
+	fresh = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	with pytest.raises(snapshot.SnapshotError):
+		fresh.restore('0000:' + data.split(':')[1])
+	import pickle, base64, zlib, os
+	evil = base64.b64encode(zlib.compress(pickle.dumps({'names': os.system}))).decode('ascii')
+	with pytest.raises(snapshot.SnapshotError):
+		fresh.restore(snapshot.version() + ':' + evil)
+	assert not fresh.execute('x')[1]
+	# Including ones that reach other things through the objects that are allowed
+	def reduce_global(module, name, arguments):
+		quoted = lambda x: pickle.dumps(x, protocol=4)[2:-1]
+		return b'\x80\x04' + quoted(module) + quoted(name) + b'\x93' + quoted(arguments) + b'R.'
+	for module, name, arguments in [
+		('mpmath.libmp.backend', 'os.getcwd', ()),
+		('mathbot.calculator.functions', 'asyncio.sleep', (0,)),
+		('os', 'getcwd', ()),
+		('sympy.functions.elementary.trigonometric', 'sin', ('__import__("os").getcwd()',)),
+	]:
+		with pytest.raises(snapshot.SnapshotError):
+			snapshot.load_bytes(reduce_global(module, name, arguments), fresh.snapshot_base)
+	assert snapshot.load_bytes(reduce_global('sympy.core.numbers', 'Integer', (3,)), fresh.snapshot_base) == 3
+
+def test_runtime_image(tmp_path, monkeypatch):
+	from mathbot.calculator import blackbox, image
+	monkeypatch.setattr(image, 'DIRECTORY', str(tmp_path))
+	monkeypatch.setattr(image, '_IMAGES', {})
+	first = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	assert os.path.exists(image.filename(2))
+	# Terminals made from the same image don't share their globals
+	second = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	assert first.execute('x = 4')[1]
+	assert not second.execute('x')[1]
+	assert second.execute('foldl(sum, 0, map(a -> a * 2, range(1, 4)))')[0] == '12'
+	assert second.execute('factorial(5) + sin(0)')[0] == '120'
+	assert not second.execute('map = 4')[1]
+	# A new process reads the image from disk, and rebuilds it if it's damaged
+	monkeypatch.setattr(image, '_IMAGES', {})
+	with open(image.filename(2), 'wb') as f:
+		f.write(b'not an image')
+	third = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	assert third.execute('reverse(array(1, 2))')[0] == '[2  1]'
+	with open(image.filename(2), 'rb') as f:
+		assert f.read() == image._IMAGES[2].data
+
+def test_shared_runtime_scope():
+	from mathbot.calculator import blackbox
+	first = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	second = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	index = first.builder.extrascope['map']
+	# The runtime is shared until a terminal assigns something
+	assert first.interpereter.root_scope.values is second.interpereter.root_scope.values
+	assert first.interpereter.root_scope.get(index, 0) is second.interpereter.root_scope.get(index, 0)
+	assert not first.execute('map = 3')[1]
+	assert first.interpereter.root_scope.values is second.interpereter.root_scope.values
+	assert first.execute('x = 5, map(a -> a + x, [1])')[0] == '[6]'
+	assert first.interpereter.root_scope.values is not second.interpereter.root_scope.values
+	assert first.interpereter.root_scope.get(index, 0) is second.interpereter.root_scope.get(index, 0)
+	assert not second.execute('x')[1]
+	assert first.execute('unload? x')[1]
+	assert not first.execute('x')[1]
+	assert first.execute('map(a -> a, [1])')[0] == '[1]'
+	# Unprotected terminals can change the runtime, so they get their own copy
+	unprotected = blackbox.Terminal.new_blackbox_sync()
+	assert isinstance(unprotected.interpereter.root_scope.values, list)
+	assert unprotected.interpereter.root_scope.get(index, 0) is not second.interpereter.root_scope.get(index, 0)
+	assert second.execute('map(a -> a, [1])')[0] == '[1]'
+
+def test_eviction():
+	from mathbot.calculator import eviction, blackbox
+	now = [0]
+	evicted = []
+	busy = set()
+	manager = eviction.EvictionManager(
+		max_entries=3,
+		memory_budget=1000,
+		minimum_idle=10,
+		on_evict=evicted.append,
+		is_busy=busy.__contains__,
+		clock=lambda: now[0]
+	)
+	for key in 'abc':
+		manager.touch(key, 100)
+		now[0] += 20
+	manager.touch('a', 100)
+	# Least recently used first, but busy terminals are skipped
+	busy.add('b')
+	assert manager.touch('d', 100) == ['c']
+	assert evicted == ['c'] and len(manager) == 3 and manager.size == 300
+	# Terminals that were used recently are kept even if it means going over budget
+	assert manager.touch('e', 900) == []
+	assert manager.size == 1200
+	busy.clear()
+	assert manager.enforce() == ['b']
+	now[0] += 20
+	assert manager.enforce() == ['a']
+	assert list(manager.entries) == ['d', 'e'] and manager.size == 1000
+	manager.discard('e')
+	assert manager.size == 100
+	assert manager.statistics.evictions == 3
+	assert evicted == ['c', 'b', 'a']
+	manager.record_rehydration(0.5)
+	manager.record_rehydration(1.5)
+	assert manager.statistics.mean_rehydration_time == 1
+	assert manager.statistics.slowest_rehydration == 1.5
+	# Estimates only count what the terminal doesn't share with others
+	term = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2)
+	empty = term.memory_usage()
+	assert empty == blackbox.TERMINAL_SIZE
+	term.execute('x = range(1, 1000)')
+	assert term.memory_usage() > empty
+
+def test_result_cache():
+	from mathbot.calculator import results, blackbox
+	now = [0]
+	cache = results.ResultCache(capacity=2, ttl=100, clock=lambda: now[0])
+	cache.put('a', '1')
+	cache.put('b', '2')
+	assert cache.get('a') == '1'
+	cache.put('c', '3')
+	assert cache.get('b') is None and len(cache) == 2
+	now[0] += 100
+	assert cache.get('a') is None and len(cache) == 1
+	assert (cache.statistics.hits, cache.statistics.misses) == (1, 2)
+	assert (cache.statistics.evictions, cache.statistics.expirations) == (1, 1)
+	# Only code that doesn't depend on the terminal's state is cached
+	shared = results.ResultCache()
+	first = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2, result_cache=shared)
+	second = blackbox.Terminal.new_blackbox_sync(runtime_protection_level=2, result_cache=shared)
+	for code in ['x = 3', 'f(y) = y + x', 'x', 'f(2)', 'unload? x', 'symbol? z']:
+		first.execute(code)
+	assert len(shared) == 0
+	assert first.execute('map(x -> x * 2, [1, sqrt(2)])')[0] == '[2  2×sqrt(2)]'
+	assert second.execute('map(x  ->  x*2, [1, sqrt(2)])  # comment') == ('[2  2×sqrt(2)]', True, {'cached': True})
+	assert second.execute('x') != first.execute('x')
+	assert first.execute('length(3)')[1] is False and len(shared) == 1
+	assert shared.statistics.hits == 1
+
+def test_crucible_round_trip():
+	from mathbot.calculator import crucible
+	import operator
+	import time
+	async def work():
+		pool = crucible.Pool(2)
+		assert await pool.run(crucible.small, (3,)) == 9
+		started = time.perf_counter()
+		results = [await pool.run(crucible.small, (i,)) for i in range(20)]
+		elapsed = time.perf_counter() - started
+		assert results == [i * i for i in range(20)]
+		# Workers wait for jobs, rather than checking for them every so often
+		assert elapsed < 1
+		# Workers that die are replaced
+		with pytest.raises(Exception):
+			await pool.run(operator.truediv, (1, 0))
+		assert await pool.run(crucible.echo, ('hi',)) == 'hi'
+	asyncio.get_event_loop().run_until_complete(work())
+
+def test_crucible_pool():
+	from mathbot.calculator import crucible
+	async def work():
+		pool = crucible.Pool(2, spares=1, max_jobs=3)
+		await pool.start()
+		assert pool.workers == 3 and len(pool._idle) == 3
+		for i in range(6):
+			assert await pool.run(crucible.small, (i,)) == i * i
+		assert pool.statistics.recycled == 2
+		async def replenished():
+			while pool._replenishing is not None and not pool._replenishing.done():
+				await asyncio.sleep(0.1)
+			return len(pool._idle)
+		assert await replenished() == 3
+		# Idle workers that die are noticed and replaced
+		for proc in pool._idle:
+			proc.terminate()
+		await asyncio.sleep(0.5)
+		assert await pool.run(crucible.echo, (1,)) == 1
+		assert pool.statistics.restarts == 3
+		assert await replenished() == 3
+		assert pool.statistics.jobs == 7 and pool.statistics.queued == 0
+		pool.close()
+		assert pool.workers == 0
+	asyncio.get_event_loop().run_until_complete(work())
+
+def _allocate(size):
+	return len(bytearray(size))
+
+def _spin():
+	while True:
+		pass
+
+def test_crucible_limits(monkeypatch):
+	from mathbot.calculator import crucible
+	import operator
+	async def work():
+		pool = crucible.Pool(1, memory_limit=512 * 1024 * 1024, cpu_limit=1)
+		assert await pool.run(_allocate, (1024,)) == 1024
+		with pytest.raises(crucible.ResourceExhausted) as info:
+			await pool.run(_allocate, (1024 * 1024 * 1024,))
+		assert info.value.resource == crucible.MEMORY
+		# The worker is killed by the OS, rather than timing out
+		with pytest.raises(crucible.ResourceExhausted) as info:
+			await pool.run(_spin, (), timeout=10)
+		assert info.value.resource == crucible.CPU_TIME
+		# Exceptions don't kill the worker
+		with pytest.raises(crucible.JobFailed):
+			await pool.run(operator.truediv, (1, 0))
+		assert pool.statistics.exhausted == {crucible.MEMORY: 1, crucible.CPU_TIME: 1}
+		assert pool.statistics.restarts == 2 and pool.statistics.timeouts == 0
+		assert await pool.run(crucible.small, (5,)) == 25
+		pool.close()
+	asyncio.get_event_loop().run_until_complete(work())
+	# The calculator reports these as errors
+	async def exhausted(function, arguments, timeout):
+		raise crucible.ResourceExhausted(crucible.MEMORY)
+	monkeypatch.setattr(crucible, 'run', exhausted)
+	with pytest.raises(calculator.errors.ResourceExhaustedError):
+		asyncio.get_event_loop().run_until_complete(
+			calculator.interpereter.protected_power(True, sympy.Integer(10), sympy.Integer(10 ** 10)))
+	from mathbot.calculator import blackbox
+	term = blackbox.Terminal.new_blackbox_sync()
+	assert term.execute('factorial(1000)')[0].endswith('Operation used too much memory. Perhaps the values were too large?')
+
+class _SlowSymbol(sympy.Symbol):
+	def evalf(self, *args, **kwargs):
+		import time
+		time.sleep(5)
+
+def test_render(monkeypatch):
+	from mathbot.calculator import formatter, crucible
+	assert formatter.render(sympy.Rational(2, 3)) == ('2/3', '0.666666666666667', [])
+	assert formatter.render(sympy.Integer(3)) == ('3', None, [])
+	exact, approximation, timed_out = formatter.render(sympy.Integer(10) ** 999, limit=100)
+	assert exact == '1000000000…0000000000 (1000 digits)'
+	assert approximation == '1e+999' and timed_out == []
+	assert formatter.render(_SlowSymbol('x'), time_limit=0.1) == ('x', None, ['approximation'])
+	from mathbot.calculator import blackbox
+	term = blackbox.Terminal.new_blackbox_sync(output_limit=100)
+	assert term.execute('10^999')[0] == exact + ' = ' + approximation
+	# The approximation is done in the crucible, so it can time out there
+	async def approximation_timed_out(function, arguments, timeout):
+		return ('2/3', None, [formatter.APPROXIMATION])
+	monkeypatch.setattr(crucible, 'run', approximation_timed_out)
+	assert term.execute('2/3')[0] == '2/3 [approximation timed out]'
+
+def test_large_integers():
+	from mathbot.calculator import formatter
+	for n in [0, 9, 10, 10 ** 999 - 1, 10 ** 999, 10 ** 1000 + 1, 2 ** 10000]:
+		assert formatter.digit_count(n) == formatter.digit_count(-n) == len(str(n))
+	# Integers are shown in full if they fit in the output
+	assert formatter.format(sympy.Integer(10) ** 3999).startswith('1‚000‚000‚')
+	assert formatter.format(sympy.Integer(10) ** 4000) == '1000000000…0000000000 (4001 digits)'
+	assert len(formatter.format(-sympy.Integer(10) ** 1461, limit=1950)) == 1950
+	assert formatter.format(sympy.Integer(10) ** 1462, limit=1950) == '1000000000…0000000000 (1463 digits)'
+	assert formatter.format(sympy.Integer(10) ** 1462, width=2000).startswith('10‚000‚000‚')
+	assert formatter.format(-sympy.Integer(2) ** 100000 + 1) == '-9990020930…9883109375 (30103 digits)'
+	assert formatter.format(sympy.Rational(2 ** 10000, 3), limit=1950) == '1995063116…2596709376 (3011 digits)/3'
+	assert formatter.format(sympy.Rational(1, 3)) == '1/3'
+	from mathbot.calculator import blackbox
+	term = blackbox.Terminal.new_blackbox_sync()
+	assert term.execute('2^100000')[0] == '9990020930…9883109376 (30103 digits) = 9.99002093014385e+30102'
+	term = blackbox.Terminal.new_blackbox_sync(output_limit=1950)
+	assert term.execute('10^1200')[0].startswith(formatter.format(sympy.Integer(10) ** 1200) + ' = ')
+
+def test_profiler():
+	from mathbot.calculator import profiler
+	I = calculator.bytecode.I
+	ticks = iter(range(1000000))
+	prof = profiler.Profiler(clock=lambda: next(ticks))
+	interp = calculator.interpereter.Interpereter(compile_threshold=0)
+	builder = calculator.bytecode.Builder()
+	interp.run(segment=calculator.runtime.prepare_runtime(builder))
+	interp.profiler = prof
+	code = 'f(x) = if (x == 0, 0, g(x)), g(x) = 1 + f(x - 1), h(x) = x(1), f(3)'
+	_, ast = calculator.parser.parse(code)
+	assert interp.run(segment=builder.build(ast)) == 3
+	assert prof.depth == 0
+	# Functions are left when there's an error
+	_, ast = calculator.parser.parse('h(0)')
+	with pytest.raises(calculator.errors.EvaluationError):
+		interp.run(segment=builder.build(ast))
+	assert prof.depth == 0
+	assert prof.functions['f'].calls == 4
+	assert prof.functions['g'].calls == 3
+	assert prof.functions['h'].calls == 1
+	# Total time of recursive functions is only counted once
+	assert prof.functions['f'].total_time < sum(i.time for i in prof.opcodes.values())
+	assert sum(i.ticks for i in prof.opcodes.values()) == sum(i[0] for i in prof.stacks.values())
+	returns = sum(prof.opcodes[i].ticks for i in (I.RETURN, I.RETURN_CACHED) if i in prof.opcodes)
+	assert returns > 0
+	folded = prof.collapsed(weight='ticks').split('\n')
+	# f calls g in tail position, so g replaces it
+	assert any(i.startswith('<main>;g;g;g;f ') for i in folded)
+	assert all(int(i.rsplit(' ', 1)[1]) > 0 for i in folded)
+
+def test_native_numbers():
+	operators = calculator.operators
+	assert operators.exact_add(2, 3) == 5
+	assert operators.exact_division(6, 3).__class__ is int
+	assert operators.exact_division(7, 2) == operators.NativeRational(7, 2)
+	assert operators.exact_multiply(sympy.Integer(2), operators.NativeRational(1, 4)) == operators.NativeRational(1, 2)
+	# Things that don't have native results are left to sympy
+	assert operators.exact_division(1, 0) == sympy.zoo
+	assert operators.exact_add(sympy.Symbol('x'), 1) == sympy.Symbol('x') + 1
+	assert operators.try_native(operators.operator_power, 2, operators.NativeRational(1, 2)) is NotImplemented
+	assert operators.try_native(operators.operator_power, 10, 3000) is NotImplemented
+	big = operators.to_sympy(10) ** 1500
+	assert operators.exact_multiply(10 ** 1500, 10 ** 1500) == big ** 2
+	assert operators.try_native(operators.operator_multiply, 10 ** 1500, 10 ** 1500) is NotImplemented
+	# Native numbers use the same dispatchers as everything else
+	assert operators.operator_multiply.find(2, 3) is operators.multiply_ints
+	assert operators.operator_power.find(operators.NativeRational(1, 2), 3) is operators.power_int
+	assert operators.operator_add(1.5, 2) == 3.5
+	# Results match what sympy would have produced
+	for a, b in [(7, 2), (-7, 3), (operators.NativeRational(2, 3), 5), (0, 4)]:
+		x, y = sympy.Integer(1) * a, sympy.Integer(1) * b
+		assert operators.exact_subtract(a, b) == x - y
+		assert operators.exact_modulo(a, b) == x % y
+		assert operators.try_native(operators.operator_power, a, -2 if a else 2) == x ** (-2 if a else 2)
+	# The interpereter uses them, but returns sympy values
+	doit('x = 3, y = x / 6, y * 4', 2)
+	doit('f(x) = x * 2, f(1 / 3)', sympy.Rational(2, 3))
+	assert isinstance(calculator.calculate('x = 7, x / 2'), sympy.Rational)
+	doit('x = 10, x ^ 3000 - x ^ 3000', 0)
+	doformatted('x = 1, [x, x / 2, x ^ 0.5]', '[1  1/2  1]')
+	dort('x = 1, [x, x / 2] == [1, 1 / 2]', True)
+
+def test_native_list_functions():
+	from mathbot.calculator import blackbox, quota
+	doformatted('map(x -> x * 2, range(0, 4))', '[0  2  4  6]')
+	doformatted('filter(x -> x ~mod 2, range(0, 6))', '[1  3  5]')
+	doformatted('foldr((a b) -> a:b, [], reverse([1, 2, 3]))', '[3  2  1]')
+	doformatted('sort([3, 1/2, 2.5, -1])', '[-1  1/2  5/2  3]')
+	doformatted('sort("cab")', '"abc"')
+	doformatted('zip(take([1, 2, 3], 2), drop([4, 5, 6], 1))', '[[1  5]  [2  6]]')
+	doformatted('join([1, 2], [3])', '[1  2  3]')
+	dort('foldl(sum, 0, range(0, 1001))', 500500)
+	doformatted('f(x) = map(y -> y + x, [1, 2]), f(3)', '[4  5]')
+	# Anything out of the ordinary is handled by the library versions
+	doformatted('map(x -> x, [1 2 3])', '[1  2  3]')
+	throws('take([1, 2], 5)')
+	doformatted('range(1/2, 5/2)', '[1/2  3/2]')
+	throws('range(1/2, 3)')
+	throws('map(3, [1])')
+	throws('join([1], 2)')
+	# Only the rest of the list is handed over part way through
+	doformatted('symbol? z, _native_filter(x -> if(x == 2, z > 1, x), [1, 0, 2, 3, 0], (f l) -> l)', '[1  2  3  0]')
+	# Errors in the functions they call can still be caught
+	dort('try(map(x -> length(x), [1]), 7)', 7)
+	terminal = blackbox.Terminal.new_blackbox_sync(command_quota=quota.Budget(ticks=5000))
+	output, worked, details = terminal.execute('try(map(x -> foldl(sum, 0, range(0, 10^5)), [1]), 7)')
+	assert not worked and output == 'Operation timed out'
+
+def test_hash_maps():
+	import pickle
+	import random
+	functions = calculator.functions
+	generator = random.Random(25)
+	table, expected = functions.HashMap(), {}
+	for _ in range(5000):
+		key = generator.randrange(1000)
+		if generator.random() < 0.3:
+			table, _ = table.without(key), expected.pop(key, None)
+		else:
+			table, expected[key] = table.with_item(key, key * 2), key * 2
+	# Things are kept in the order that they were first added, like a dict
+	assert table.items() == list(expected.items())
+	assert table.lookup(sympy.Integer(next(iter(expected)))) is not None
+	restored = pickle.loads(pickle.dumps(table))
+	assert restored == table and hash(restored) == hash(table)
+	# Keys are compared strictly, and sets can be keys
+	assert functions.HashMap().with_item(1, 'a').lookup(sympy.Float(1)) is None
+	small = functions.HashSet.from_keys([1, 2])
+	assert functions.HashMap().with_item(small.insert(3), 'x').lookup(functions.HashSet.from_keys([3, 2, 1])) == 'x'
+	# Keys with the same hash
+	class Colliding:
+		def __init__(self, value):
+			self.value = value
+		def __hash__(self):
+			return 7
+		def __eq__(self, other):
+			return self.value == other.value
+	keys = [Colliding(i) for i in range(5)]
+	table = functions.HashMap.from_items((k, k.value) for k in keys)
+	assert [table.lookup(k) for k in keys] == [0, 1, 2, 3, 4]
+	table = table.without(keys[1]).without(keys[3])
+	assert len(table) == 3 and table.lookup(keys[1]) is None and table.lookup(keys[4]) == 4
+	# In the language
+	doformatted('assoc(assoc(hashmap(), 1, "one"), [2], 3)', 'hashmap(1: "one"  [2]: 3)')
+	doformatted('hashmap([[1, 2], [1, 3], [4, 5]])', 'hashmap(1: 2  4: 5)')
+	doformatted('update(hashmap([[1, 2]]), 1, x -> x * 10)', 'hashmap(1: 20)')
+	doformatted('t = hashmap([["a", 1], ["b", 2]]), [get(t, "b"), get(t, "c"), keys(t), values(t)]', '[2  []  ["a"  "b"]  [1  2]]')
+	doformatted('aremove_value(aremove(hashmap([[1, 2], [3, 4], [5, 4]]), 1), 4)', 'hashmap()')
+	doformatted('set_remove(set_insert(hashset([3, 1, 3]), 2), 1)', 'hashset(3  2)')
+	dort('length(foldl((t i) -> assoc(t, i, i), hashmap(), range(0, 500)))', 500)
+	dort('s = hashset([1, 2]), [in(s, 2), in(s, 5), set_equals(s, hashset([2, 1]))] == [true, false, true]', True)
+	dort('hashmap([[1, [2]]]) == hashmap([[1, [2]]])', True)
+	throws('hashmap([1]) == [1]')
+	# A list compared to a set counts as the set of its items
+	dort('set_equals(hashset([1]), [1])', True)
+	dort('set_equals([2, 1, 2], hashset([1, 2]))', True)
+	dort('set_equals(hashset([1]), [1, 2])', False)
+	throws('set_equals(hashset([1]), 1)')
+	# Missing keys give the empty list, as they do for association lists
+	doformatted('get(hashmap([[x -> x, 1]]), 2)', '[]')
+	assert str(calculator.calculate('get(hashmap([[x -> x, 1]]), 2)')) == 'list()'
+	dort('f = x -> x, get(hashmap([[f, 1]]), f)', 1)
+	# The library functions still work on lists
+	doformatted('get(assoc(assoc([], 1, 2), 3, 4), 3)', '4')
+	doformatted('to_set([1, 2, 1])', '[1  2]')